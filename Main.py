@@ -1,6 +1,10 @@
 # coding=utf-8
+import sys
 import src.interaction.UserFacer as User
+import src.interaction.Cli as Cli
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:  # 有参数时不打开窗口, 见 Cli
+        sys.exit(Cli.main(sys.argv[1:]))
     a = User.UserFacer()
     a.mainloop()
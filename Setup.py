@@ -2,7 +2,7 @@
 import os
 import sys
 
-needs = ['pip']
+needs = ['pip', 'psutil']  # psutil 用于显示运行中项目的 CPU 与内存占用
 logName = 'Azazo1Logs.txt'
 print('Start')
 state = 1
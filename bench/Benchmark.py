@@ -0,0 +1,310 @@
+# coding=utf-8
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import multiprocessing
+from typing import List, Tuple, Dict, Optional
+import src.Constant as Const
+from src.emails.EmailManager import Downloader, Uploader, ProjectArchiveInfo
+from src.emails.AsyncEngine import AsyncDownloader
+from src.emails.Catalog import MailCatalog
+from src.Trace import tracer
+from bench import MailServers
+
+FORMAT_VERSION = 1
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# 指标 => 数值变大是否更差
+METRICS = {'seconds': True, 'peak_bytes': True, 'imap_commands': True, 'mb_per_second': False}
+
+
+def parseSize(text: str) -> int:
+    """"512K", "4M" or a number of bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def log(msg: str):
+    sys.stderr.write(msg if msg.endswith('\n') else msg + '\n')
+
+
+def sizeOf(projectFile: ProjectArchiveInfo) -> int:
+    return os.path.getsize(projectFile.path) if projectFile.path else len(projectFile.data)
+
+
+class Recorder:
+    def __init__(self, counter, traceMemory: bool = True):
+        """counter: the multiprocessing.Value of the IMAP commands the stand-in server answered"""
+        self.counter = counter
+        self.traceMemory = traceMemory
+        self.results = {}  # type: Dict[str, dict]
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        time the block, count the IMAP commands it sent and trace the peak memory it allocated.
+        The block can put more numbers into the dict it gets, "bytes" also gives mb_per_second.
+        """
+        result = {}
+        gc.collect()
+        if self.traceMemory:
+            tracemalloc.start()  # 每个阶段重新开始, 峰值只属于该阶段
+        commands = self.counter.value
+        mark = tracer.mark()
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            seconds = time.perf_counter() - start
+            if self.traceMemory:
+                result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        result['seconds'] = round(seconds, 4)
+        result['imap_commands'] = self.counter.value - commands
+        if 'bytes' in result and seconds > 0:
+            result['mb_per_second'] = round(result['bytes'] / seconds / 1024 ** 2, 2)
+        if tracer.enabled:
+            result['spans'] = tracer.summary(mark)
+        self.results[name] = result
+        log(f'{name:<20}{seconds:>9.3f}s  ' + '  '.join(
+            f'{key}={value}' for key, value in result.items() if key not in ('seconds', 'spans')))
+
+
+def useServers(imapPort: int, smtpPort: int):
+    Const.IMAP_HOST, Const.IMAP_PORT, Const.IMAP_SSL = '127.0.0.1', imapPort, False
+    Const.SMTP_HOST, Const.SMTP_PORT, Const.SMTP_SSL = '127.0.0.1', smtpPort, False
+    Const.PASSWORD = 'benchmark'
+
+
+def makeProjectFolder(path: str, archiveSize: int, fileSize: int):
+    for name, data in MailServers.projectFilesOf(0, archiveSize, fileSize).items():
+        filePath = os.path.join(path, name)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        with open(filePath, 'wb') as w:
+            w.write(data)
+
+
+def benchUpload(recorder: Recorder, args):
+    folders = []
+    for index in range(args.uploads):
+        folder = os.path.join('upload', f'upload{index}')
+        makeProjectFolder(folder, args.archive_size, args.file_size)
+        folders.append(folder)
+    with recorder.phase('upload') as result:
+        for index, folder in enumerate(folders):
+            uploader = Uploader(f'upload{index}' if index % 2 else f'上传{index}', '1.0',  # 也有中文项目名
+                                compression=args.compression)
+            uploader.login()
+            uploader.attachFolder(folder)
+            uploader.send()
+        result['projects'] = len(folders)
+        result['bytes'] = args.archive_size * len(folders)
+    shutil.rmtree('upload', ignore_errors=True)
+
+
+def benchSync(recorder: Recorder, args, targets: List[Tuple[str, str]]):
+    downloader = Downloader()
+    downloader.login()
+    try:
+        with recorder.phase('list') as result:
+            result['emails'] = len(downloader.getAllAvailableEmails(args.batch))
+    finally:
+        downloader.close()
+
+    catalog = MailCatalog(Const.CATALOG_PATH)
+    downloader = Downloader(catalog=catalog, poolSize=args.jobs)
+    try:
+        downloader.login()
+        with recorder.phase('list_catalog_cold') as result:
+            result['emails'] = len(downloader.getAllAvailableEmails(args.batch))
+        downloader.close()
+        downloader = Downloader(catalog=catalog, poolSize=args.jobs)  # 像重新打开程序一样, 只取新邮件
+        downloader.login()
+        with recorder.phase('list_catalog_warm') as result:
+            result['emails'] = len(downloader.getAllAvailableEmails(args.batch))
+        try:
+            fetched = {}
+            start = time.perf_counter()
+            with recorder.phase('fetch') as result:
+                failed = downloader.fetchAll(targets, fetched=lambda target: fetched.__setitem__(
+                    target, time.perf_counter() - start))
+                result['projects'] = len(fetched)
+                result['failed'] = len(failed)
+                result['bytes'] = sum(sizeOf(projectFile) for projectFile in downloader.got_files)
+                result['first_project_seconds'] = round(min(fetched.values()), 4) if fetched else None
+            with recorder.phase('install') as result:
+                installed = []
+                downloader.save(installed=lambda projectFile, seconds: installed.append(
+                    sizeOf(projectFile)))
+                result['projects'] = len(installed)
+                result['bytes'] = sum(installed)
+        finally:
+            downloader.clearTempFile()
+            downloader.close()
+    finally:
+        catalog.close()
+
+
+async def benchAsync(recorder: Recorder, args, targets: List[Tuple[str, str]]):
+    downloader = AsyncDownloader(save_path='get-async', connections=args.jobs)
+    await downloader.login()
+    try:
+        with recorder.phase('async_list') as result:
+            result['emails'] = len(await downloader.getAllAvailableEmails(args.batch))
+        with recorder.phase('async_fetch') as result:
+            results = await asyncio.gather(*(downloader.fetch(projectName, version)
+                                             for projectName, version in targets), return_exceptions=True)
+            got = [projectFile for projectFile in results if isinstance(projectFile, ProjectArchiveInfo)]
+            result['projects'] = len(got)
+            result['failed'] = len(results) - len(got)
+            result['bytes'] = sum(sizeOf(projectFile) for projectFile in got)
+    finally:
+        await downloader.close()
+
+
+def gitCommit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bestOf(runs: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """the best value of every metric over the runs, the other numbers are the ones of the first run"""
+    best = {}
+    for name, result in runs[0].items():
+        best[name] = dict(result)
+        for metric, biggerIsWorse in METRICS.items():
+            values = [run[name][metric] for run in runs if run.get(name, {}).get(metric) is not None]
+            if values:
+                best[name][metric] = min(values) if biggerIsWorse else max(values)
+    return best
+
+
+def runOnce(args) -> Dict[str, dict]:
+    """every phase against a new mailbox, the servers run in another process"""
+    log(f'Filling the mailbox with {args.emails} emails...')
+    counter = multiprocessing.Value('Q', 0)
+    connection, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=MailServers.serve, daemon=True, args=(
+        {'emails': args.emails, 'projects': args.projects, 'archiveSize': args.archive_size,
+         'fileSize': args.file_size, 'latency': args.latency}, child, counter))
+    server.start()
+    imapPort, smtpPort, targets = connection.recv()
+    useServers(imapPort, smtpPort)
+    recorder = Recorder(counter, args.memory)
+    workDir = tempfile.mkdtemp(prefix='azazo1-bench-')
+    cwd = os.getcwd()
+    os.chdir(workDir)  # 所有相对路径 (get, temp, 目录数据库) 都在这里
+    try:
+        benchUpload(recorder, args)
+        benchSync(recorder, args, targets)
+        asyncio.run(benchAsync(recorder, args, targets))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+        connection.send('stop')
+        server.join(10)
+    return recorder.results
+
+
+def runBenchmark(args) -> dict:
+    config = {
+        'emails': args.emails, 'projects': args.projects, 'archive_size': args.archive_size,
+        'file_size': args.file_size, 'uploads': args.uploads, 'latency': args.latency, 'jobs': args.jobs,
+        'batch': args.batch, 'compression': args.compression, 'trace_memory': args.memory,
+        'trace': args.trace,
+    }
+    runs = []
+    for index in range(max(1, args.repeat)):
+        log(f'Run {index + 1}/{max(1, args.repeat)}')
+        runs.append(runOnce(args))
+    return {
+        'format': FORMAT_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'repeat': len(runs),
+        'results': bestOf(runs),
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """the metrics which got worse than the baseline by more than threshold, as readable lines"""
+    if baseline.get('config') != report['config']:
+        log('The baseline was run with another config, the numbers may not be comparable.')
+    regressions = []
+    for name, result in report['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        for metric, biggerIsWorse in METRICS.items():
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            ratio = result[metric] / old[metric]
+            line = f'{name}.{metric}: {old[metric]} -> {result[metric]} ({ratio - 1:+.1%})'
+            if (ratio - 1 if biggerIsWorse else 1 - ratio) > threshold:
+                regressions.append(line)
+                log('REGRESSION ' + line)
+            else:
+                log('           ' + line)
+    return regressions
+
+
+def buildParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.Benchmark',
+        description='Measure Uploader, Downloader and AsyncDownloader against local IMAP/SMTP stand-in servers.')
+    parser.add_argument('-e', '--emails', type=int, default=1000, help='emails in the mailbox')
+    parser.add_argument('-p', '--projects', type=int, default=8, help='emails of them that carry big archives')
+    parser.add_argument('-s', '--archive-size', type=parseSize, default=parseSize('4M'),
+                        help='bytes of every big archive, like 512K or 4M')
+    parser.add_argument('--file-size', type=parseSize, default=parseSize('256K'), help='bytes of every file in them')
+    parser.add_argument('-u', '--uploads', type=int, default=2, help='projects uploaded through SMTP')
+    parser.add_argument('-l', '--latency', type=float, default=0.02, help='seconds before every command is answered')
+    parser.add_argument('-j', '--jobs', type=int, default=Const.POOL_SIZE, help='IMAP connections')
+    parser.add_argument('--batch', type=int, default=Const.FETCH_BATCH_SIZE, help='headers fetched per command')
+    parser.add_argument('--compression', default=Const.COMPRESSION, help='stored, deflate, bzip2 or lzma')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='run everything this many times and keep the best of every number')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not trace the peak memory, tracing makes everything slower')
+    parser.add_argument('--trace', action='store_true',
+                        help='also record the spans of every phase, tracing makes everything a little slower')
+    parser.add_argument('-o', '--output', default='bench_output.json', help='where the results are saved')
+    parser.add_argument('-c', '--compare', help='an earlier output, exit with 1 if anything got worse')
+    parser.add_argument('-t', '--threshold', type=float, default=0.15,
+                        help='how much worse counts as a regression, 0.15 is 15%%')
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    args = buildParser().parse_args(argv)
+    tracer.enabled = args.trace
+    report = runBenchmark(args)
+    with open(args.output, 'w', encoding='utf-8') as w:
+        json.dump(report, w, ensure_ascii=False, indent=1)
+    log(f'Saved to {args.output}.')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as r:
+            baseline = json.load(r)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
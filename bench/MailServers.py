@@ -0,0 +1,437 @@
+# coding=utf-8
+import io
+import os
+import re
+import json
+import time
+import queue
+import socket
+import hashlib
+import threading
+import socketserver
+import zipfile
+import email
+import email.header
+import email.policy
+import email.parser
+import email.message
+import multiprocessing
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from typing import List, Tuple, Dict, Optional, Callable
+import src.Constant as Const
+
+LITERAL_PATTERN = re.compile(rb'\{(\d+)\}\r\n$')
+SECTION_PATTERN = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', re.I)
+FETCH_ITEM_PATTERN = re.compile(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[^\s()]+', re.I)
+SEARCH_TOKEN_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+def quote(value) -> str:
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def unquote(text: str) -> str:
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def crlf(data: bytes) -> bytes:
+    return data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+
+
+def uidSetOf(spec: str, maxUID: int) -> Callable[[int], bool]:
+    """whether a UID is in an IMAP UID set, "n:*" always contains the biggest UID like a real server"""
+    ranges = []
+    for piece in spec.split(','):
+        first, _, last = piece.partition(':')
+        first = maxUID if first == '*' else int(first)
+        last = first if not last else maxUID if last == '*' else int(last)
+        ranges.append((min(first, last), max(first, last)))
+    return lambda UID: any(a <= UID <= b for a, b in ranges)
+
+
+class StoredMessage:
+    def __init__(self, UID: int, raw: bytes, date: float):
+        """everything the client asks for is worked out once and kept, the servers should not be the bottleneck"""
+        self.UID = UID
+        self.raw = raw
+        self.date = date
+        self.header = raw.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+        self.headers = email.parser.BytesHeaderParser().parsebytes(self.header)
+        self._message = None  # type: Optional[email.message.Message]
+        self._structure = None  # type: Optional[str]
+        self._sections = {}  # type: Dict[str, bytes]
+
+    def headerText(self, field: str) -> str:
+        """the header decoded, SEARCH HEADER of real servers matches the decoded text"""
+        value = self.headers.get(field) or ''
+        return str(email.header.make_header(email.header.decode_header(value))) if '=?' in value else value
+
+    def message(self) -> email.message.Message:
+        if self._message is None:
+            self._message = email.message_from_bytes(self.raw)
+        return self._message
+
+    def section(self, name: str) -> bytes:
+        """the data of BODY[name]"""
+        if name not in self._sections:
+            if name == '':
+                data = self.raw
+            elif name == 'HEADER':
+                data = self.header
+            elif name.upper().startswith('HEADER.FIELDS'):
+                fields = {field.lower() for field in re.search(r'\((.*)\)', name).group(1).split()}
+                lines = re.sub(rb'\r\n[ \t]', b' ', self.header).split(b'\r\n')
+                data = b''.join(line + b'\r\n' for line in lines
+                                if line.split(b':', 1)[0].decode().lower() in fields) + b'\r\n'
+                return data  # 字段组合很多, 不缓存
+            else:
+                part = self.message()
+                for index in name.split('.'):
+                    if part.is_multipart():
+                        part = part.get_payload()[int(index) - 1]
+                data = crlf(part.as_bytes() if part.is_multipart() else part.get_payload().encode())
+            self._sections[name] = data
+        return self._sections[name]
+
+    def structure(self) -> str:
+        if self._structure is None:
+            self._structure = self._structureOf(self.message(), '')
+        return self._structure
+
+    def _structureOf(self, part: email.message.Message, section: str) -> str:
+        if part.is_multipart():
+            children = ''.join(self._structureOf(child, f'{section}.{index}'.lstrip('.'))
+                               for index, child in enumerate(part.get_payload(), 1))
+            return f'({children} {quote(part.get_content_subtype().upper())} ' \
+                   f'("BOUNDARY" {quote(part.get_boundary())}) NIL NIL)'
+        params = part.get_params()[1:] if part.get_params() else []
+        params = '(' + ' '.join(f'{quote(key.upper())} {quote(value)}' for key, value in params) + ')' \
+            if params else 'NIL'
+        disposition = 'NIL'
+        if part.get('Content-Disposition'):
+            fileName = part.get_filename()
+            disposition = f'({quote(part.get_content_disposition().upper())} ' + \
+                          (f'("FILENAME" {quote(fileName)})' if fileName else 'NIL') + ')'
+        data = self.section(section or '1')
+        encoding = (part.get('Content-Transfer-Encoding') or '7BIT').upper()
+        text = f'({quote(part.get_content_maintype().upper())} {quote(part.get_content_subtype().upper())} ' \
+               f'{params} NIL NIL {quote(encoding)} {len(data)}'
+        if part.get_content_maintype() == 'text':
+            lines = data.count(b'\n') + 1
+            text += f' {lines}'
+        return text + f' NIL {disposition} NIL)'
+
+
+class Mailbox:
+    def __init__(self, uidValidity: int = 1, latency: float = 0.0, counter=None):
+        """
+        latency: seconds every command waits before it is answered, like the round trip to a real server.
+        counter: a multiprocessing.Value counting the IMAP commands, so the other process can read it.
+        """
+        self.uidValidity = uidValidity
+        self.latency = latency
+        self.counter = counter if counter is not None else multiprocessing.Value('Q', 0)
+        self.messages = []  # type: List[StoredMessage]
+        self.nextUID = 1
+        self.lock = threading.Lock()
+
+    def add(self, raw: bytes, date: float = None) -> int:
+        raw = crlf(raw)
+        with self.lock:
+            UID = self.nextUID
+            self.nextUID += 1
+            self.messages.append(StoredMessage(UID, raw, time.time() if date is None else date))
+        return UID
+
+    def snapshot(self) -> List[StoredMessage]:
+        with self.lock:
+            return list(self.messages)
+
+    def count(self):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+
+def archiveOf(projectName: str, version: str, files: Dict[str, bytes]) -> bytes:
+    """the archive Uploader would make of a folder named projectName, with its manifest"""
+    buffer = io.BytesIO()
+    manifest = {'project': projectName, 'version': version, 'base': None, 'files': {}, 'deleted': []}
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as z:  # 随机内容压缩不了
+        for name, data in files.items():
+            insidePath = f'{projectName}/{name}'
+            z.writestr(insidePath, data)
+            manifest['files'][insidePath] = hashlib.sha256(data).hexdigest()
+        z.writestr(Const.MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=1))
+    return buffer.getvalue()
+
+
+def projectMessage(projectName: str, version: str, files: Dict[str, bytes]) -> bytes:
+    """an email laid out as Uploader sends it"""
+    archive = archiveOf(projectName, version, files)
+    message = MIMEMultipart()
+    message.add_header('From', Const.EMAIL_ADDRESS)
+    message.add_header('To', Const.EMAIL_ADDRESS)
+    message.add_header('Subject', projectName)
+    message.add_header(Const.PROJECT_NAME_HEADER, projectName)
+    message.add_header(Const.PROJECT_VERSION_HEADER, version)
+    message.add_header(Const.ARCHIVE_HASH_HEADER, hashlib.sha256(archive).hexdigest())
+    message.attach(MIMEText(Const.SIGN, 'plain'))
+    attachment = MIMEApplication(archive)
+    attachment.add_header('Content-Disposition', 'attachment', filename=projectName + '.zip')
+    message.attach(attachment)
+    return message.as_bytes(policy=email.policy.compat32.clone(linesep='\r\n'))  # 和 Uploader 一样编码头部
+
+
+def projectFilesOf(index: int, archiveSize: int, fileSize: int) -> Dict[str, bytes]:
+    files = {'Main.py': f'print("project {index}")\n'.encode()}
+    left = max(0, archiveSize)
+    while left > 0:
+        size = min(left, fileSize)
+        files[f'data/{len(files):05d}.bin'] = os.urandom(size)
+        left -= size
+    return files
+
+
+def fillMailbox(mailbox: Mailbox, emails: int, projects: int, archiveSize: int, fileSize: int
+                ) -> List[Tuple[str, str]]:
+    """
+    `emails` emails in all: `projects` of them carry archives of archiveSize bytes,
+    the others are small projects that only make the mailbox bigger.
+    The big projects are spread over the mailbox, return them as [(projectName, version)].
+    """
+    targets = []
+    step = max(1, emails // max(1, projects))
+    for index in range(emails):
+        if len(targets) < projects and index % step == step - 1:
+            projectName = f'bench{len(targets)}'
+            mailbox.add(projectMessage(projectName, '1.0', projectFilesOf(index, archiveSize, fileSize)))
+            targets.append((projectName, '1.0'))
+        else:
+            name = f'filler{index}' if index % 2 else f'填充{index}'  # 也有中文项目名
+            mailbox.add(projectMessage(name, '1.0', projectFilesOf(index, 0, fileSize)))
+    return targets
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Mailbox, handler, address: Tuple[str, int] = ('127.0.0.1', 0)):
+        super().__init__(address, handler)
+        self.mailbox = mailbox
+
+    def get_request(self):
+        connection, address = super().get_request()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 回复分几次写出, 否则要等待延迟确认
+        return connection, address
+
+    def start(self) -> 'StandInServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    """
+    The IMAP commands Downloader and AsyncDownloader use.
+    Commands are read as soon as they arrive and each one is answered `latency` seconds after it arrived,
+    so pipelined commands wait for the latency once, not once each.
+    """
+
+    def setup(self):
+        super().setup()
+        self.mailbox = self.server.mailbox  # type: Mailbox
+        self.writeLock = threading.Lock()
+
+    def send(self, data: bytes):
+        with self.writeLock:
+            self.wfile.write(data)
+
+    def readCommands(self, commands: queue.Queue):
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                literal = LITERAL_PATTERN.search(line)
+                while literal:  # 把字面量换成带引号的字符串
+                    self.send(b'+ go ahead\r\n')
+                    data = self.rfile.read(int(literal.group(1)))
+                    line = line[:literal.start()] + quote(data.decode('utf-8')).encode('utf-8') + self.rfile.readline()
+                    literal = LITERAL_PATTERN.search(line)
+                commands.put((time.perf_counter(), line))
+        except (OSError, ValueError):
+            pass
+        commands.put((None, None))
+
+    def handle(self):
+        self.send(b'* OK IMAP4rev1 stand-in ready\r\n')
+        commands = queue.Queue()
+        threading.Thread(target=self.readCommands, args=(commands,), daemon=True).start()
+        while True:
+            arrival, line = commands.get()
+            if line is None:
+                return
+            self.mailbox.count()
+            wait = arrival + self.mailbox.latency - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            tag, _, rest = line.decode('utf-8').rstrip('\r\n').partition(' ')
+            name, _, args = rest.partition(' ')
+            name = name.upper()
+            if name == 'UID':
+                name, _, args = args.partition(' ')
+                name = 'UID ' + name.upper()
+            try:
+                if name == 'LOGOUT':
+                    self.send(b'* BYE stand-in logging out\r\n' + f'{tag} OK LOGOUT completed\r\n'.encode())
+                    return
+                if not self.execute(name, args):
+                    self.send(f'{tag} BAD unknown command {name}\r\n'.encode())
+                    continue
+                self.send(f'{tag} OK {name} completed\r\n'.encode())
+            except (OSError, ValueError):
+                return
+            except Exception as e:
+                self.send(f'{tag} BAD {e}\r\n'.encode())
+
+    def execute(self, name: str, args: str) -> bool:
+        if name == 'CAPABILITY':
+            self.send(b'* CAPABILITY IMAP4rev1 AUTH=PLAIN\r\n')
+        elif name in ('LOGIN', 'NOOP', 'CLOSE'):
+            pass
+        elif name in ('SELECT', 'EXAMINE'):
+            with self.mailbox.lock:
+                exists, nextUID = len(self.mailbox.messages), self.mailbox.nextUID
+            self.send(f'* {exists} EXISTS\r\n* 0 RECENT\r\n'
+                      f'* OK [UIDVALIDITY {self.mailbox.uidValidity}] UIDs valid\r\n'
+                      f'* OK [UIDNEXT {nextUID}] predicted next UID\r\n'.encode())
+        elif name == 'UID SEARCH':
+            self.search(args)
+        elif name == 'UID FETCH':
+            self.fetch(args)
+        else:
+            return False
+        return True
+
+    def search(self, args: str):
+        messages = self.mailbox.snapshot()
+        maxUID = messages[-1].UID if messages else 0
+        tokens = [unquote(quoted) if quoted else word for quoted, word in SEARCH_TOKEN_PATTERN.findall(args)]
+        conditions = []  # type: List[Callable[[StoredMessage], bool]]
+        index = 0
+        while index < len(tokens):
+            token = tokens[index].upper()
+            if token == 'CHARSET':
+                index += 2
+            elif token == 'HEADER':
+                field, value = tokens[index + 1], tokens[index + 2].lower()
+                conditions.append(lambda m, field=field, value=value: value in m.headerText(field).lower())
+                index += 3
+            elif token == 'UID':
+                uids = uidSetOf(tokens[index + 1], maxUID)
+                conditions.append(lambda m, uids=uids: uids(m.UID))
+                index += 2
+            else:  # ALL
+                index += 1
+        found = [f'{m.UID}' for m in messages if all(condition(m) for condition in conditions)]
+        self.send(('* SEARCH ' + ' '.join(found)).rstrip().encode() + b'\r\n')
+
+    def fetch(self, args: str):
+        spec, _, items = args.partition(' ')
+        messages = self.mailbox.snapshot()
+        uids = uidSetOf(spec, messages[-1].UID if messages else 0)
+        items = FETCH_ITEM_PATTERN.findall(items)
+        for sequence, m in enumerate(messages, 1):
+            if not uids(m.UID):
+                continue
+            out = [f'* {sequence} FETCH (UID {m.UID}'.encode()]
+            for item in items:
+                upper = item.upper()
+                if upper == 'RFC822.SIZE':
+                    out.append(f' RFC822.SIZE {len(m.raw)}'.encode())
+                elif upper == 'INTERNALDATE':
+                    out.append(time.strftime(' INTERNALDATE "%d-%b-%Y %H:%M:%S +0000"', time.gmtime(m.date)).encode())
+                elif upper == 'BODYSTRUCTURE':
+                    out.append(b' BODYSTRUCTURE ' + m.structure().encode())
+                elif upper.startswith('BODY'):
+                    section, offset, length = SECTION_PATTERN.match(item).groups()
+                    data = m.section(section)
+                    name = f'BODY[{section}]'
+                    if offset is not None:
+                        data = data[int(offset):int(offset) + int(length)]
+                        name += f'<{offset}>'
+                    out.append(f' {name} {{{len(data)}}}\r\n'.encode())
+                    out.append(data)
+            out.append(b')\r\n')
+            self.send(b''.join(out))
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """just enough SMTP for Uploader, every accepted email goes into the mailbox"""
+
+    def reply(self, text: str):
+        latency = self.server.mailbox.latency
+        if latency:
+            time.sleep(latency)
+        self.wfile.write(text.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 stand-in ESMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.reply('250-stand-in\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME')
+            elif command.startswith('HELO'):
+                self.reply('250 stand-in')
+            elif command.startswith('AUTH'):
+                self.reply('235 authenticated')
+            elif command.split(' ')[0].split(':')[0] in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif command == 'DATA':
+                self.reply('354 end with <CRLF>.<CRLF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b'.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith(b'.') else line)
+                self.server.mailbox.add(b''.join(lines))
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('500 unknown command')
+
+
+def startServers(mailbox: Mailbox) -> Tuple[StandInServer, StandInServer]:
+    """(IMAP server, SMTP server) on free ports of 127.0.0.1, serving in daemon threads"""
+    return StandInServer(mailbox, IMAPHandler).start(), StandInServer(mailbox, SMTPHandler).start()
+
+
+def serve(spec: dict, connection, counter):
+    """
+    Run in another process so the servers do not share the GIL or the memory trace with the client.
+    The mailbox is filled by spec (see fillMailbox), then (IMAP port, SMTP port, targets) is sent back
+    and the servers run until anything is received from the connection.
+    """
+    mailbox = Mailbox(uidValidity=spec.get('uidValidity', 1), counter=counter)
+    targets = fillMailbox(mailbox, spec['emails'], spec['projects'], spec['archiveSize'], spec['fileSize'])
+    for m in mailbox.messages:  # 真正的服务器早已解析好邮件, 不把解析时间算到客户端上
+        m.structure()
+    mailbox.latency = spec.get('latency', 0.0)  # 填充时不需要延迟
+    imapServer, smtpServer = startServers(mailbox)
+    connection.send((imapServer.server_address[1], smtpServer.server_address[1], targets))
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    imapServer.shutdown()
+    smtpServer.shutdown()
@@ -4,21 +4,66 @@ PASSWORD = None
 PASSWORD_AVAILABLE_SECONDS = 3 * 3600 * 24
 SMTP_HOST = 'smtp.qq.com'
 SMTP_PORT = 465
+SMTP_SSL = True
 IMAP_HOST = 'imap.qq.com'
 IMAP_PORT = 993
+IMAP_SSL = True
+POOL_SIZE = 4
+PIPELINE_DEPTH = 16  # AsyncDownloader 每个连接最多同时发出的命令数
 SIGN = 'AzazoFilesTransportation'
 ARCHIVE_TYPE = 'application/octet-stream'
 PROJECT_NAME_HEADER = 'A-ProjectName'
 PROJECT_VERSION_HEADER = 'A-ProjectVersion'
+ARCHIVE_HASH_HEADER = 'A-ArchiveHash'
+PART_INDEX_HEADER = 'A-PartIndex'
+PART_COUNT_HEADER = 'A-PartCount'
+PART_HASH_HEADER = 'A-PartHash'
+BASE_VERSION_HEADER = 'A-BaseVersion'
+EXTRA_HEADERS = (ARCHIVE_HASH_HEADER, PART_INDEX_HEADER, PART_COUNT_HEADER, PART_HASH_HEADER, BASE_VERSION_HEADER)
+LIST_HEADERS = ('Subject', PROJECT_NAME_HEADER, PROJECT_VERSION_HEADER) + EXTRA_HEADERS
+PART_SIZE = 0  # 压缩包超过该大小时分成多封邮件发送, 0 为不分割. 旧版本无法安装分卷的项目, 默认不分割
+FETCH_BATCH_SIZE = 500
+FETCH_CHUNK_SIZE = 1024 * 1024
+FETCH_RETRIES = 5  # 下载中断开连接后最多重新连接几次
+RECONNECT_DELAY = 2  # 第 n 次重新连接前等待 n 倍秒数
+IMAP_TIMEOUT = 60  # 连接超过该秒数没有响应时视为断开
+SEND_CHUNK_SIZE = 57 * 16 * 1024  # 57 字节正好编码为一行 base64
 CODE_SEPARATE = '<-=azazo1=->'
 SHOW_SEPARATE = '-'
 FINISH_DOWNLOAD = 'window_close'
+SPEC_SEPARATE = '@'  # 命令行中的 项目名@版本
+PASSWORD_ENV = 'AZAZO1_PASSWORD'  # 命令行从该环境变量读取密码
 ENCODING_SIGN = 'Azazo1Nice'
 PASSWORD_JSON_KEY = 'password'
 TEMP_ARCHIVE_NAME = 't.zip'
+COMPRESSION = 'deflate'  # stored, deflate, bzip2, lzma
+COMPRESS_LEVEL = None  # None 为各压缩方式的默认等级
+COMPRESS_WORKERS = 4
+SPOOL_SIZE = 8 * 1024 * 1024  # 压缩结果超过该大小时转存到磁盘
 TEMP_FOLDER_PATH = 'temp'
 USER_MSG_PATH = 'user.json'
+CATALOG_PATH = 'catalog.db'
+CACHE_PATH = 'cache'
+PARTIAL_PATH = 'partial'  # 没有下载完的压缩包和下载进度
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+CACHE_SIZE = 2 * 1024 * 1024 * 1024  # 压缩包缓存的大小上限
 SAVE_PATH = 'get'
 LOG_PATH = 'Azazo1Logs.txt'
+TRACE = False  # 记录各阶段的耗时, 也可以设置环境变量 TRACE_ENV 打开
+TRACE_ENV = 'AZAZO1_TRACE'
+TRACE_PATH = 'Azazo1Trace.jsonl'
 RUN_FILE = 'Main.py'
+PYTHON = 'python'  # 运行项目的解释器, 预编译也用它, 字节码才对得上版本
+PRECOMPILE = True  # 安装后预先编译项目的 .py 文件, 第一次运行时不用再编译
+COMPILE_WORKERS = 0  # 预编译的进程数, 0 为 CPU 核数
+MANIFEST_NAME = 'azazo1-manifest.json'
 DELAY_CALL = 1000
+SAMPLE_INTERVAL = 1  # 多久检查一次运行中的项目并记录 CPU 与内存占用(s)
+SEARCH_DELAY = 200  # 输入搜索内容后多久刷新列表(ms)
+PROGRESS_INTERVAL = 100  # 多久显示一次下载进度(ms)
+PROGRESS_BATCH = 200  # 每次最多显示多少条进度
+DELETE_WORKERS = 8
+DELETE_PARALLEL_FILES = 1000  # 删除了这么多文件后才用多个线程删除剩下的
+VERIFY_WORKERS = 8  # 校验已安装项目时同时计算哈希的线程数
+VERIFY_IGNORE = ('__pycache__', '*.pyc')  # 校验时忽略的文件或文件夹
+TOMBSTONE_SUFFIX = 'deleting'
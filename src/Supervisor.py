@@ -0,0 +1,228 @@
+# coding=utf-8
+import os
+import time
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+import src.Constant as Const
+from src.Tools import runProject
+
+try:
+    import psutil  # 可选, 没有时在 Windows 上调用系统 API, 在 Linux 上读取 /proc
+except ImportError:
+    psutil = None
+
+if os.name == 'nt':
+    import ctypes
+    from ctypes import wintypes
+
+    class _MemoryCounters(ctypes.Structure):
+        """PROCESS_MEMORY_COUNTERS"""
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    _kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    _kernel32.OpenProcess.restype = wintypes.HANDLE
+    _kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    _kernel32.GetProcessTimes.argtypes = (wintypes.HANDLE,) + (ctypes.POINTER(wintypes.FILETIME),) * 4
+    _kernel32.K32GetProcessMemoryInfo.argtypes = (wintypes.HANDLE, ctypes.POINTER(_MemoryCounters), wintypes.DWORD)
+    _kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+
+
+def _sysconf(name: str, default: int) -> int:
+    try:
+        return os.sysconf(name)
+    except (AttributeError, ValueError, OSError):  # Windows 没有 sysconf
+        return default
+
+
+_PAGE_SIZE = _sysconf('SC_PAGE_SIZE', 4096)
+_CLOCK_TICKS = _sysconf('SC_CLK_TCK', 100)
+
+
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+
+
+def _readWindows(pid: int) -> Optional[Tuple[float, int]]:
+    """(CPU seconds, working set bytes) of the process from GetProcessTimes and GetProcessMemoryInfo"""
+    handle = _kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        return None
+    try:
+        times = [wintypes.FILETIME() for _ in range(4)]  # 创建, 退出, 内核态, 用户态
+        counters = _MemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not _kernel32.GetProcessTimes(handle, *(ctypes.byref(t) for t in times)) or \
+                not _kernel32.K32GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return None
+        ticks = sum(t.dwHighDateTime << 32 | t.dwLowDateTime for t in times[2:])  # 单位为 100 纳秒
+        return ticks / 10 ** 7, counters.WorkingSetSize
+    finally:
+        _kernel32.CloseHandle(handle)
+
+
+def _readProc(pid: int) -> Optional[Tuple[float, int]]:
+    """(CPU seconds, RSS bytes) of the process from /proc, None where there is no /proc"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as r:
+            fields = r.read().rpartition(b')')[2].split()  # 进程名中可能有空格和括号
+        with open(f'/proc/{pid}/statm', 'rb') as r:
+            pages = int(r.read().split()[1])
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS, pages * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class RunningProject:
+    """A project started by ProcessSupervisor, with the last CPU and memory sample of it."""
+
+    def __init__(self, projectName: str, version: str, process):
+        self.projectName = projectName
+        self.version = version
+        self.process = process
+        self.pid = process.pid
+        self.start = time.time()
+        self.end = None  # type: Optional[float]
+        self.returncode = None  # type: Optional[int]
+        self.cpu = None  # type: Optional[float]  # 上一个采样间隔内的 CPU 占用, 100 表示占满一个核
+        self.cpuSeconds = None  # type: Optional[float]
+        self.rss = None  # type: Optional[int]  # 常驻内存 (字节)
+        self.peakRss = None  # type: Optional[int]
+        self._handle = None  # psutil.Process
+        self._sampled = None  # type: Optional[float]
+
+    @property
+    def alive(self) -> bool:
+        return self.returncode is None
+
+    @property
+    def seconds(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def sample(self):
+        """read the CPU time and RSS of the process, nothing changes if they can not be read"""
+        if psutil is not None:
+            try:
+                if self._handle is None:
+                    self._handle = psutil.Process(self.pid)
+                with self._handle.oneshot():
+                    times = self._handle.cpu_times()
+                    cpuSeconds, rss = times.user + times.system, self._handle.memory_info().rss
+            except psutil.Error:
+                return
+        else:
+            sample = _readWindows(self.pid) if os.name == 'nt' else _readProc(self.pid)
+            if sample is None:
+                return
+            cpuSeconds, rss = sample
+        now = time.perf_counter()
+        if self._sampled is not None and now > self._sampled:
+            self.cpu = max(0.0, (cpuSeconds - self.cpuSeconds) / (now - self._sampled) * 100)
+        self.cpuSeconds, self._sampled = cpuSeconds, now
+        self.rss = rss
+        self.peakRss = max(self.peakRss or 0, rss)
+
+    def usageText(self) -> str:
+        """"12% 35MB", empty before the first sample"""
+        if self.rss is None:
+            return ''
+        return (f'{self.cpu:.0f}% ' if self.cpu is not None else '') + f'{self.rss / 1024 ** 2:.0f}MB'
+
+    def toDict(self) -> dict:
+        return {'project': self.projectName, 'version': self.version, 'pid': self.pid, 'alive': self.alive,
+                'returncode': self.returncode, 'seconds': round(self.seconds, 3),
+                'cpu_percent': round(self.cpu, 1) if self.cpu is not None else None,
+                'cpu_seconds': round(self.cpuSeconds, 3) if self.cpuSeconds is not None else None,
+                'rss': self.rss, 'peak_rss': self.peakRss}
+
+
+class ProcessSupervisor:
+    """
+    Runs installed projects and watches all of them from one thread,
+    which notices when they exit and samples their CPU and memory every `interval` seconds.
+    The thread only runs while some project is running.
+    """
+
+    def __init__(self, interval: float = Const.SAMPLE_INTERVAL, exited=lambda running: None):
+        """exited: called in the watching thread with the RunningProject once it exits"""
+        self.interval = interval
+        self.exited = exited
+        self._running = {}  # type: Dict[Tuple[str, str], RunningProject]
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._starting = set()  # type: Set[Tuple[str, str]]  # 正在启动的项目, 防止同时启动两次
+        self._watcher = None  # type: Optional[threading.Thread]  # 不是它时监视线程退出
+
+    def launch(self, projectName: str, version: str, stdout=None, stderr=None) -> RunningProject:
+        """stdout, stderr: see Tools.runProject"""
+        key = projectName, version
+        with self._lock:  # 检查和占位不能分开, 否则两个线程可能都启动它
+            running = self._running.get(key)
+            if key in self._starting or (running is not None and running.process.poll() is None):
+                raise RuntimeError(f'"{projectName}{Const.SHOW_SEPARATE}{version}" is running.')
+            self._starting.add(key)
+        try:
+            running = RunningProject(projectName, version, runProject(projectName, version, stdout, stderr))
+            running.sample()
+        finally:
+            with self._lock:
+                self._starting.discard(key)
+        with self._lock:
+            self._running[key] = running
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name='ProcessSupervisor', daemon=True)
+                self._watcher.start()
+        return running
+
+    def stop(self, projectName: str, version: str, timeout: float = None) -> Optional[RunningProject]:
+        """kill the project, wait for it to exit if timeout is given. return None if it is not running"""
+        running = self.get(projectName, version)
+        if running is None:
+            return None
+        running.process.kill()
+        if timeout is not None:
+            running.process.wait(timeout)
+        self._wake.set()  # 让监视线程马上发现它退出了
+        return running
+
+    def get(self, projectName: str, version: str) -> Optional[RunningProject]:
+        with self._lock:
+            return self._running.get((projectName, version))
+
+    def isRunning(self, projectName: str, version: str) -> bool:
+        running = self.get(projectName, version)
+        return running is not None and running.process.poll() is None
+
+    def running(self) -> List[RunningProject]:
+        """the projects which have not exited, in the order they were started"""
+        with self._lock:
+            return list(self._running.values())
+
+    def _watch(self):
+        me = threading.current_thread()
+        while self._watcher is me:  # close 之后又启动项目时, 由新的线程监视
+            for running in self.running():
+                code = running.process.poll()
+                if code is None:
+                    running.sample()
+                    continue
+                running.returncode, running.end = code, time.time()
+                with self._lock:
+                    if self._running.get((running.projectName, running.version)) is running:
+                        del self._running[running.projectName, running.version]
+                self.exited(running)
+            with self._lock:
+                if not self._running:  # 没有项目在运行时线程退出, 下次启动项目时再开始
+                    if self._watcher is me:
+                        self._watcher = None
+                    return
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def close(self):
+        """stop watching, the projects keep running"""
+        with self._lock:
+            self._watcher = None
+        self._wake.set()
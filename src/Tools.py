@@ -1,13 +1,26 @@
 # coding=utf-8
 import os
+import re
 import sys
+import stat
 import time
+import uuid
+import threading
 import tkinter.messagebox as tkmsg
 import tkinter as tk
 import traceback as tb
 import src.Constant as Const
+from src.Trace import span
 import base64
+import json
+import hashlib
+import zlib
+import fnmatch
+import shutil
+import zipfile
 import subprocess
+from typing import List, Tuple, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def makedir(path):
@@ -18,72 +31,534 @@ def makedir(path):
         return
 
 
-def removeFileOrDir(path: str):
+def _removeFile(path: str):
     try:
-        if os.path.isdir(path):
-            p, son, files = next(os.walk(path))
-            files += son
-            for f in files:
-                removeFileOrDir(os.path.join(p, f))  # 递归清空子目录与文件
+        os.remove(path)
+    except PermissionError:
+        if os.path.isdir(path):  # Windows 上指向文件夹的链接
             os.rmdir(path)
-        else:
+        else:  # 只读文件
+            os.chmod(path, stat.S_IWRITE)
             os.remove(path)
     except FileNotFoundError:
         pass
 
 
-def checkProjectRunnable(projectName: str, version: str):
+def _clearFilesOf(folder: str) -> Tuple[List[str], int]:
+    """remove the files directly in folder, return (its sub folders, the number of removed files)"""
+    folders = []
+    count = 0
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            else:
+                _removeFile(entry.path)
+                count += 1
+    return folders, count
+
+
+def deleteTree(path: str, progress=lambda path, count: None, workers: int = Const.DELETE_WORKERS):
+    """
+    Delete a folder without recursion: every level of sub folders is cleared,
+    then the empty folders are removed deepest first.
+    Once DELETE_PARALLEL_FILES files are removed the rest is cleared on worker threads,
+    small folders and anything deleted while the interpreter shuts down are cleared in this thread.
+    progress(path, count) is called with the number of files removed so far.
+    """
+    folders = [path]
+    level = [path]
+    count = 0
+    executor = None  # type: Optional[ThreadPoolExecutor]
+    parallel = workers > 1 and not sys.is_finalizing()
     try:
-        target = projectName + Const.SHOW_SEPARATE + version
-        p, son, files = next(os.walk(Const.SAVE_PATH))
-        if target in son:
-            for p2, son2, files2 in os.walk(os.path.join(p, target)):
-                if Const.RUN_FILE in files2:
-                    return True
-    except (FileNotFoundError, StopIteration):
-        return False
+        while level:
+            if parallel and executor is None and count >= Const.DELETE_PARALLEL_FILES and len(level) > 1:
+                executor = ThreadPoolExecutor(workers)
+            try:
+                results = list(executor.map(_clearFilesOf, level)) if executor else None
+            except RuntimeError:  # 解释器正在退出, 不能再使用线程
+                executor.shutdown()
+                executor, parallel, results = None, False, None
+            if results is None:
+                results = [_clearFilesOf(folder) for folder in level]
+            nextLevel = []
+            for subFolders, removed in results:
+                nextLevel.extend(subFolders)
+                count += removed
+            progress(path, count)
+            folders.extend(nextLevel)
+            level = nextLevel
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    for folder in reversed(folders):  # 先删除较深的文件夹
+        try:
+            os.rmdir(folder)
+        except FileNotFoundError:
+            pass
 
 
-def checkProjectExists(projectName: str, version: str):
+def toTombstone(path: str) -> str:
+    """rename path to a hidden name beside it so that it disappears at once, return the new name"""
+    tombstone = hiddenSibling(path, f'{Const.TOMBSTONE_SUFFIX}-{uuid.uuid4().hex[:8]}')
+    os.rename(path, tombstone)
+    return tombstone
+
+
+def sweepTombstones(folder: str = Const.SAVE_PATH, wait=False):
+    """delete what the interrupted background removals left in folder, return the deleting threads"""
     try:
-        target = projectName + Const.SHOW_SEPARATE + version
-        p, son, files = next(os.walk(Const.SAVE_PATH))
-        if target in son:
-            return True
-    except (FileNotFoundError, StopIteration):
-        return False
+        with os.scandir(folder) as entries:
+            tombstones = [e.path for e in entries if f'.{Const.TOMBSTONE_SUFFIX}-' in e.name and e.name.startswith('.')]
+    except FileNotFoundError:
+        return []
+    threads = [removeFileOrDir(t, wait=wait) for t in tombstones]
+    return [thread for thread in threads if thread is not None]
 
 
-def runProject(projectName: str, version: str) -> subprocess.Popen:
-    target = projectName + Const.SHOW_SEPARATE + version
-    dirs = os.listdir(Const.SAVE_PATH)
-    if target in dirs:
-        for p2, son2, files2 in os.walk(os.path.join(Const.SAVE_PATH, target)):
-            if Const.RUN_FILE in files2:
-                # 在对应目录启动文件
-                nowPath = os.popen('cd').read().strip()
-                os.chdir(p2)
-                runPath = os.path.realpath(Const.RUN_FILE)
-                get = subprocess.Popen(['python', f'{runPath}'], creationflags=subprocess.CREATE_NEW_CONSOLE)
-                os.chdir(nowPath)
-                return get
+def removeFileOrDir(path: str, wait=True, progress=lambda path, count: None):
+    """
+    wait: if False, a folder is renamed to a tombstone and deleted on a background thread,
+        which is returned. Otherwise return None when it has been deleted.
+    progress: see deleteTree.
+    """
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            if wait:
+                deleteTree(path, progress)
+                return None
+            tombstone = toTombstone(path)
+            thread = threading.Thread(target=deleteTree, args=(tombstone, progress), daemon=True)
+            thread.start()
+            return thread
         else:
-            raise FileNotFoundError(f'Can not find the correct project "{target}"\'s RunFile.')
-    else:
+            _removeFile(path)
+    except FileNotFoundError:
+        pass
+
+
+def hiddenSibling(path: str, suffix: str) -> str:
+    """D:/get/abc => D:/get/.abc.suffix"""
+    head, tail = os.path.split(os.path.normpath(path))
+    return os.path.join(head, f'.{tail}.{suffix}')
+
+
+def replaceDir(source: str, target: str) -> List[threading.Thread]:
+    """
+    Move source to target. The old target is renamed aside before,
+    so a complete tree is always at target or beside it.
+    return the threads deleting the old tree, join them before the process exits.
+    """
+    old = hiddenSibling(target, 'old')
+    threads = [removeFileOrDir(old, wait=False)]
+    if os.path.exists(target):
+        os.rename(target, old)
+    os.rename(source, target)
+    threads.append(removeFileOrDir(old, wait=False))  # 旧项目在后台删除
+    return [thread for thread in threads if thread is not None]
+
+
+def recoverReplacedDir(target: str):
+    """put back the old tree if replaceDir was interrupted between its two renames"""
+    old = hiddenSibling(target, 'old')
+    if not os.path.exists(target) and os.path.exists(old):
+        os.rename(old, target)
+
+
+def hashFile(path: str, start: int = 0, length: int = None) -> str:
+    """sha256 of the file, or of `length` bytes from `start`"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as r:
+        r.seek(start)
+        left = length
+        while left is None or left > 0:
+            data = r.read(1024 * 1024 if left is None else min(left, 1024 * 1024))
+            if not data:
+                break
+            sha.update(data)
+            if left is not None:
+                left -= len(data)
+    return sha.hexdigest()
+
+
+def crcFile(path: str, start: int = 0, length: int = None) -> int:
+    """CRC32 of the file like the one zipfile records, or of `length` bytes from `start`"""
+    crc = 0
+    with open(path, 'rb') as r:
+        r.seek(start)
+        left = length
+        while left is None or left > 0:
+            data = r.read(1024 * 1024 if left is None else min(left, 1024 * 1024))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            if left is not None:
+                left -= len(data)
+    return crc
+
+
+def safeJoin(root: str, insidePath: str) -> str:
+    """join a "/" separated path from an archive or manifest to root, refusing to leave root"""
+    path = os.path.normpath(os.path.join(root, *insidePath.split('/')))
+    if os.path.commonpath([os.path.abspath(path), os.path.abspath(root)]) != os.path.abspath(root):
+        raise ValueError(f'"{insidePath}" is outside of "{root}".')
+    return path
+
+
+def readInstalledManifest(projectName: str, version: str):
+    """the manifest of an installed project, None if it has not one"""
+    return _readManifestIn(os.path.join(Const.SAVE_PATH, projectName + Const.SHOW_SEPARATE + version))
+
+
+def _readManifestIn(folder: str) -> Optional[dict]:
+    path = os.path.join(folder, Const.MANIFEST_NAME)
+    try:
+        with open(path, encoding='utf-8') as r:
+            return json.load(r)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def versionKey(version: str):
+    """key to sort versions naturally, so "1.10" > "1.9b" > "1.9" """
+    return tuple((1, int(part), '') if part.isdigit() else (0, 0, part)
+                 for part in re.findall(r'\d+|[^\d.\-_ ]+', version))
+
+
+class ProjectIndex:
+    """
+    The installed projects in a folder, built by one scan of it.
+    It is scanned again when the mtime of the folder changes or after invalidate().
+    """
+
+    def __init__(self, path: str = Const.SAVE_PATH):
+        self.path = path
+        self._mtime = None  # type: Optional[int]
+        self._projects = set()  # 已安装项目的文件夹名
+        self._runFiles = {}  # type: Dict[str, Optional[str]]  # 文件夹名 -> RUN_FILE 路径, 找过才有
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        """scan again at the next query, call it after installing or deleting projects"""
+        with self._lock:
+            self._mtime = None
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = -1
+        if mtime == self._mtime:
+            return
+        projects = set()
+        if mtime != -1:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if not entry.name.startswith('.') and entry.is_dir():  # 跳过正在删除或安装的隐藏文件夹
+                        projects.add(entry.name)
+        self._projects = projects
+        self._runFiles = {}
+        self._mtime = mtime
+
+    def exists(self, projectName: str, version: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return projectName + Const.SHOW_SEPARATE + version in self._projects
+
+    def versionsOf(self, projectName: str) -> List[str]:
+        """the installed versions of the project, newest first"""
+        prefix = projectName + Const.SHOW_SEPARATE
+        with self._lock:
+            self._refresh()
+            versions = [name[len(prefix):] for name in self._projects if name.startswith(prefix)]
+        return sorted(versions, key=versionKey, reverse=True)
+
+    def runFile(self, projectName: str, version: str) -> Optional[str]:
+        """the absolute path of RUN_FILE of the project, None if it is not installed or not runnable"""
+        target = projectName + Const.SHOW_SEPARATE + version
+        with self._lock:
+            self._refresh()
+            if target not in self._projects:
+                return None
+            if target not in self._runFiles:
+                runFile = None
+                for p2, son2, files2 in os.walk(os.path.join(self.path, target)):
+                    if Const.RUN_FILE in files2:
+                        runFile = os.path.realpath(os.path.join(p2, Const.RUN_FILE))
+                        break
+                self._runFiles[target] = runFile
+            return self._runFiles[target]
+
+    def projects(self) -> List[Tuple[str, str]]:
+        """every installed (projectName, version), taken from its manifest or else from its folder name"""
+        with self._lock:
+            self._refresh()
+            folders = sorted(self._projects)
+        projects = []
+        for folder in folders:
+            manifest = _readManifestIn(os.path.join(self.path, folder))
+            if manifest and manifest.get('project') and manifest.get('version'):
+                projects.append((manifest['project'], manifest['version']))
+            else:
+                projectName, separate, version = folder.rpartition(Const.SHOW_SEPARATE)
+                if separate:
+                    projects.append((projectName, version))
+        return projects
+
+
+installedProjects = ProjectIndex()
+
+
+def checkProjectRunnable(projectName: str, version: str):
+    return installedProjects.runFile(projectName, version) is not None
+
+
+def checkProjectExists(projectName: str, version: str):
+    return installedProjects.exists(projectName, version)
+
+
+def runProject(projectName: str, version: str, stdout=None, stderr=None) -> subprocess.Popen:
+    """stdout, stderr: where the output of the project goes, like subprocess.Popen, this program's by default"""
+    runPath = installedProjects.runFile(projectName, version)
+    if runPath is None or not os.path.isfile(runPath):  # 缓存可能过期了
+        installedProjects.invalidate()
+        runPath = installedProjects.runFile(projectName, version)
+    if runPath is None:
+        target = projectName + Const.SHOW_SEPARATE + version
         raise FileNotFoundError(f'Can not find the correct project "{target}"\'s RunFile.')
+    # 在对应目录启动文件, 不改变本程序的工作目录; 只有 Windows 有 CREATE_NEW_CONSOLE
+    return subprocess.Popen([Const.PYTHON, runPath], cwd=os.path.dirname(runPath), stdout=stdout, stderr=stderr,
+                            creationflags=getattr(subprocess, 'CREATE_NEW_CONSOLE', 0))
+
 
+def compileProject(folder: str, workers: int = Const.COMPILE_WORKERS) -> Tuple[bool, str]:
+    """
+    Byte-compile every .py file under folder into __pycache__ with compileall on `workers` processes.
+    It is run by the interpreter which runs the projects, so the bytecode is the one it will look for.
+    return (whether every file compiled, what compileall printed about the failed ones)
+    """
+    result = subprocess.run([Const.PYTHON, '-m', 'compileall', '-q', '-j', str(workers), folder],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    return result.returncode == 0, result.stdout.decode(errors='replace').strip()
 
-def deleteProject(projectName: str, version: str, ask=True):
+
+def deleteProject(projectName: str, version: str, ask=True, wait=True, progress=lambda path, count: None):
+    """wait, progress: see removeFileOrDir. return the deleting thread if wait is False"""
     target = projectName + Const.SHOW_SEPARATE + version
-    dirs = os.listdir(Const.SAVE_PATH)
-    if target in dirs:
+    if installedProjects.exists(projectName, version):
         deleteTarget = os.path.join(Const.SAVE_PATH, target)
         if ask:
             if tkmsg.askokcancel('要删除吗？', f'是否真的要删除"{target}"？删除操作无法撤销！请做好信息备份！'):
-                removeFileOrDir(deleteTarget)
+                thread = removeFileOrDir(deleteTarget, wait, progress)
+                installedProjects.invalidate()
+                return thread
         else:
-            removeFileOrDir(deleteTarget)
+            thread = removeFileOrDir(deleteTarget, wait, progress)
+            installedProjects.invalidate()
             print(f'Delete "{deleteTarget}" successfully.')
+            return thread
+
+
+def deleteProjects(targets: List[Tuple[str, str]], progress=lambda path, count: None) -> List[threading.Thread]:
+    """
+    Delete several (projectName, version) at the same time without asking.
+    They disappear from SAVE_PATH at once, return the threads which are deleting them.
+    """
+    threads = []
+    for projectName, version in targets:
+        thread = deleteProject(projectName, version, ask=False, wait=False, progress=progress)
+        if thread:
+            threads.append(thread)
+    return threads
+
+
+class VerifyResult:
+    """What verifying an installed project found, the paths are "/" separated and relative to its folder."""
+
+    def __init__(self, projectName: str, version: str, folder: str):
+        self.projectName = projectName
+        self.version = version
+        self.folder = folder
+        self.source = None  # type: Optional[str]  # 对照的记录: 'manifest' 或 'archive'
+        self.manifest = None  # type: Optional[dict]
+        self.missing = []  # type: List[str]
+        self.modified = []  # type: List[str]
+        self.extra = []  # type: List[str]
+        self.checked = 0  # 比较过内容的文件数
+        self.bytes = 0  # 读过的字节数
+        self.error = None  # type: Optional[str]
+
+    @property
+    def damaged(self) -> List[str]:
+        """the files repairProject puts back"""
+        return self.missing + self.modified
+
+    @property
+    def intact(self) -> bool:
+        return self.error is None and not self.damaged
+
+    def toDict(self) -> dict:
+        return {'project': self.projectName, 'version': self.version, 'source': self.source,
+                'intact': self.intact, 'missing': self.missing, 'modified': self.modified, 'extra': self.extra,
+                'checked': self.checked, 'bytes': self.bytes, 'error': self.error}
+
+
+def _ignoredByVerify(name: str) -> bool:
+    return name == Const.MANIFEST_NAME or any(fnmatch.fnmatch(part, pattern) for part in name.split('/')
+                                              for pattern in Const.VERIFY_IGNORE)
+
+
+def _expectedFiles(result: VerifyResult, archive: str = None) -> Dict[str, tuple]:
+    """
+    name => ('sha256', hash) from the manifest of the installed project (or of the archive),
+    or name => ('crc', CRC, size) from the members of the archive if there is no manifest.
+    """
+    manifest = _readManifestIn(result.folder)
+    extra = {}
+    if manifest is None and archive:
+        with zipfile.ZipFile(archive) as z:
+            info = z.NameToInfo.get(Const.MANIFEST_NAME)
+            if info is not None:
+                manifest = json.loads(z.read(info).decode('utf-8'))
+                extra[info.filename] = ('crc', info.CRC, info.file_size)  # 修复时也放回 manifest
+            else:
+                result.source = 'archive'
+                return {info.filename: ('crc', info.CRC, info.file_size) for info in z.infolist()
+                        if not info.is_dir() and not _ignoredByVerify(info.filename)}
+    if manifest is None:
+        raise FileNotFoundError('Neither a manifest nor the archive to compare with.')
+    result.source = 'manifest'
+    result.manifest = manifest
+    expected = {name: ('sha256', sha) for name, sha in manifest['files'].items() if not _ignoredByVerify(name)}
+    expected.update(extra)
+    return expected
+
+
+def _filesIn(folder: str) -> List[str]:
+    files = []
+    for path, dirs, names in os.walk(folder):
+        relative = os.path.relpath(path, folder).replace(os.sep, '/')
+        for name in names:
+            name = name if relative == '.' else relative + '/' + name
+            if not _ignoredByVerify(name):
+                files.append(name)
+    return files
+
+
+def _sameAsExpected(path: str, expected: tuple) -> Tuple[bool, int]:
+    """(whether the file matches, the bytes read)"""
+    try:
+        if expected[0] == 'crc':
+            if os.path.getsize(path) != expected[2]:  # 大小不同就不用读了
+                return False, 0
+            return crcFile(path) == expected[1], expected[2]
+        return hashFile(path) == expected[1], os.path.getsize(path)
+    except OSError:  # 读不了也算损坏
+        return False, 0
+
+
+def verifyProjects(targets: List[Tuple[str, str]], archives: Dict[Tuple[str, str], str] = None,
+                   workers: int = Const.VERIFY_WORKERS,
+                   progress=lambda result: None, folder: str = None) -> List[VerifyResult]:
+    """
+    Compare the installed (projectName, version) with their manifests,
+    or with the CRCs recorded in their archives when they have none.
+    The files of every project are hashed at the same time on `workers` threads.
+    archives: (projectName, version) => the path of its archive, only needed for projects without a manifest.
+    progress: called with each VerifyResult once it is finished.
+    folder: where the projects are installed, Const.SAVE_PATH by default.
+    """
+    archives = archives or {}
+    folder = folder or Const.SAVE_PATH
+    results = []
+    left = {}  # 每个项目还没有检查完的文件数
+    jobs = {}
+    with span('verify', projects=len(targets)) as s, ThreadPoolExecutor(max(1, workers)) as executor:
+        for projectName, version in targets:
+            result = VerifyResult(projectName, version,
+                                  os.path.join(folder, projectName + Const.SHOW_SEPARATE + version))
+            results.append(result)
+            try:
+                if not os.path.isdir(result.folder):
+                    raise FileNotFoundError(f'"{projectName}{Const.SHOW_SEPARATE}{version}" is not installed.')
+                expected = _expectedFiles(result, archives.get((projectName, version)))
+                existing = set(_filesIn(result.folder))
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                result.error = f'{e}'
+                progress(result)
+                continue
+            result.missing = sorted(name for name in expected if name not in existing)
+            result.extra = sorted(existing.difference(expected))
+            left[result] = 0
+            for name in sorted(existing.intersection(expected)):
+                jobs[executor.submit(_sameAsExpected, safeJoin(result.folder, name), expected[name])] = result, name
+                left[result] += 1
+            if not left[result]:
+                progress(result)
+        for future in as_completed(jobs):
+            result, name = jobs[future]
+            same, size = future.result()
+            result.checked += 1
+            result.bytes += size
+            s.add(size)
+            if not same:
+                result.modified.append(name)
+            left[result] -= 1
+            if not left[result]:
+                result.modified.sort()
+                progress(result)
+    return results
+
+
+def verifyProject(projectName: str, version: str, archive: str = None,
+                  workers: int = Const.VERIFY_WORKERS, folder: str = None) -> VerifyResult:
+    """see verifyProjects"""
+    return verifyProjects([(projectName, version)], {(projectName, version): archive} if archive else None,
+                          workers, folder=folder)[0]
+
+
+def repairProject(result: VerifyResult, archive=None, removeExtra=False) -> List[str]:
+    """
+    Put back the missing and modified files of a verified project, extracting only them from its archive.
+    archive: the path of the archive or a file object of it.
+    The files a delta archive does not carry are copied from the installed base version if they match the manifest.
+    removeExtra: also delete the files which do not belong to the project.
+    return the damaged files which could not be repaired.
+    """
+    left = list(result.damaged)
+    if archive and left:
+        with zipfile.ZipFile(archive) as z:
+            for name in list(left):
+                info = z.NameToInfo.get(name)
+                if info is None or info.is_dir():
+                    continue
+                path = safeJoin(result.folder, name)
+                if os.path.isdir(path):
+                    removeFileOrDir(path)
+                else:
+                    _removeFile(path)  # 可能是只读文件
+                makedir(os.path.dirname(path))
+                with z.open(info) as r, open(path, 'wb') as w:  # 读完时 zipfile 会检查 CRC
+                    shutil.copyfileobj(r, w, 1024 * 1024)
+                left.remove(name)
+    manifest = result.manifest or {}
+    if manifest.get('base') and left:
+        # 基础版本和项目装在同一个目录下
+        base = os.path.join(os.path.dirname(result.folder), result.projectName + Const.SHOW_SEPARATE + manifest['base'])
+        for name in list(left):
+            source = safeJoin(base, name)
+            if os.path.isfile(source) and hashFile(source) == manifest['files'].get(name):
+                path = safeJoin(result.folder, name)
+                _removeFile(path)
+                makedir(os.path.dirname(path))
+                shutil.copy2(source, path)
+                left.remove(name)
+    if removeExtra:
+        for name in result.extra:
+            _removeFile(safeJoin(result.folder, name))
+    installedProjects.invalidate()
+    return left
 
 
 def askForAnswer(title: str, message: str, root: tk.Tk = None, topFrame: tk.Frame = None, destroy=True):
@@ -97,14 +572,15 @@ def askForAnswer(title: str, message: str, root: tk.Tk = None, topFrame: tk.Fram
         if not save:
             s.set('')
             cancel[0] = True
+        answer[0] = s.get()
+        done.set(True)
         if destroy:
             root.destroy()
-        alive[0] = False
 
-    alive = [True]
+    answer = ['']
     cancel = [False]
     if not root:
-        root = tk.Tk()
+        root = dialogWindow()
     if not topFrame:
         topFrame = tk.Frame(root)
         topFrame.pack()
@@ -120,13 +596,18 @@ def askForAnswer(title: str, message: str, root: tk.Tk = None, topFrame: tk.Fram
     tk.Entry(frame, textvariable=s, width=60).pack(side=tk.LEFT, expand=True, fill=tk.X)
     tk.Button(frame, text='确认', command=delete).pack(side=tk.LEFT, expand=True, fill=tk.X)
 
-    while alive[0]:
-        try:
-            root.update()
-        except tk.TclError:
-            break
-    topFrame.forget()
-    return s.get(), cancel[0]
+    done = tk.BooleanVar(root)
+    root.wait_variable(done)  # 等待时照常处理事件, 不占用CPU
+    if not destroy:
+        topFrame.forget()
+    return answer[0], cancel[0]
+
+
+def dialogWindow():
+    """a Toplevel of the existing Tk, or a new Tk if there is not one"""
+    if tk._default_root is not None:
+        return tk.Toplevel(tk._default_root)
+    return tk.Tk()
 
 
 def changeEnDecode(code: str, pwd: str):
@@ -159,11 +640,9 @@ def encode(origin: str, pwd: str = Const.ENCODING_SIGN, life=Const.PASSWORD_AVAI
 
 def showException(title: str = '', message='', attach=''):
     def delete():
-        alive[0] = False
         root.destroy()
 
-    alive = [True]
-    root = tk.Tk()
+    root = dialogWindow()
     root.title('错误' + (':' + title) if title else '')
     root.attributes('-topmost', True)
     root.bind('<Escape>', lambda *a: delete())
@@ -181,8 +660,7 @@ def showException(title: str = '', message='', attach=''):
     t.pack(expand=True, fill=tk.BOTH)
     print('\a' + exception, file=sys.stderr)
     root.focus_force()
-    while alive[0]:
-        root.update()
+    root.wait_window(root)
 
 
 if __name__ == '__main__':
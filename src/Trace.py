@@ -0,0 +1,146 @@
+# coding=utf-8
+import os
+import json
+import time
+import itertools
+import threading
+import contextvars
+from typing import List, Dict, Optional
+import src.Constant as Const
+
+_current = contextvars.ContextVar('span', default=None)  # 当前线程或协程中最内层的 span
+
+
+class Span:
+    """One timed phase, with the bytes it handled. Use it with `with`."""
+    __slots__ = ('tracer', 'name', 'attributes', 'id', 'parent', 'start', 'seconds', 'bytes', 'thread', 'error',
+                 '_began', '_token')
+
+    def __init__(self, tracer: 'Tracer', name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.id = next(tracer.ids)
+        self.parent = None  # type: Optional[int]
+        self.start = 0.0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.thread = None  # type: Optional[str]
+        self.error = None  # type: Optional[str]
+
+    def add(self, size: int):
+        """count bytes the phase handled"""
+        self.bytes += size
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        parent = _current.get()
+        self.parent = parent.id if parent is not None else None
+        self.thread = threading.current_thread().name
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._began = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.seconds = time.perf_counter() - self._began
+        _current.reset(self._token)
+        if kind is not None:
+            self.error = kind.__name__
+        self.tracer.record(self)
+        return False
+
+    def toDict(self) -> dict:
+        return {'name': self.name, 'id': self.id, 'parent': self.parent, 'start': round(self.start, 6),
+                'seconds': round(self.seconds, 6), 'bytes': self.bytes, 'thread': self.thread,
+                'error': self.error, 'attributes': self.attributes}
+
+
+class NullSpan:
+    """what span() gives while tracing is off, it does nothing"""
+    __slots__ = ()
+
+    def add(self, size: int):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Collects the finished spans in memory.
+    While it is disabled span() only returns NULL_SPAN, so the traced code costs next to nothing.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.spans = []  # type: List[Span]
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **attributes):
+        """with tracer.span('fetch.body', project=name) as s: s.add(len(chunk))"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def mark(self) -> int:
+        """give it to summary or export later to only use the spans finished after now"""
+        with self._lock:
+            return len(self.spans)
+
+    def finished(self, since: int = 0) -> List[Span]:
+        with self._lock:
+            return self.spans[since:]
+
+    def summary(self, since: int = 0) -> Dict[str, dict]:
+        """name => {count, seconds, bytes}, the seconds of spans running at the same time are added up"""
+        summary = {}
+        for span in self.finished(since):
+            item = summary.setdefault(span.name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            item['count'] += 1
+            item['seconds'] += span.seconds
+            item['bytes'] += span.bytes
+        for item in summary.values():
+            item['seconds'] = round(item['seconds'], 4)
+        return summary
+
+    def summaryText(self, since: int = 0) -> str:
+        lines = [f'{"phase":<18}{"count":>7}{"seconds":>10}{"MB":>10}{"MB/s":>9}\n']
+        for name, item in sorted(self.summary(since).items()):
+            mb = item['bytes'] / 1024 ** 2
+            speed = f'{mb / item["seconds"]:.1f}' if item['bytes'] and item['seconds'] else '-'
+            lines.append(f'{name:<18}{item["count"]:>7}{item["seconds"]:>10.3f}{mb:>10.2f}{speed:>9}\n')
+        return ''.join(lines)
+
+    def export(self, path: str = Const.TRACE_PATH, since: int = 0) -> int:
+        """append the spans to path as JSON lines, return how many were written"""
+        spans = self.finished(since)
+        with open(path, 'a', encoding='utf-8') as w:
+            for span in spans:
+                w.write(json.dumps(span.toDict(), ensure_ascii=False) + '\n')
+        return len(spans)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+tracer = Tracer(Const.TRACE or bool(os.environ.get(Const.TRACE_ENV)))
+span = tracer.span
@@ -0,0 +1,607 @@
+# coding=utf-8
+import os
+import re
+import ssl
+import time
+import asyncio
+import functools
+import imaplib
+import email.message
+from typing import List, Tuple, Dict, Optional, Callable
+import src.Constant as Const
+from src.Tools import makedir, hashFile, versionKey
+from src.emails.Catalog import MailCatalog
+from src.emails.Cache import ArchiveCache
+from src.emails.Partial import PartialDownload, sweepPartials
+from src.emails.EmailManager import ArchiveInstaller, ProjectArchiveInfo, Base64StreamDecoder, FETCH_UID_PATTERN, \
+    bodyStructureOf, findArchivePart, partNameOf, isFirstPart, get_by_msg, headerQueryOf, \
+    scannedEmailsOf, catalogEntryOf, quoteIMAP, findParts, buildIndex, addToIndex, removeFromIndex, emailsInIndex
+
+LITERAL_PATTERN = re.compile(rb'\{(\d+)\}\r\n$')
+UNTAGGED_PATTERN = re.compile(rb'(?:(\d+) )?([A-Za-z]+) ?')
+LITERAL_READ_SIZE = 64 * 1024
+
+
+def uidMatcher(spec: str) -> Callable[[int], bool]:
+    """whether a UID is in an IMAP UID set like "1,3:5,9:*" """
+    ranges = []
+    for piece in spec.split(','):
+        first, _, last = piece.partition(':')
+        if '*' in (first, last):
+            return lambda UID: True
+        ranges.append((int(first), int(last or first)))
+    return lambda UID: any(min(a, b) <= UID <= max(a, b) for a, b in ranges)
+
+
+class IMAPCommand:
+    def __init__(self, tag: bytes, name: str, uids: Callable[[int], bool] = None, sink=None):
+        """
+        name: the untagged responses of this name are the result, like imaplib.
+        uids: the UIDs which the command asked for, its untagged FETCH responses are found by them.
+        sink: called with the pieces of the literals as they arrive, instead of keeping them.
+        """
+        self.tag = tag
+        self.name = name
+        self.uids = uids
+        self.sink = sink
+        self.responses = {}  # type: Dict[str, list]
+        self.done = asyncio.get_running_loop().create_future()
+
+    def wants(self, UID: Optional[int]) -> bool:
+        return UID is not None and self.uids is not None and self.uids(UID)
+
+    def result(self) -> Tuple[str, list]:
+        """(typ, data) like imaplib"""
+        return self.done.result()[0], self.responses.get(self.name, [None])
+
+
+class AsyncIMAP:
+    """
+    An IMAP connection on an asyncio stream, many tagged commands can be on their way at the same time.
+    One task reads every response, untagged FETCH responses go to the oldest command which asked for their UID,
+    the other untagged responses go to the oldest command. The data has the same form as imaplib.
+    """
+
+    def __init__(self, host: str = None, port: int = None, useSSL: bool = None, depth: int = Const.PIPELINE_DEPTH):
+        self.host = host or Const.IMAP_HOST
+        self.port = port or Const.IMAP_PORT
+        self.useSSL = Const.IMAP_SSL if useSSL is None else useSSL
+        self.depth = max(1, depth)
+        self._reader = None  # type: asyncio.StreamReader
+        self._writer = None  # type: asyncio.StreamWriter
+        self._readTask = None  # type: asyncio.Task
+        self._slots = None  # type: asyncio.Semaphore
+        self._sending = None  # type: asyncio.Lock  # 等待发送字面量时, 其他命令不能插进来
+        self._continuation = None  # type: Optional[asyncio.Future]  # 等待服务器的 "+"
+        self._pending = {}  # type: Dict[bytes, IMAPCommand]  # 按发出顺序
+        self._count = 0
+        self._error = None  # type: Optional[Exception]
+        self.uidValidity = None  # type: Optional[str]  # select 时得到
+
+    @property
+    def load(self) -> int:
+        """commands waiting for their responses"""
+        return len(self._pending)
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.useSSL else None,
+            limit=Const.FETCH_CHUNK_SIZE)
+        greeting = await self._reader.readuntil(b'\r\n')
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise imaplib.IMAP4.error(f'Bad greeting: {greeting!r}.')
+        self._slots = asyncio.Semaphore(self.depth)
+        self._sending = asyncio.Lock()
+        self._readTask = asyncio.get_running_loop().create_task(self._readLoop())
+
+    async def submit(self, command: str, *args: str, name: str = None, uids: str = None, sink=None,
+                     literal: bytes = None) -> IMAPCommand:
+        """
+        Send a command without waiting for its responses, await IMAPCommand.done for them.
+        Commands are sent in the order of the calls.
+        literal: sent as the last argument after the server asks for it, like imaplib.IMAP4.literal.
+        """
+        if self._error is not None:
+            raise ConnectionError(f'The connection to {self.host} is broken: {self._error}')
+        await self._slots.acquire()
+        self._count += 1
+        tag = f'A{self._count:04d}'.encode()
+        sent = IMAPCommand(tag, name or command.split()[-1], uidMatcher(uids) if uids else None, sink)
+        self._pending[tag] = sent
+        sent.done.add_done_callback(lambda future: self._slots.release())
+        async with self._sending:
+            line = b' '.join([tag, command.encode(), *(a.encode() for a in args)])
+            try:
+                if literal is None:
+                    self._writer.write(line + b'\r\n')
+                else:
+                    self._continuation = asyncio.get_running_loop().create_future()
+                    self._writer.write(line + b' {%d}\r\n' % len(literal))
+                    await self._writer.drain()
+                    # 服务器拒绝命令时不会要字面量
+                    await asyncio.wait([self._continuation, sent.done], return_when=asyncio.FIRST_COMPLETED)
+                    if not sent.done.done():
+                        self._writer.write(literal + b'\r\n')
+                await self._writer.drain()
+            except OSError as e:  # 这个命令的结果不会再有人等待
+                sent.done.add_done_callback(lambda future: future.cancelled() or future.exception())
+                raise ConnectionError(f'The connection to {self.host} is broken: {e}') from e
+            finally:
+                self._continuation = None
+        return sent
+
+    async def command(self, command: str, *args: str, name: str = None) -> IMAPCommand:
+        sent = await self.submit(command, *args, name=name)
+        await sent.done
+        return sent
+
+    async def uid(self, command: str, uids: str, *args: str, sink=None, literal: bytes = None) -> Tuple[str, list]:
+        """like imaplib.IMAP4.uid, sink: see IMAPCommand, literal: see submit"""
+        sent = await self.submit('UID ' + command, uids, *args, uids=uids if command.upper() == 'FETCH' else None,
+                                 sink=sink, literal=literal)
+        await sent.done
+        return sent.result()
+
+    async def login(self, user: str, password: str):
+        sent = await self.command('LOGIN', quoteIMAP(user), quoteIMAP(password))
+        if sent.done.result()[0] != 'OK':
+            raise imaplib.IMAP4.error(f'Login failed: {sent.done.result()[1]!r}.')
+
+    async def select(self, mailbox: str = 'INBOX') -> Optional[str]:
+        """return the UIDVALIDITY of the mailbox"""
+        sent = await self.command('SELECT', mailbox, name='OK')
+        if sent.done.result()[0] != 'OK':
+            raise imaplib.IMAP4.error(f'Can not select {mailbox}: {sent.done.result()[1]!r}.')
+        for line in sent.responses.get('OK', ()):
+            found = re.search(rb'\[UIDVALIDITY (\d+)\]', line if isinstance(line, bytes) else line[0])
+            if found:
+                self.uidValidity = found.group(1).decode()
+        return self.uidValidity
+
+    async def logout(self):
+        try:
+            if self._error is None:
+                await self.command('LOGOUT')
+        finally:
+            self._writer.close()
+            if self._readTask is not None:
+                self._readTask.cancel()
+
+    async def _readLoop(self):
+        try:
+            while True:
+                line = await self._reader.readuntil(b'\r\n')
+                if line.startswith(b'* '):
+                    await self._readUntagged(line[2:])
+                elif line.startswith(b'+'):  # 服务器等待字面量
+                    if self._continuation is not None and not self._continuation.done():
+                        self._continuation.set_result(None)
+                else:
+                    tag, _, rest = line.rstrip(b'\r\n').partition(b' ')
+                    typ, _, text = rest.partition(b' ')
+                    sent = self._pending.pop(tag, None)
+                    if sent is not None:
+                        sent.done.set_result((typ.decode(), text))
+        except Exception as e:  # 连接断开, 或 sink 出错后无法再分辨之后的响应
+            self._error = e
+            for sent in self._pending.values():
+                if not sent.done.done():
+                    sent.done.set_exception(ConnectionError(f'The connection to {self.host} is broken: {e}'))
+            self._pending.clear()
+
+    def _ownerOf(self, UID: Optional[int], isFetch: bool) -> Optional[IMAPCommand]:
+        for sent in self._pending.values():
+            if not isFetch or sent.wants(UID):
+                return sent
+        return None
+
+    async def _readUntagged(self, line: bytes):
+        found = UNTAGGED_PATTERN.match(line)
+        name = found.group(2).decode().upper() if found else ''
+        if found and found.group(1) is None:  # "* SEARCH 1 2" => b"1 2", "* 3 FETCH (...)" => b"3 (...)"
+            line = line[found.end():]
+        elif found:
+            line = found.group(1) + b' ' + line[found.end():]
+        isFetch = name == 'FETCH'
+        UID = None
+        owner = None
+        data = []
+        while True:
+            if UID is None:
+                uidFound = FETCH_UID_PATTERN.search(line)
+                if uidFound:
+                    UID = int(uidFound.group(1))
+                    owner = self._ownerOf(UID, isFetch)
+            literal = LITERAL_PATTERN.search(line)
+            if not literal:
+                data.append(line.rstrip(b'\r\n'))
+                break
+            head = line[:-2]
+            size = int(literal.group(1))
+            if owner is not None and owner.sink is not None:  # 一边接收一边交给 sink
+                left = size
+                while left > 0:
+                    piece = await self._reader.read(min(left, LITERAL_READ_SIZE))
+                    if not piece:
+                        raise asyncio.IncompleteReadError(b'', left)
+                    owner.sink(piece)
+                    left -= len(piece)
+                data.append((head, b''))
+            else:
+                data.append((head, await self._reader.readexactly(size)))
+            line = await self._reader.readuntil(b'\r\n')
+        if owner is None:
+            owner = self._ownerOf(UID, isFetch) if UID is not None else self._ownerOf(None, False)
+            if owner is not None and owner.sink is not None:  # UID 在字面量之后才出现
+                for i, item in enumerate(data):
+                    if isinstance(item, tuple) and item[1]:
+                        owner.sink(item[1])
+                        data[i] = item[0], b''
+        if owner is not None:
+            owner.responses.setdefault(name, []).extend(item for item in data if item != b'')
+
+
+class AsyncDownloader:
+    """
+    Downloads projects on asyncio. The FETCH commands of every download are pipelined on a few connections,
+    so hundreds of projects can be fetched at the same time by one thread.
+    It is not a Downloader: listing, searching and fetching are coroutines here.
+    The archives go into an ArchiveInstaller, which is shared with Downloader and installs them.
+    """
+
+    def __init__(self, save_path: str = Const.SAVE_PATH, catalog: MailCatalog = None,
+                 connections: int = Const.POOL_SIZE, cache: ArchiveCache = None):
+        self.installer = ArchiveInstaller(save_path, cache)
+        self.catalog = catalog
+        self.uidValidity = None
+        self.poolSize = max(1, connections)
+        self.connections = []  # type: List[AsyncIMAP]  # 在 login 时建立
+        self._alive = False
+        self._available = None  # type: Optional[Dict[bytes, email.message.Message]]
+        self._listing = None  # type: Optional[asyncio.Task]
+        self._fetching = {}  # type: Dict[Tuple[str, str], asyncio.Task]
+        self._reconnecting = {}  # type: Dict[AsyncIMAP, asyncio.Task]  # 断开的连接 -> 代替它的连接
+        # 项目名 -> 版本 -> [(UID, header Message)], 新的在前, 第一次查找时建立
+        self.index = None  # type: Optional[Dict[str, Dict[str, List[Tuple[bytes, email.message.Message]]]]]
+
+    @property
+    def got_files(self) -> List[ProjectArchiveInfo]:
+        return self.installer.got_files
+
+    def _check(self, sit=True):
+        """如果不是该状况则报错"""
+        if not (self._alive == sit):
+            raise RuntimeError('This AsyncDownloader is not available now.')
+        return True
+
+    @staticmethod
+    async def _open() -> AsyncIMAP:
+        conn = AsyncIMAP()
+        await conn.connect()
+        await conn.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
+        await conn.select('INBOX')
+        return conn
+
+    async def login(self):
+        self.connections = list(await asyncio.gather(*(self._open() for _ in range(self.poolSize))))
+        self.uidValidity = self.installer.uidValidity = self.connections[0].uidValidity
+        self._alive = True
+        sweepPartials(Const.PARTIAL_PATH, self.uidValidity)
+
+    def _connection(self) -> AsyncIMAP:
+        """the connection with the fewest commands on their way"""
+        return min(self.connections, key=lambda conn: conn.load)
+
+    async def _search(self, criteria: str, literal: bytes = None) -> Tuple[bytes]:
+        typ, data = await self._connection().uid('SEARCH', criteria, literal=literal)
+        if typ == 'OK' and data and data[0]:
+            return tuple(b' '.join(data).split()[::-1])  # 倒序, 新的在前
+        return ()
+
+    async def getAllAvailableEmails(self, batchSize: int = Const.FETCH_BATCH_SIZE,
+                                    withParts: bool = False) -> Dict[bytes, email.message.Message]:
+        """see Downloader.getAllAvailableEmails, the FETCH of every batch are sent at the same time"""
+        self._check()
+        if self.catalog is None or self.uidValidity is None:
+            get = {UID: msg for UID, msg, size, date in await self._scanEmails(await self._search('ALL'), batchSize)}
+        else:
+            self.catalog.checkValidity(self.uidValidity)  # UIDVALIDITY 变化时重建
+            present = await self._search('ALL')
+            self.catalog.keepOnly(int(UID) for UID in present)  # 忘掉已被删除的邮件
+            scanned = self.catalog.maxUid
+            UIDs = tuple(UID for UID in present if int(UID) > scanned)
+            if UIDs:
+                self.catalog.add((catalogEntryOf(*found) for found in await self._scanEmails(UIDs, batchSize)),
+                                 max(int(UID) for UID in UIDs))
+            get = self.catalog.getAll()
+        self._available = get
+        self.index = buildIndex(get)
+        if withParts:
+            return get
+        return {UID: msg for UID, msg in get.items() if isFirstPart(msg)}
+
+    async def _scanEmails(self, UIDs: Tuple[bytes], batchSize: int
+                          ) -> List[Tuple[bytes, email.message.Message, int, str]]:
+        batchSize, query = headerQueryOf(batchSize)
+        batches = [UIDs[start:start + batchSize] for start in range(0, len(UIDs), batchSize)]
+
+        async def scan(batch):
+            typ, data = await self._connection().uid('FETCH', b','.join(batch).decode(), query)
+            return scannedEmailsOf(batch, data if typ == 'OK' else [])
+
+        return [found for got in await asyncio.gather(*(scan(batch) for batch in batches)) for found in got]
+
+    async def _availableEmails(self) -> Dict[bytes, email.message.Message]:
+        """the listing with every part, the mailbox is listed only once for the fetches at the same time"""
+        if self._available is None:
+            if self._listing is None:
+                self._listing = asyncio.get_running_loop().create_task(self.getAllAvailableEmails(withParts=True))
+            try:
+                await self._listing
+            finally:
+                self._listing = None
+        return self._available
+
+    async def _indexedEmails(self, projectName: str, version: str = None) -> Dict[bytes, email.message.Message]:
+        """see Downloader._indexedEmails"""
+        if self.index is None:
+            await self._availableEmails()
+        if not emailsInIndex(self.index, projectName, version):
+            found = await self._scanEmails(await self.searchUIDsOnServer(projectName, version),
+                                           Const.FETCH_BATCH_SIZE)
+            addToIndex(self.index, [(UID, header_msg) for UID, header_msg, size, date in found
+                                    if get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True) == projectName])
+        return emailsInIndex(self.index, projectName, version)
+
+    async def searchUIDsOnServer(self, projectName: str, version: str = None) -> Tuple[bytes]:
+        """
+        see Downloader.searchUIDsOnServer
+        """
+        self._check()
+        criteria = []
+        if version is not None and version.isascii():
+            criteria.append(f'HEADER {Const.PROJECT_VERSION_HEADER} {quoteIMAP(version)}')
+        criteria.append(f'HEADER {Const.PROJECT_NAME_HEADER}')
+        if projectName.isascii():
+            return await self._search(f'{" ".join(criteria)} {quoteIMAP(projectName)}')
+        # 非 ASCII 的项目名作为字面量发送, 和 Downloader 一样
+        return await self._search(f'CHARSET UTF-8 {" ".join(criteria)}', projectName.encode('utf-8'))
+
+    async def getVersions(self, projectName: str, refresh=False) -> List[str]:
+        """see Downloader.getVersions"""
+        if refresh:
+            await self.getAllAvailableEmails(withParts=True)
+        versions = {get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+                    for header_msg in (await self._indexedEmails(projectName)).values() if isFirstPart(header_msg)}
+        return sorted(versions, key=versionKey, reverse=True)
+
+    async def getLatestVersion(self, projectName: str, refresh=False) -> Optional[str]:
+        versions = await self.getVersions(projectName, refresh)
+        return versions[0] if versions else None
+
+    async def fetch(self, projectName: str, version: str, report=lambda msg: None) -> ProjectArchiveInfo:
+        """
+        see Downloader.fetch, the parts of a split project are fetched at the same time.
+        Fetching the same project at the same time downloads it once.
+        """
+        if not projectName:
+            raise ValueError('Keyword can not be empty!')
+        self._check()
+        key = projectName, version
+        task = self._fetching.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._fetch(projectName, version, report))
+            self._fetching[key] = task
+            task.add_done_callback(lambda done: self._fetching.get(key) is done and self._fetching.pop(key))
+        return await task
+
+    async def fetchAll(self, targets: List[Tuple[str, str]], report=lambda msg: None
+                       ) -> Dict[Tuple[str, str], Exception]:
+        """fetch every (projectName, version) at the same time, return the targets that failed and their exceptions"""
+        targets = list(targets)
+        results = await asyncio.gather(*(self.fetch(projectName, version, report) for projectName, version in targets),
+                                       return_exceptions=True)
+        failed = {}
+        for target, result in zip(targets, results):
+            if isinstance(result, Exception):
+                failed[target] = result
+                report(f'Failed to download "{target[0]}{Const.SHOW_SEPARATE}{target[1]}": {result}\n')
+        return failed
+
+    async def _fetch(self, projectName: str, version: str, report) -> ProjectArchiveInfo:
+        parts = findParts(projectName, version, await self._indexedEmails(projectName, version))
+        if not parts:
+            raise FileNotFoundError(f'Can not find the email whose name is {projectName}.')
+        base = get_by_msg(parts[0][1], Const.BASE_VERSION_HEADER)
+        if base and not self.installer.hasBase(projectName, base):  # 差量更新需要先取得基础版本
+            report(f'"{projectName}{Const.SHOW_SEPARATE}{version}" needs version {base}.\n')
+            await self.fetch(projectName, base, report)
+        got = self.installer.fromCache(*parts[0])
+        if got:
+            report(f'"{projectName}{Const.SHOW_SEPARATE}{version}" is in the cache.\n')
+        else:
+            downloaded = await asyncio.gather(*(self._fetchArchive(UID, header_msg, report)
+                                                for UID, header_msg in parts))
+            loop = asyncio.get_running_loop()
+            got = self.installer.toCache(await loop.run_in_executor(None, self.installer.joinParts, list(downloaded)),
+                                         parts[0][0])
+        self.installer.got_files.append(got)
+        return got
+
+    async def _reconnect(self, broken: AsyncIMAP) -> AsyncIMAP:
+        """
+        a new connection in place of the broken one,
+        the downloads which were on it at the same time all wait for the same new connection
+        """
+        task = self._reconnecting.get(broken)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._open())
+            self._reconnecting[broken] = task
+        try:
+            conn = await task
+        except (imaplib.IMAP4.error, OSError):
+            if self._reconnecting.get(broken) is task:
+                del self._reconnecting[broken]  # 下一次重新连接
+            raise
+        if broken in self.connections:
+            self.connections[self.connections.index(broken)] = conn
+            try:
+                await broken.logout()  # 只是关闭 socket
+            except Exception:
+                pass
+        return conn
+
+    async def _retrying(self, conn: AsyncIMAP, action, report) -> Tuple[AsyncIMAP, object]:
+        """
+        await action(conn), connecting again when the connection drops, like Downloader._fetchByUID.
+        return (the connection used at last, the result of action)
+        """
+        failures = 0
+        while True:
+            try:
+                return conn, await action(conn)
+            except ConnectionError as e:
+                failures += 1
+                if failures > Const.FETCH_RETRIES:
+                    raise
+                report(f'Connection lost ({e}), reconnecting {failures}/{Const.FETCH_RETRIES}...\n')
+                await asyncio.sleep(Const.RECONNECT_DELAY * failures)
+                try:
+                    conn = await self._reconnect(conn)
+                except (imaplib.IMAP4.error, OSError):
+                    continue  # 还连不上, 下一次再试
+                if conn.uidValidity != self.uidValidity:
+                    raise FileNotFoundError('The mailbox has changed, list it again.')
+
+    async def _fetchArchive(self, target_UID: bytes, header_msg: email.message.Message, report
+                            ) -> ProjectArchiveInfo:
+        """
+        see Downloader._fetchByUID. Every ranged FETCH is sent at once on one connection,
+        the literals are decoded into the file while they arrive.
+        The progress is saved under Const.PARTIAL_PATH after every piece like Downloader._fetchByUID,
+        when the connection drops the download goes on from there on a new connection.
+        """
+        projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True)
+        version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+        name = partNameOf(header_msg)
+        UID = target_UID.decode()
+        report(f'Downloading "{name}"...\n')
+        start = time.time()
+        conn, (typ, data) = await self._retrying(self._connection(),
+                                                 lambda conn: conn.uid('FETCH', UID, '(BODYSTRUCTURE)'), report)
+        if not typ == 'OK':
+            raise Exception(f'Wrong email, whose data is {data}.')
+        if data[0] is None:  # 邮件已被删除
+            if self.catalog is not None:
+                self.catalog.remove(int(target_UID))
+            removeFromIndex(self.index, target_UID)
+            raise FileNotFoundError(f'The email of {projectName} has been removed.')
+        part = findArchivePart(bodyStructureOf(data))
+        if not part:
+            raise FileNotFoundError(f'The email of {projectName} contains no archive.')
+        section, encoding, size, filename = part
+        makedir(Const.TEMP_FOLDER_PATH)
+        path = os.path.join(Const.TEMP_FOLDER_PATH, name + '.zip')
+        self.installer.temp.append(path)
+        partial = PartialDownload(Const.PARTIAL_PATH, self.uidValidity, UID, section, size)
+        if partial.resume():
+            report(f'Resuming "{name}" from {partial.offset * 100 // max(1, size)}%.\n')
+        with partial:
+            out = Base64StreamDecoder(partial, partial.rest) if encoding == 'BASE64' else partial
+            received = [partial.offset, partial.offset * 10 // max(1, size)]  # 收到的字节, 已报告的进度
+            failed = []  # 写入时的异常, 它会让连接断开
+
+            def sinkFrom(offset: int, attempt: list):
+                got = [0]
+
+                def sink(piece: bytes):
+                    start, got[0] = got[0], got[0] + len(piece)
+                    if not attempt[0] or received[0] != offset + start:  # 已经放弃, 或前一块不完整而对不上位置
+                        return
+                    try:
+                        out.write(piece)
+                    except Exception as e:
+                        failed.append(e)
+                        raise
+                    received[0] += len(piece)
+                    if received[0] * 10 // size > received[1]:  # 每 10% 报告一次
+                        received[1] = received[0] * 10 // size
+                        report(f'"{name}" {min(received[1] * 10, 100)}%\n')
+
+                return sink
+
+            async def download(conn: AsyncIMAP):
+                """the rest of the archive from what has been received"""
+                attempt = [True]
+                sent = []
+                try:
+                    # 按顺序发出, 同一连接上的响应也按顺序到达
+                    for offset in range(received[0], size, Const.FETCH_CHUNK_SIZE):
+                        sent.append((offset, await conn.submit(
+                            'UID FETCH', UID, f'(BODY.PEEK[{section}]<{offset}.{Const.FETCH_CHUNK_SIZE}>)',
+                            name='FETCH', uids=UID, sink=sinkFrom(offset, attempt))))
+                    for offset, command in sent:
+                        await command.done
+                        if command.result()[0] != 'OK':
+                            raise Exception(f'Failed to download "{name}": {command.done.result()[1]!r}.')
+                        if received[0] < min(offset + Const.FETCH_CHUNK_SIZE, size):  # 保留进度以后继续
+                            raise ValueError(f'"{name}" stopped at {received[0]} of {size} bytes, '
+                                             f'download it again to go on.')
+                        partial.checkpoint(received[0], out.pending if encoding == 'BASE64' else b'')
+                except ConnectionError:
+                    if failed:  # 不是连接的问题, 重新连接也没有用
+                        raise failed[0]
+                    raise
+                finally:
+                    attempt[0] = False
+                    for offset, command in sent:  # 放弃的命令的结果不再需要
+                        command.done.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+            await self._retrying(conn, download, report)
+            if encoding == 'BASE64':
+                out.close()
+        partial.finish(path)
+        partHash = get_by_msg(header_msg, Const.PART_HASH_HEADER)
+        if partHash and await asyncio.get_running_loop().run_in_executor(None, hashFile, path) != partHash:
+            raise ValueError(f'"{name}" is broken, its hash does not match.')
+        report(f'Downloaded "{name}" ({os.path.getsize(path)} bytes in {time.time() - start:.1f}s).\n')
+        return ProjectArchiveInfo(filename or name + '.zip', projectName, version, path=path,
+                                  archiveHash=get_by_msg(header_msg, Const.ARCHIVE_HASH_HEADER),
+                                  baseVersion=get_by_msg(header_msg, Const.BASE_VERSION_HEADER))
+
+    async def save(self, report=lambda msg: None, overWrite=True, incremental=True,
+                   installed=lambda projectFile, seconds: None, precompile: bool = Const.PRECOMPILE):
+        """ArchiveInstaller.save in an executor, so the event loop goes on meanwhile"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.installer.save, report, overWrite,
+                                                                  incremental, installed, precompile))
+
+    def clearTempFile(self):
+        self.installer.clearTempFile()
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.installer.waitRemoving)
+        if self._alive:
+            self._alive = False
+            self.clearTempFile()
+            await asyncio.gather(*(conn.logout() for conn in self.connections), return_exceptions=True)
+            self._reconnecting.clear()
+
+    def __del__(self):
+        self.installer.waitRemoving()
+        if self._alive:  # 无法在这里等待退出登录
+            self._alive = False
+            self.clearTempFile()
+
+
+async def testDownload():
+    d = AsyncDownloader()
+    await d.login()
+    try:
+        print(await d.getAllAvailableEmails())
+    finally:
+        await d.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(testDownload())
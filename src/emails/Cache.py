@@ -0,0 +1,90 @@
+# coding=utf-8
+import os
+import re
+import threading
+from typing import Optional, Dict
+import src.Constant as Const
+from src.Tools import makedir
+
+
+class ArchiveCache:
+    """
+    Downloaded archives kept on disk, keyed by (project, version, content hash).
+    The least recently used ones are removed when the cache grows over maxSize,
+    except the pinned ones, which are waiting to be installed.
+    """
+
+    def __init__(self, path: str = Const.CACHE_PATH, maxSize: int = Const.CACHE_SIZE):
+        self.path = path
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._pinned = {}  # type: Dict[str, int]  # 路径 -> 被固定的次数
+        makedir(path)
+
+    def _pathOf(self, projectName: str, version: str, contentHash: str) -> str:
+        name = f'{projectName}{Const.SHOW_SEPARATE}{version}-{contentHash}.zip'
+        return os.path.join(self.path, re.sub(r'[\\/:*?"<>|]', '_', name))  # 去除文件名中不能用的字符
+
+    def get(self, projectName: str, version: str, contentHash: str, pin=False) -> Optional[str]:
+        """the path of the cached archive, None if it is not cached. pin: see pin"""
+        path = self._pathOf(projectName, version, contentHash)
+        with self._lock:
+            if not os.path.isfile(path):
+                return None
+            os.utime(path)  # 修改时间即最近使用时间
+            if pin:
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+        return path
+
+    def put(self, projectName: str, version: str, contentHash: str, archivePath: str, pin=False) -> str:
+        """move the archive into the cache, return its new path. pin: see pin"""
+        path = self._pathOf(projectName, version, contentHash)
+        with self._lock:
+            os.replace(archivePath, path)
+            os.utime(path)
+            if pin:
+                self._pinned[path] = self._pinned.get(path, 0) + 1
+            self._evict(keep=path)
+        return path
+
+    def pin(self, path: str):
+        """keep the archive until unpin, however big the cache grows"""
+        with self._lock:
+            self._pinned[path] = self._pinned.get(path, 0) + 1
+
+    def unpin(self, path: str):
+        """the cache may shrink again once nothing pins the archive"""
+        with self._lock:
+            count = self._pinned.get(path, 0) - 1
+            if count > 0:
+                self._pinned[path] = count
+                return
+            self._pinned.pop(path, None)
+            self._evict()
+
+    def _evict(self, keep: str = None):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for mtime, size, path in sorted(entries):  # 最久未使用的在前
+            if total <= self.maxSize:
+                break
+            if path == keep or path in self._pinned:  # 还要安装的压缩包
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:  # 可能正在被解压
+                pass
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.path):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
@@ -0,0 +1,123 @@
+# coding=utf-8
+import json
+import sqlite3
+import threading
+import email.message
+from typing import Dict, Iterable, Tuple, Optional
+import src.Constant as Const
+
+
+SCHEMA_VERSION = 1
+
+
+class CatalogEntry:
+    def __init__(self, UID: int, projectName: str, version: str, subject: str, size: int, date: str,
+                 headers: Dict[str, str] = None):
+        """headers: the Const.EXTRA_HEADERS which the email has"""
+        self.UID = UID
+        self.projectName = projectName
+        self.version = version
+        self.subject = subject
+        self.size = size
+        self.date = date
+        self.headers = headers or {}
+
+    def toMessage(self) -> email.message.Message:
+        """rebuild the header Message which getAllAvailableEmails used to return"""
+        msg = email.message.Message()
+        if self.subject is not None:
+            msg['Subject'] = self.subject
+        msg[Const.PROJECT_NAME_HEADER] = self.projectName
+        msg[Const.PROJECT_VERSION_HEADER] = self.version
+        for key, value in self.headers.items():
+            msg[key] = value
+        return msg
+
+
+class MailCatalog:
+    """
+    Local copy of the project headers in the mailbox, keyed by UID.
+    It is only valid while the UIDVALIDITY of the mailbox stays the same.
+    """
+
+    def __init__(self, path: str = Const.CATALOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                # 只是缓存, 结构变化时直接重建
+                self._db.execute('DROP TABLE IF EXISTS meta')
+                self._db.execute('DROP TABLE IF EXISTS emails')
+                self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS emails ('
+                             'uid INTEGER PRIMARY KEY, project TEXT, version TEXT, '
+                             'subject TEXT, size INTEGER, date TEXT, headers TEXT)')
+
+    def _getMeta(self, key: str) -> Optional[str]:
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _setMeta(self, key: str, value):
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, f'{value}'))
+
+    @property
+    def uidValidity(self) -> Optional[str]:
+        with self._lock:
+            return self._getMeta('uidvalidity')
+
+    @property
+    def maxUid(self) -> int:
+        """the highest UID that has been scanned, whether it is a project or not"""
+        with self._lock:
+            return int(self._getMeta('maxuid') or 0)
+
+    def checkValidity(self, uidValidity: str, address: str = Const.EMAIL_ADDRESS) -> bool:
+        """Drop everything if the mailbox is not the one cached. return whether the cache is kept."""
+        with self._lock, self._db:
+            if self._getMeta('uidvalidity') == f'{uidValidity}' and self._getMeta('address') == address:
+                return True
+            self._db.execute('DELETE FROM emails')
+            self._db.execute('DELETE FROM meta')
+            self._setMeta('uidvalidity', uidValidity)
+            self._setMeta('address', address)
+            return False
+
+    def add(self, entries: Iterable[CatalogEntry], scannedUid: int = 0):
+        """scannedUid: every UID up to it has been scanned."""
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO emails (uid, project, version, subject, size, date, headers) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(e.UID, e.projectName, e.version, e.subject, e.size, e.date, json.dumps(e.headers))
+                 for e in entries]
+            )
+            if scannedUid > int(self._getMeta('maxuid') or 0):
+                self._setMeta('maxuid', scannedUid)
+
+    def remove(self, UID: int):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM emails WHERE uid = ?', (UID,))
+
+    def keepOnly(self, UIDs: Iterable[int]) -> int:
+        """forget the emails which are not among UIDs any more, like the expunged ones. return how many"""
+        present = set(UIDs)
+        with self._lock, self._db:
+            gone = [(UID,) for UID, in self._db.execute('SELECT uid FROM emails') if UID not in present]
+            self._db.executemany('DELETE FROM emails WHERE uid = ?', gone)
+        return len(gone)
+
+    def entries(self) -> Tuple[CatalogEntry]:
+        """newest first"""
+        with self._lock:
+            rows = self._db.execute('SELECT uid, project, version, subject, size, date, headers '
+                                    'FROM emails ORDER BY uid DESC').fetchall()
+        return tuple(CatalogEntry(*row[:-1], json.loads(row[-1] or '{}')) for row in rows)
+
+    def getAll(self) -> Dict[bytes, email.message.Message]:
+        return {f'{e.UID}'.encode(): e.toMessage() for e in self.entries()}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
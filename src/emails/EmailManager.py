@@ -1,25 +1,91 @@
 # coding=utf-8
 import smtplib
+import sys
 import os
+import io
+import re
+import ssl
+import socket
+import mmap
+import time
+import base64
+import binascii
+import copy
+import json
+import shutil
+import uuid
+import struct
+import tempfile
+import collections
+import itertools
+import queue
+import threading
+import contextlib
 import traceback
 import zipfile
-from typing import List, Tuple, Union, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple, Union, Dict, Optional, Iterator, Iterable
 import src.Constant as Const
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 from email.mime.text import MIMEText
 import email
 import email.header
+import email.policy
 import imaplib
-from src.Tools import removeFileOrDir, makedir
+from src.Tools import removeFileOrDir, makedir, hashFile, crcFile, safeJoin, readInstalledManifest, hiddenSibling, \
+    replaceDir, recoverReplacedDir, installedProjects, versionKey, verifyProject, repairProject, VerifyResult, \
+    compileProject
+from src.Trace import span
+from src.emails.Catalog import MailCatalog, CatalogEntry
+from src.emails.Cache import ArchiveCache
+from src.emails.Partial import PartialDownload, sweepPartials
 
 
 class ProjectArchiveInfo:
-    def __init__(self, fileName: str, projectName: str, version: str, data: bytes):
+    def __init__(self, fileName: str, projectName: str, version: str, data: bytes = None, path: str = None,
+                 archiveHash: str = None, baseVersion: str = None):
+        """
+        the archive is either in memory (data) or already on disk (path)
+        baseVersion: the archive is a delta on this version.
+        """
         self.filename = fileName
         self.projectName = projectName
         self.version = version
         self.data = data
+        self.path = path
+        self.archiveHash = archiveHash
+        self.baseVersion = baseVersion
+
+
+class Base64StreamDecoder:
+    """Decode base64 which arrives in pieces of any length into a binary file."""
+
+    def __init__(self, out, rest: bytes = b''):
+        """rest: the base64 left over by an earlier decoder, when a download is resumed"""
+        self.out = out
+        self._rest = rest
+
+    @property
+    def pending(self) -> bytes:
+        """the base64 received but not decoded yet"""
+        return self._rest
+
+    def write(self, chunk: bytes) -> int:
+        with span('fetch.decode') as s:
+            data = self._rest + chunk.translate(None, b' \t\r\n')
+            cut = len(data) - len(data) % 4  # 只解码完整的 4 字节组
+            self._rest = data[cut:]
+            decoded = binascii.a2b_base64(data[:cut])
+            s.add(len(decoded))
+        with span('fetch.write') as s:
+            s.add(len(decoded))
+            return self.out.write(decoded)
+
+    def close(self):
+        if self._rest.strip(b'='):
+            raise ValueError('Incomplete base64 data.')
+        self._rest = b''
 
 
 def countTopFolderInZIP(z: zipfile.ZipFile):
@@ -30,6 +96,87 @@ def countTopFolderInZIP(z: zipfile.ZipFile):
     return len(folders)
 
 
+COMPRESSIONS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+}
+# compat32 才会把中文的项目名等头部编码成 =?utf-8?b?...?=, 只把换行改成 SMTP 要的 CRLF
+SMTP_COMPAT = email.policy.compat32.clone(linesep='\r\n')
+
+
+# copyCompressedMember 用到的 zipfile 内部实现在这些版本上核对过, 其他版本逐个压缩
+RAW_MEMBER_VERSIONS = ((3, 8), (3, 13))
+RAW_MEMBER_ATTRIBUTES = ('_lock', '_writing', '_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+
+def canCopyCompressed(z: zipfile.ZipFile) -> bool:
+    """whether copyCompressedMember works with the zipfile of this Python"""
+    return (RAW_MEMBER_VERSIONS[0] <= sys.version_info[:2] <= RAW_MEMBER_VERSIONS[1] and
+            hasattr(zipfile.ZipInfo, 'FileHeader') and all(hasattr(z, name) for name in RAW_MEMBER_ATTRIBUTES))
+
+
+def compressMember(realPath: str, insidePath: str, compression: int, level: int = None):
+    """
+    Compress one file into a single-member archive of its own, so that
+    several files can be compressed at the same time. return the archive file.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=Const.SPOOL_SIZE)
+    with zipfile.ZipFile(spool, 'w', compression, compresslevel=level) as single:
+        single.write(realPath, insidePath)
+    return spool
+
+
+def copyCompressedMember(z: zipfile.ZipFile, spool):
+    """
+    Append the member compressed by compressMember to z without compressing it again.
+    zipfile has no public way to write raw members, this follows what ZipFile.writestr does inside,
+    check canCopyCompressed first.
+    """
+    with spool, zipfile.ZipFile(spool) as single:
+        info = single.infolist()[0]
+        spool.seek(info.header_offset)
+        header = spool.read(zipfile.sizeFileHeader)
+        nameLength, extraLength = struct.unpack('<HH', header[26:30])
+        spool.seek(info.header_offset + zipfile.sizeFileHeader + nameLength + extraLength)
+        info.extra = b''  # 大小等信息由 FileHeader 重新生成
+        with z._lock:
+            if z._writing:
+                raise ValueError('Can not write to the archive while an open writing handle exists.')
+            z._writecheck(info)
+            z._didModify = True
+            z.fp.seek(z.start_dir)
+            info.header_offset = z.fp.tell()
+            z.fp.write(info.FileHeader())
+            left = info.compress_size
+            while left > 0:
+                data = spool.read(min(left, 1024 * 1024))
+                if not data:
+                    raise zipfile.BadZipFile(f'Truncated member "{info.filename}".')
+                z.fp.write(data)
+                left -= len(data)
+            z.filelist.append(info)
+            z.NameToInfo[info.filename] = info
+            z.start_dir = z.fp.tell()
+
+
+def sameAsMember(path: str, info: zipfile.ZipInfo) -> bool:
+    """whether the file on disk has the size and CRC of the archive member"""
+    try:
+        return os.path.getsize(path) == info.file_size and crcFile(path) == info.CRC
+    except OSError:
+        return False
+
+
+def linkOrCopy(source: str, target: str):
+    """hard link if the file system allows, the old tree is removed afterwards anyway"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
 def checkContainsArchive(msg: email.message.Message):
     """检查对应的信封是否是Azazo的传输文件"""
     try:
@@ -62,24 +209,317 @@ def analysisArchive(msg: email.message.Message) -> ProjectArchiveInfo:
             return ProjectArchiveInfo(
                 fileName=payload.get_filename(),
                 data=payload.get_payload(decode=True),
-                projectName=get_by_msg(msg, Const.PROJECT_NAME_HEADER),
-                version=get_by_msg(msg, Const.PROJECT_VERSION_HEADER),
+                projectName=get_by_msg(msg, Const.PROJECT_NAME_HEADER, decode=True),
+                version=get_by_msg(msg, Const.PROJECT_VERSION_HEADER, decode=True),
             )
 
 
+FETCH_UID_PATTERN = re.compile(rb'UID (\d+)')
+FETCH_SIZE_PATTERN = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_DATE_PATTERN = re.compile(rb'INTERNALDATE "([^"]*)"')
+
+
+def iterFetchResponse(data: list):
+    """
+    Walk the data of an imaplib FETCH response.
+    yield (UID, literal, attributes) for every message in it,
+    attributes is the non-literal text of the response.
+    """
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            if pending:
+                yield tuple(pending)
+            head, literal = item
+            found = FETCH_UID_PATTERN.search(head)
+            pending = [found.group(1) if found else None, literal, head]
+        elif isinstance(item, bytes) and pending:
+            pending[2] += item
+            found = FETCH_UID_PATTERN.search(item)  # UID 可能位于文本之后
+            if found and pending[0] is None:
+                pending[0] = found.group(1)
+    if pending:
+        yield tuple(pending)
+
+
+IMAP_TOKEN_PATTERN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.S)
+
+
+def flattenFetchResponse(data: list) -> bytes:
+    """join an imaplib FETCH response into one line, literals become quoted strings"""
+    parts = []
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            parts.append(re.sub(rb'\{\d+\}$', b'', head))
+            parts.append(b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"')
+        elif isinstance(item, bytes):
+            parts.append(item)
+    return b''.join(parts)
+
+
+def parseIMAPList(text: bytes) -> list:
+    """parse IMAP parenthesized lists into nested lists of str, NIL becomes None"""
+    stack = [[]]
+    pos = 0
+    while True:
+        found = IMAP_TOKEN_PATTERN.match(text, pos)
+        if not found:
+            break
+        pos = found.end()
+        opening, closing, quoted, atom = found.groups()
+        if opening:
+            stack.append([])
+        elif closing:
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode(errors='replace'))
+        else:
+            stack[-1].append(None if atom.upper() == b'NIL' else atom.decode(errors='replace'))
+    return stack[0]
+
+
+def bodyStructureOf(data: list) -> list:
+    """get the parsed BODYSTRUCTURE from an imaplib FETCH response"""
+    text = flattenFetchResponse(data)
+    start = text.upper().find(b'BODYSTRUCTURE ')
+    if start < 0:
+        raise ValueError(f'No BODYSTRUCTURE in {text[:100]}.')
+    parsed = parseIMAPList(text[start + len(b'BODYSTRUCTURE '):])
+    return parsed[0] if parsed else []
+
+
+def _imapParams(params) -> Dict[str, str]:
+    if not isinstance(params, list):
+        return {}
+    return {f'{k}'.lower(): v for k, v in zip(params[::2], params[1::2])}
+
+
+def findArchivePart(structure: list, section: str = '') -> Optional[Tuple[str, str, int, str]]:
+    """
+    Find the archive in a parsed BODYSTRUCTURE.
+    return (section, encoding, size, filename), size is the encoded size.
+    """
+    if structure and isinstance(structure[0], list):  # multipart: 子部分在前, 之后是子类型
+        for i, part in enumerate(itertools.takewhile(lambda x: isinstance(x, list), structure), 1):
+            found = findArchivePart(part, f'{section}.{i}' if section else f'{i}')
+            if found:
+                return found
+        return None
+    if len(structure) < 7 or f'{structure[0]}/{structure[1]}'.lower() != Const.ARCHIVE_TYPE:
+        return None
+    filename = _imapParams(structure[2]).get('name')
+    if len(structure) > 8 and isinstance(structure[8], list) and len(structure[8]) > 1:
+        filename = _imapParams(structure[8][1]).get('filename', filename)
+    return section or '1', (structure[5] or '7BIT').upper(), int(structure[6]), filename
+
+
+def quoteIMAP(text: str) -> str:
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def headerQueryOf(batchSize: int) -> Tuple[int, str]:
+    """(UIDs in one FETCH, FETCH items) to list the emails, see Downloader.getAllAvailableEmails"""
+    if batchSize:
+        fields = ' '.join(Const.LIST_HEADERS).upper()
+        return batchSize, f'(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS ({fields})])'
+    return 1, '(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER])'
+
+
+def scannedEmailsOf(UIDs: Tuple[bytes], data: list) -> List[Tuple[bytes, email.message.Message, int, str]]:
+    """
+    [(UID, header Message, size, date)] of the project emails in a FETCH response of headerQueryOf,
+    in the order of UIDs.
+    """
+    headers = {}
+    for UID, literal, attributes in iterFetchResponse(data):
+        if UID is not None:
+            headers[UID] = literal, attributes
+    get = []
+    for i in UIDs:
+        if i not in headers:
+            continue
+        literal, attributes = headers[i]
+        try:
+            msg = email.message_from_bytes(literal)
+            if checkContainsArchive(msg):
+                size = FETCH_SIZE_PATTERN.search(attributes)
+                date = FETCH_DATE_PATTERN.search(attributes)
+                get.append((i, msg,
+                            int(size.group(1)) if size else None,
+                            date.group(1).decode() if date else None))
+        except (TypeError, AttributeError):
+            pass
+    return get
+
+
+def catalogEntryOf(UID: bytes, msg: email.message.Message, size: int, date: str) -> CatalogEntry:
+    return CatalogEntry(int(UID),
+                        get_by_msg(msg, Const.PROJECT_NAME_HEADER, decode=True),
+                        get_by_msg(msg, Const.PROJECT_VERSION_HEADER, decode=True),
+                        get_by_msg(msg, 'Subject'),
+                        size, date,
+                        {key: msg[key] for key in Const.EXTRA_HEADERS if msg[key] is not None})
+
+
+def partNameOf(msg: email.message.Message) -> str:
+    """project-version, with the part index if the project is split"""
+    name = f'{get_by_msg(msg, Const.PROJECT_NAME_HEADER, decode=True)}{Const.SHOW_SEPARATE}{get_by_msg(msg, Const.PROJECT_VERSION_HEADER, decode=True)}'
+    index = get_by_msg(msg, Const.PART_INDEX_HEADER)
+    if index is not None:
+        name += f'.part{index}of{get_by_msg(msg, Const.PART_COUNT_HEADER)}'
+    return name
+
+
+def isFirstPart(msg: email.message.Message) -> bool:
+    """whether the email is a whole project or the first part of one"""
+    return get_by_msg(msg, Const.PART_INDEX_HEADER) in (None, '1')
+
+
+# 连接已损坏的异常, FileNotFoundError 等其他 OSError 不是
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, ConnectionError, socket.timeout, ssl.SSLError)
+
+
+def findEmail(projectName: str, version: str, available: Dict[bytes, email.message.Message]) -> Optional[bytes]:
+    """the UID of the newest email of the project, or of the first part of it"""
+    for i, header_msg in available.items():
+        try:
+            msg_projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True)
+            msg_version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+            if projectName == msg_projectName and version == msg_version and isFirstPart(header_msg):  # 判断
+                return i
+        except (TypeError, AttributeError):
+            pass
+
+
+def findParts(projectName: str, version: str, available: Dict[bytes, email.message.Message]
+              ) -> List[Tuple[bytes, email.message.Message]]:
+    """
+    Every email of the project in part order, a project which is not split has one.
+    If it was uploaded more than once, the newest complete upload is chosen.
+    available: newest first, with every part.
+    """
+    # 同一次上传的各卷有相同的 ArchiveHash 与 PartCount, 内容相同的重复上传可以混用
+    uploads = collections.OrderedDict()  # type: Dict[object, Dict[int, Tuple[bytes, email.message.Message]]]
+    for i, header_msg in available.items():  # available 中新的在前
+        if (get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True) != projectName or
+                get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True) != version):
+            continue
+        index = get_by_msg(header_msg, Const.PART_INDEX_HEADER)
+        if index is None:
+            uploads[i] = {1: (i, header_msg)}
+        else:
+            key = (get_by_msg(header_msg, Const.ARCHIVE_HASH_HEADER),
+                   get_by_msg(header_msg, Const.PART_COUNT_HEADER))
+            uploads.setdefault(key, {}).setdefault(int(index), (i, header_msg))
+    for parts in uploads.values():
+        count = int(get_by_msg(next(iter(parts.values()))[1], Const.PART_COUNT_HEADER) or 1)
+        if sorted(parts) == list(range(1, count + 1)):
+            return [parts[index] for index in sorted(parts)]
+    if uploads:
+        raise FileNotFoundError(f'Some parts of {projectName}{Const.SHOW_SEPARATE}{version} are missing.')
+    return []
+
+
+def buildIndex(available: Dict[bytes, email.message.Message]
+               ) -> Dict[str, Dict[str, List[Tuple[bytes, email.message.Message]]]]:
+    """项目名 -> 版本 -> [(UID, header Message)], 新的在前. available: a whole listing with every part"""
+    index = {}
+    for UID, header_msg in available.items():
+        (index.setdefault(get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True), {})
+         .setdefault(get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True), [])
+         .append((UID, header_msg)))
+    for versions in index.values():
+        for emails in versions.values():
+            emails.sort(key=lambda e: int(e[0]), reverse=True)
+    return index
+
+
+def addToIndex(index: dict, emails: Iterable[Tuple[bytes, email.message.Message]]):
+    """add the emails found after the index was built, like the ones searched on the server"""
+    for UID, header_msg in emails:
+        found = (index.setdefault(get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True), {})
+                 .setdefault(get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True), []))
+        if all(UID != i for i, _ in found):
+            found.append((UID, header_msg))
+            found.sort(key=lambda e: int(e[0]), reverse=True)
+
+
+def removeFromIndex(index: Optional[dict], UID: bytes):
+    for versions in (index or {}).values():
+        for emails in versions.values():
+            emails[:] = [e for e in emails if e[0] != UID]
+
+
+def emailsInIndex(index: dict, projectName: str, version: str = None) -> Dict[bytes, email.message.Message]:
+    """the emails of the project, or of one version of it, newest first"""
+    versions = index.get(projectName, {})
+    emails = versions.values() if version is None else [versions.get(version, [])]
+    return dict(sorted(itertools.chain(*emails), key=lambda e: int(e[0]), reverse=True))
+
+
+def openIMAP() -> imaplib.IMAP4:
+    """a new connection to Const.IMAP_HOST, plain TCP if Const.IMAP_SSL is False"""
+    conn = (imaplib.IMAP4_SSL if Const.IMAP_SSL else imaplib.IMAP4)(host=Const.IMAP_HOST, port=Const.IMAP_PORT)
+    conn.sock.settimeout(Const.IMAP_TIMEOUT)  # 断网时不会一直等待
+    return conn
+
+
+def uidValidityOf(conn: imaplib.IMAP4) -> Optional[str]:
+    """the UIDVALIDITY the server told when the mailbox was selected"""
+    typ, data = conn.response('UIDVALIDITY')
+    return data[0].decode() if data and data[0] else None
+
+
+def openSMTP() -> smtplib.SMTP:
+    """an SMTP client which is connected in Uploader.login, plain TCP if Const.SMTP_SSL is False"""
+    return smtplib.SMTP_SSL(host=Const.SMTP_HOST) if Const.SMTP_SSL else smtplib.SMTP()
+
+
 def get_by_msg(msg: email.message.Message, attr: str, decode=False) -> Union[bytes, str]:
-    """get attribute from msg"""
+    """get attribute from msg, decode: turn the RFC 2047 encoded words of a non-ASCII value back into text"""
     get = msg.get(attr)
-    if decode:
-        get, charset = email.header.decode_header(get)
-        if charset:
-            get = get.decode(charset)
+    if decode and get and '=?' in get:
+        get = str(email.header.make_header(email.header.decode_header(get)))
     return get
 
 
 class Uploader:
-    def __init__(self, subject: str, version: str):
+    def __init__(self, subject: str, version: str,
+                 compression: Union[str, int] = Const.COMPRESSION,
+                 compressLevel: int = Const.COMPRESS_LEVEL,
+                 workers: int = Const.COMPRESS_WORKERS,
+                 partSize: int = Const.PART_SIZE,
+                 baseVersion: str = None,
+                 baseManifest: Union[str, dict] = None):
+        """
+        compression: stored, deflate, bzip2, lzma or one of the zipfile.ZIP_* constants.
+        workers: how many files are compressed at the same time.
+        partSize: archives bigger than it are sent in several emails, 0 for never.
+            Clients from before split uploads can not install the split projects, so it is off by default.
+        baseVersion: upload only the files changed since this version (a delta).
+        baseManifest: the manifest of baseVersion, a dict or the path of it.
+            The one of the installed baseVersion is used if not given.
+        """
         self.subject, self.version = subject, version
+        self.compression = COMPRESSIONS[compression.lower()] if isinstance(compression, str) else compression
+        self.compressLevel = compressLevel
+        self.workers = workers
+        self.partSize = partSize
+        self.baseVersion = baseVersion
+        self._baseFiles = {}  # type: Dict[str, str]
+        if baseVersion:
+            if baseManifest is None:
+                baseManifest = readInstalledManifest(subject, baseVersion)
+            elif isinstance(baseManifest, str):
+                with open(baseManifest, encoding='utf-8') as r:
+                    baseManifest = json.load(r)
+            if not baseManifest:
+                raise FileNotFoundError(f'Can not find the manifest of "{subject}{Const.SHOW_SEPARATE}{baseVersion}".')
+            self._baseFiles = baseManifest['files']
+        self._manifest = {}  # type: Dict[str, str]  # 压缩包内路径 => sha256
         self._temp = []  # 临时文件夹与文件
         self._zip_name = subject + '.zip'
         self._zip_dir = Const.TEMP_FOLDER_PATH
@@ -88,7 +528,9 @@ class Uploader:
         self._temp.append(self._zip_dir)
         self._temp.append(self._zip_path)
 
-        self._smtpObj = smtplib.SMTP_SSL(host=Const.SMTP_HOST)
+        self._zip = None  # type: zipfile.ZipFile
+        self._zipCreated = False
+        self._smtpObj = openSMTP()
         self._message = MIMEMultipart()
         self._alive = False
         self._message.add_header('From', Const.EMAIL_ADDRESS)
@@ -104,14 +546,115 @@ class Uploader:
             raise RuntimeError('This Uploader is not available now.')
         return True
 
-    def _bindToZip(self, ):
-        self._check()
-        with open(self._zip_path, 'rb') as r:
-            data = r.read()
-        attachment = MIMEApplication(data)
+    def _openZip(self) -> zipfile.ZipFile:
+        """the archive stays open until it is sent"""
+        if self._zip is None:
+            mode = 'a' if self._zipCreated else 'w'  # 关闭后再打开时继续添加, 不覆盖
+            self._zip = zipfile.ZipFile(self._zip_path, mode, self.compression, compresslevel=self.compressLevel)
+            self._zipCreated = True
+        return self._zip
+
+    def _writeMembers(self, members: List[Tuple[str, str]]):
+        """
+        write [(realPath, insidePath)] into the archive in order, compressing them in parallel.
+        For a delta, the files which are the same as the base are only recorded in the manifest.
+        """
+        with span('upload.hash', files=len(members)), ThreadPoolExecutor(max(1, self.workers)) as executor:
+            hashes = list(executor.map(hashFile, (realPath for realPath, insidePath in members)))
+        changed = []
+        for (realPath, insidePath), sha in zip(members, hashes):
+            name = insidePath.replace(os.sep, '/').lstrip('/')
+            self._manifest[name] = sha
+            if self._baseFiles.get(name) != sha:
+                changed.append((realPath, insidePath))
+        z = self._openZip()
+        with span('upload.compress', files=len(changed)) as s:
+            start = z.fp.tell()
+            self._compressMembers(z, changed)
+            s.add(z.fp.tell() - start)
+
+    def _compressMembers(self, z: zipfile.ZipFile, members: List[Tuple[str, str]]):
+        """write the members in order, compressing them at the same time unless they are stored"""
+        if self.compression == zipfile.ZIP_STORED or self.workers <= 1 or len(members) <= 1 or \
+                not canCopyCompressed(z):
+            for realPath, insidePath in members:
+                z.write(realPath, insidePath)  # 分块写入, 不整个读入内存
+            return
+        with ThreadPoolExecutor(self.workers) as executor:  # zlib/bz2/lzma 压缩时会释放 GIL
+            pending = collections.deque()
+            for realPath, insidePath in members:
+                pending.append(executor.submit(compressMember, realPath, insidePath,
+                                               self.compression, self.compressLevel))
+                if len(pending) >= self.workers * 2:  # 限制同时存在的压缩结果
+                    copyCompressedMember(z, pending.popleft().result())
+            while pending:
+                copyCompressedMember(z, pending.popleft().result())
+
+    def _closeZip(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _writeManifest(self):
+        """record every file of the project and, for a delta, the files removed since the base"""
+        manifest = {
+            'project': self.subject,
+            'version': self.version,
+            'base': self.baseVersion,
+            'files': self._manifest,
+            'deleted': sorted(set(self._baseFiles) - set(self._manifest)),
+        }
+        self._openZip().writestr(Const.MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=1))
+
+    def _iterMessage(self, message: MIMEMultipart, fileName: str, start: int = 0, length: int = None):
+        """
+        yield the whole message in pieces, ready for the DATA command.
+        The archive (or `length` bytes of it from `start`) is base64 encoded while it is read,
+        it is never loaded at once.
+        """
+        marker = f'ARCHIVE-{uuid.uuid4().hex}'
+        attachment = MIMEApplication(b'')
         attachment.add_header('Content-Disposition', 'attachment',
-                              filename=self._zip_name)
-        self._message.attach(attachment)
+                              filename=fileName)
+        attachment.set_payload(marker)  # 占位, 发送时替换为编码后的压缩包
+        message.attach(attachment)
+        head, tail = message.as_bytes(policy=SMTP_COMPAT).split(marker.encode())
+        yield re.sub(rb'(?m)^\.', b'..', head)
+        with open(self._zip_path, 'rb') as r:
+            r.seek(start)
+            left = length
+            while left is None or left > 0:
+                data = r.read(Const.SEND_CHUNK_SIZE if left is None else min(left, Const.SEND_CHUNK_SIZE))
+                if not data:
+                    break
+                if left is not None:
+                    left -= len(data)
+                yield base64.encodebytes(data).replace(b'\n', b'\r\n')  # base64 行不会以 "." 开头
+        yield re.sub(rb'(?m)^\.', b'..', tail)
+
+    def _sendStreaming(self, message: MIMEMultipart, fileName: str, start: int = 0, length: int = None):
+        """sendmail, but the message is sent piece by piece"""
+        smtp = self._smtpObj
+        smtp.ehlo_or_helo_if_needed()
+        code, resp = smtp.mail(Const.EMAIL_ADDRESS)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, Const.EMAIL_ADDRESS)
+        code, resp = smtp.rcpt(Const.EMAIL_ADDRESS)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({Const.EMAIL_ADDRESS: (code, resp)})
+        smtp.putcmd('data')
+        code, resp = smtp.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        last = b''
+        for piece in self._iterMessage(message, fileName, start, length):
+            if piece:
+                smtp.send(piece)
+                last = piece
+        smtp.send(b'.\r\n' if last.endswith(b'\r\n') else b'\r\n.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
 
     def attachFiles(self, filePath: List[str]):
         self._check()
@@ -124,11 +667,7 @@ class Uploader:
             D:/abc/def.ghi => def.ghi
         """
         self._check()
-        with open(filePath, 'rb') as r:
-            data = r.read()
-        z = zipfile.ZipFile(self._zip_path, 'a')
-        z.writestr(os.path.split(filePath)[-1], data)
-        z.close()
+        self._writeMembers([(filePath, os.path.split(filePath)[-1])])
 
     def attachFolder(self, folderPath: str):
         """
@@ -138,27 +677,50 @@ class Uploader:
         self._check()
         if not os.path.exists(folderPath):
             raise FileNotFoundError('Can not find {}'.format(folderPath))
-        z = zipfile.ZipFile(self._zip_path, 'a')
+        members = []
         for p, childrenDir, files in os.walk(folderPath):
             for f in files:
                 insidePath = os.path.join(clearExtraPath(p, folderPath), f)
                 realPath = os.path.join(p, f)
-                with open(realPath, 'rb') as r:
-                    z.writestr(insidePath, r.read())
-        z.close()
+                members.append((realPath, insidePath))
+        self._writeMembers(members)
 
     def login(self):
-        self._smtpObj.connect(host=Const.SMTP_HOST, port=Const.SMTP_PORT)
-        self._smtpObj.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
+        with span('upload.login'):
+            self._smtpObj.connect(host=Const.SMTP_HOST, port=Const.SMTP_PORT)
+            self._smtpObj.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
         self._alive = True
 
     def send(self):
         self._check()
-        self._bindToZip()
-        self._smtpObj.sendmail(Const.EMAIL_ADDRESS, Const.EMAIL_ADDRESS, self._message.as_bytes())
+        self._writeManifest()
+        self._closeZip()
+        if self.baseVersion:
+            self._message.add_header(Const.BASE_VERSION_HEADER, self.baseVersion)
+        size = os.path.getsize(self._zip_path)
+        with span('upload.hash') as s:
+            s.add(size)
+            archiveHash = hashFile(self._zip_path)
+        count = max(1, -(-size // self.partSize)) if self.partSize else 1
+        for index in range(count):
+            message = copy.deepcopy(self._message)
+            message.add_header(Const.ARCHIVE_HASH_HEADER, archiveHash)
+            if count == 1:
+                with span('upload.send', project=self.subject) as s:
+                    s.add(size)
+                    self._sendStreaming(message, self._zip_name)
+                break
+            start = index * self.partSize  # 分卷发送, 每一卷都是一封完整的邮件
+            message.add_header(Const.PART_INDEX_HEADER, f'{index + 1}')
+            message.add_header(Const.PART_COUNT_HEADER, f'{count}')
+            message.add_header(Const.PART_HASH_HEADER, hashFile(self._zip_path, start, self.partSize))
+            with span('upload.send', project=self.subject, part=index + 1) as s:
+                s.add(min(self.partSize, size - start))
+                self._sendStreaming(message, f'{self._zip_name}.{index + 1:03d}', start, self.partSize)
         self.close()
 
     def clearTemp(self):
+        self._closeZip()
         for f in self._temp:
             removeFileOrDir(f)
         self._temp.clear()
@@ -173,13 +735,324 @@ class Uploader:
         self.close()
 
 
-class Downloader:
-    def __init__(self, save_path: str = Const.SAVE_PATH):
-        self.imapObj = imaplib.IMAP4_SSL(host=Const.IMAP_HOST, port=Const.IMAP_PORT)
+class IMAPPool:
+    """
+    Up to `size` logged-in IMAP connections with INBOX selected,
+    lent out to worker threads one at a time.
+    """
+
+    def __init__(self, size: int = Const.POOL_SIZE):
+        self.size = max(1, size)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._opened = []
+        self._replaced = {}  # 损坏的连接 => 代替它的连接
+        self._alive = True
+
+    @staticmethod
+    def _connect() -> imaplib.IMAP4:
+        conn = openIMAP()
+        conn.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
+        conn.select('INBOX')
+        return conn
+
+    def _drop(self, conn: imaplib.IMAP4):
+        with self._lock:
+            if conn in self._opened:
+                self._opened.remove(conn)
+        try:
+            conn.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        """borrow a connection, a new one is opened if all are busy and the pool is not full."""
+        if not self._alive:
+            raise RuntimeError('This IMAPPool is not available now.')
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = len(self._opened) < self.size
+                if create:
+                    self._opened.append(None)  # 先占位, 连接在锁外建立
+            if create:
+                conn = None
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._lock:
+                        self._opened.remove(None)
+                        if conn is not None:
+                            self._opened.append(conn)
+            else:
+                conn = self._idle.get()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self._drop(self._latest(conn))  # 连接已损坏, 不再放回
+            raise
+        except BaseException:
+            self._idle.put(self._latest(conn))
+            raise
+        else:
+            self._idle.put(self._latest(conn))
+
+    def reopen(self, broken: imaplib.IMAP4) -> imaplib.IMAP4:
+        """
+        replace a broken connection which is lent out,
+        the new one goes back to the pool instead of it when the borrowing ends.
+        """
+        self._drop(broken)
+        conn = self._connect()
+        with self._lock:
+            self._opened.append(conn)
+            self._replaced[broken] = conn
+        return conn
+
+    def _latest(self, conn: imaplib.IMAP4) -> imaplib.IMAP4:
+        with self._lock:
+            while conn in self._replaced:
+                conn = self._replaced.pop(conn)
+        return conn
+
+    def close(self):
         self._alive = False
-        self.got_files = []
+        while True:
+            try:
+                self._drop(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class ArchiveInstaller:
+    """
+    The downloaded archives waiting to be installed, and the installing of them.
+    Downloader and AsyncDownloader both download into one, it never talks to the server.
+    """
+
+    def __init__(self, save_path: str = Const.SAVE_PATH, cache: ArchiveCache = None):
+        self.got_files = []  # type: List[ProjectArchiveInfo]
         self.temp = []
+        self.removing = []  # type: List[threading.Thread]  # 在后台删除被替换的旧项目
+        self.pinned = []  # type: List[str]  # 固定在缓存中等待安装的压缩包
         self.save_path = save_path
+        self.cache = cache
+        self.uidValidity = None  # 没有哈希的压缩包按 UID 缓存, 要连同 UIDVALIDITY
+
+    def hasBase(self, projectName: str, base: str, targets: List[Tuple[str, str]] = ()) -> bool:
+        """whether the base version of a delta is installed or going to be"""
+        return bool(os.path.isdir(os.path.join(self.save_path, f'{projectName}{Const.SHOW_SEPARATE}{base}')) or
+                    (projectName, base) in targets or
+                    any(f.projectName == projectName and f.version == base for f in self.got_files))
+
+    def _cacheKeyOf(self, UID: bytes, archiveHash: Optional[str]) -> str:
+        """the content hash, or the UID for the emails uploaded before hashes were added"""
+        return archiveHash or f'uid{self.uidValidity}.{UID.decode()}'
+
+    def fromCache(self, UID: bytes, header_msg: email.message.Message) -> Optional[ProjectArchiveInfo]:
+        if self.cache is None:
+            return None
+        projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True)
+        version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+        archiveHash = get_by_msg(header_msg, Const.ARCHIVE_HASH_HEADER)
+        path = self.cache.get(projectName, version, self._cacheKeyOf(UID, archiveHash), pin=True)
+        if path:
+            self.pinned.append(path)
+            return ProjectArchiveInfo(os.path.basename(path), projectName, version, path=path,
+                                      archiveHash=archiveHash,
+                                      baseVersion=get_by_msg(header_msg, Const.BASE_VERSION_HEADER))
+
+    def toCache(self, projectFile: ProjectArchiveInfo, UID: bytes) -> ProjectArchiveInfo:
+        """move a downloaded archive into the cache, it is extracted from there"""
+        if self.cache is None:
+            return projectFile
+        path = self.cache.put(projectFile.projectName, projectFile.version,
+                              self._cacheKeyOf(UID, projectFile.archiveHash), projectFile.path, pin=True)
+        self.pinned.append(path)
+        if projectFile.path in self.temp:
+            self.temp.remove(projectFile.path)
+        projectFile.path = path
+        return projectFile
+
+    def joinParts(self, parts: List[ProjectArchiveInfo]) -> ProjectArchiveInfo:
+        """join the downloaded parts in order into one archive and check it"""
+        first = parts[0]
+        if len(parts) > 1:
+            path = os.path.join(Const.TEMP_FOLDER_PATH,
+                                f'{first.projectName}{Const.SHOW_SEPARATE}{first.version}.zip')
+            self.temp.append(path)
+            with span('fetch.join', parts=len(parts)), open(path, 'wb') as w:
+                for part in parts:
+                    with open(part.path, 'rb') as r:
+                        shutil.copyfileobj(r, w, 1024 * 1024)
+                    removeFileOrDir(part.path)
+            first = ProjectArchiveInfo(os.path.basename(path), first.projectName, first.version, path=path,
+                                       archiveHash=first.archiveHash, baseVersion=first.baseVersion)
+        if first.archiveHash and not self._verify(first.path, first.archiveHash):
+            raise ValueError(f'The archive of "{first.projectName}" is broken, its hash does not match.')
+        return first
+
+    @staticmethod
+    def _verify(path: str, expected: str) -> bool:
+        with span('fetch.verify') as s:
+            s.add(os.path.getsize(path))
+            return hashFile(path) == expected
+
+    def save(self, report=lambda msg: None, overWrite=True, incremental=True,
+             installed=lambda projectFile, seconds: None, precompile: bool = Const.PRECOMPILE):
+        """
+        return the download path.
+        incremental: build the project aside, reusing the installed files which did not change,
+            then swap it in. Otherwise the installed project is removed before extracting.
+        installed: called with the ProjectArchiveInfo and the seconds it took after each project is installed.
+        precompile: byte-compile the .py files of each project after installing it, so its first run is not slower.
+        """
+        zip_dir = Const.TEMP_FOLDER_PATH
+        to_path = self.save_path
+        for projectFile in self._installOrder():
+            start = time.time()
+            folder_name = f'{projectFile.projectName}{Const.SHOW_SEPARATE}{projectFile.version}'
+            target = os.path.join(to_path, folder_name)
+            recoverReplacedDir(target)
+            if os.path.exists(target):  # 检查是否存在原项目
+                if overWrite and incremental:
+                    report(f'"{folder_name}" exists, updating it... \n')
+                elif overWrite:
+                    report(f'"{folder_name}" exists, uninstalling it... \n')
+                    removeFileOrDir(os.path.join(to_path, folder_name))
+                    installedProjects.invalidate()
+                    report(f'Uninstalling "{folder_name}" successfully. \n')
+                else:
+                    report(f'Failed to install "{folder_name}".\n')
+                    raise FileExistsError(f'"{folder_name}" has already exists. Consider to turn overWrite on.')
+            report(f'Installing "{folder_name}"...\n')
+            with span('install', project=folder_name) as s:
+                s.add(os.path.getsize(projectFile.path) if projectFile.path else len(projectFile.data))
+                if projectFile.path:  # 已经下载到临时文件夹, 映射到内存解压
+                    z = UnZIPer(projectFile.path)
+                    self.temp.append(zip_dir)
+                else:  # 直接从内存解压
+                    z = UnZIPer(projectFile.data)
+                staging = hiddenSibling(target, 'staging')
+                removeFileOrDir(staging)
+                with z:
+                    manifest = z.readManifest()
+                    if manifest and manifest.get('base'):
+                        self._applyDelta(z, manifest, to_path, staging, report)
+                    else:
+                        written, reused = z.extractChanged(staging, target if os.path.isdir(target) else None)
+                        if reused:
+                            report(f'{reused} files of "{folder_name}" did not change, '
+                                   f'{written} files are written.\n')
+                with span('install.replace'):
+                    self.removing.extend(replaceDir(staging, target))  # 最后一步才替换原项目
+                installedProjects.invalidate()
+            if precompile:
+                self._compile(target, folder_name, report)
+            report(f'Installing "{folder_name} successfully!"\n')
+            installed(projectFile, time.time() - start)
+            # 只去掉装好的, AsyncDownloader 安装时还可能有新下载好的压缩包加入
+            self.got_files.remove(projectFile)
+            self.releaseCache([projectFile.path])
+        return to_path
+
+    @staticmethod
+    def _compile(target: str, folder_name: str, report):
+        """a project which does not compile is still installed, the errors are only reported"""
+        start = time.time()
+        with span('install.compile', project=folder_name):
+            try:
+                ok, output = compileProject(target)
+            except OSError as e:  # 找不到解释器
+                ok, output = False, f'{e}'
+        if ok:
+            report(f'Compiled "{folder_name}" in {time.time() - start:.1f}s.\n')
+        else:
+            report(f'Some files of "{folder_name}" can not be compiled ({time.time() - start:.1f}s):\n{output}\n')
+
+    def _installOrder(self) -> List[ProjectArchiveInfo]:
+        """got_files, but the base of a delta comes before the delta"""
+        pending = list(self.got_files)
+        ordered = []
+        while pending:
+            for projectFile in pending:
+                if not any(f.projectName == projectFile.projectName and f.version == projectFile.baseVersion
+                           for f in pending):
+                    break
+            else:
+                raise ValueError('The deltas are based on each other.')
+            pending.remove(projectFile)
+            ordered.append(projectFile)
+        return ordered
+
+    @staticmethod
+    def _applyDelta(z: 'UnZIPer', manifest: dict, to_path: str, target: str, report):
+        """
+        rebuild the whole project at target: the files the delta did not change are copied from the installed
+        base version after their sha256 is checked against the manifest, then the changed files are extracted
+        """
+        base_name = f'{manifest["project"]}{Const.SHOW_SEPARATE}{manifest["base"]}'
+        base_path = os.path.join(to_path, base_name)
+        if not os.path.isdir(base_path):
+            raise FileNotFoundError(f'"{manifest["project"]}{Const.SHOW_SEPARATE}{manifest["version"]}" '
+                                    f'is a delta, install "{base_name}" first.')
+        report(f'Rebuilding "{manifest["version"]}" from "{base_name}"...\n')
+        changed = set(z.namelist())
+        unchanged = [name for name in manifest['files'] if name not in changed]  # 只复制清单中的文件
+
+        def hashOf(name: str) -> Optional[str]:
+            try:
+                return hashFile(safeJoin(base_path, name))
+            except OSError:
+                return None
+
+        with span('install.base', files=len(unchanged)) as s:
+            with ThreadPoolExecutor(Const.VERIFY_WORKERS) as executor:
+                hashes = list(executor.map(hashOf, unchanged))
+            differ = [name for name, sha in zip(unchanged, hashes) if sha != manifest['files'][name]]
+            if differ:  # 被改过的基础版本会把改动带进新版本
+                raise ValueError(f'{len(differ)} files of "{base_name}" are missing or modified '
+                                 f'({", ".join(differ[:5])}), repair or reinstall it first.')
+            for name in unchanged:
+                path = safeJoin(target, name)
+                makedir(os.path.dirname(path))
+                shutil.copy2(safeJoin(base_path, name), path)  # 不能硬链接, 否则修改新版本会改动基础版本
+                s.add(os.path.getsize(path))
+        z.extractChanged(target)
+
+    def clearTempFile(self):
+        for f in self.temp:
+            removeFileOrDir(f)
+        self.temp.clear()
+        self.releaseCache()
+
+    def releaseCache(self, paths: List[str] = None):
+        """let the cache remove the archives it kept for installing, all of them if paths is not given"""
+        for path in list(self.pinned) if paths is None else paths:
+            if path in self.pinned:
+                self.pinned.remove(path)
+                self.cache.unpin(path)
+
+    def waitRemoving(self):
+        """wait until the replaced projects are deleted, otherwise a short-lived process leaves them behind"""
+        for thread in self.removing:
+            thread.join()
+        self.removing.clear()
+
+
+class Downloader(ArchiveInstaller):
+    def __init__(self, save_path: str = Const.SAVE_PATH, catalog: MailCatalog = None,
+                 poolSize: int = Const.POOL_SIZE, cache: ArchiveCache = None):
+        super().__init__(save_path, cache)
+        self.imapObj = openIMAP()
+        self._alive = False
+        self.catalog = catalog
+        self.poolSize = poolSize
+        self.pool = None  # type: IMAPPool
+        # 项目名 -> 版本 -> [(UID, header Message)], 新的在前, 第一次查找时建立
+        self.index = None  # type: Optional[Dict[str, Dict[str, List[Tuple[bytes, email.message.Message]]]]]
 
     def _check(self, sit=True):
         """如果不是该状况则报错"""
@@ -188,105 +1061,431 @@ class Downloader:
         return True
 
     def login(self):
-        self.imapObj.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
-        self._alive = True
-        self.imapObj.select('INBOX')
+        with span('login'):
+            self.imapObj.login(Const.EMAIL_ADDRESS, Const.PASSWORD)
+            self._alive = True
+            self.imapObj.select('INBOX')
+        self.uidValidity = uidValidityOf(self.imapObj)
+        sweepPartials(Const.PARTIAL_PATH, self.uidValidity)
 
-    def getAllUid(self) -> Tuple[str]:
+    def getAllUid(self) -> Tuple[bytes]:
         self._check()
-        typ, data = self.imapObj.search(None, 'ALL')
+        with span('list.search'):
+            typ, data = self.imapObj.uid('SEARCH', None, 'ALL')
         if typ == 'OK':
             return tuple(data[0].split()[::-1])  # 倒序输出,为了让最近的在前面
 
-    def getSubjectByUID(self, UID: Union[int, str]):
-        typ, data = self.imapObj.fetch(f'{UID}', '(BODY.PEEK[HEADER])')
+    def getUidAbove(self, UID: int) -> Tuple[bytes]:
+        """UIDs greater than UID, newest first"""
+        self._check()
+        with span('list.search'):
+            typ, data = self.imapObj.uid('SEARCH', None, f'UID {UID + 1}:*')
+        if typ == 'OK':
+            # "n:*" 总会包含最大的 UID, 即使它小于 n
+            return tuple(i for i in data[0].split()[::-1] if int(i) > UID)
+        return ()
+
+    def getSubjectByUID(self, UID: Union[int, str, bytes]):
+        if isinstance(UID, bytes):
+            UID = UID.decode()
+        typ, data = self.imapObj.uid('FETCH', f'{UID}', '(BODY.PEEK[HEADER])')
         if not typ == 'OK':
             raise ValueError('Invalid Email.')
         msg = email.message_from_bytes(data[0][1])
         subject = get_by_msg(msg, 'subject', True)
         return subject
 
-    def searchFromAvailableEmails(self, projectName: str, version: str):
+    def searchFromAvailableEmails(self, projectName: str, version: str,
+                                  available: Dict[bytes, email.message.Message] = None):
         """
         Find the correct project of correct version in the mailbox.
+        available: the result of getAllAvailableEmails, fetched again if not given.
         """
-        available = self.getAllAvailableEmails()
-        for i, header_msg in available.items():
-            try:
-                msg_projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER)
-                msg_version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER)
-                if projectName == msg_projectName and version == msg_version:  # 判断
-                    return i
-            except (TypeError, AttributeError):
-                pass
+        if available is None:
+            available = self._indexedEmails(projectName, version)
+        return findEmail(projectName, version, available)
 
-    def getAllAvailableEmails(self) -> Dict[str, email.message.Message]:
+    def searchPartsFromAvailableEmails(self, projectName: str, version: str,
+                                       available: Dict[bytes, email.message.Message] = None
+                                       ) -> List[Tuple[bytes, email.message.Message]]:
+        """
+        Find every email of the project, in part order. A project which is not split has one.
+        If it was uploaded more than once, the newest complete upload is chosen.
+        available: the result of getAllAvailableEmails(withParts=True), the index is used if not given.
+        """
+        if available is None:
+            available = self._indexedEmails(projectName, version)
+        return findParts(projectName, version, available)
+
+    def getAllAvailableEmails(self, batchSize: int = Const.FETCH_BATCH_SIZE,
+                              withParts: bool = False) -> Dict[bytes, email.message.Message]:
         """
         find the emails which belongs to AzazoFilesTransportation
         return the dict contains UID and the Header Message of it.
+        batchSize: how many UIDs to send in one FETCH, 0 for one FETCH per email.
+        withParts: include every part of the split projects, not only the first one.
+        With a catalog, only the emails newer than the cached ones are fetched.
         """
-        get = {}
-        for i in self.getAllUid():
-            typ, data = self.imapObj.fetch(i, f'(BODY.PEEK[HEADER])')
-            if not typ == 'OK':
-                continue
-            try:
-                msg = email.message_from_bytes(data[0][1])
-                if checkContainsArchive(msg):
-                    get[i] = msg
-            except (TypeError, AttributeError):
-                pass
-        return get
+        self._check()
+        with span('list') as s:
+            if self.catalog is None or self.uidValidity is None:
+                get = {UID: msg for UID, msg, size, date in self.scanEmails(self.getAllUid(), batchSize)}
+            else:
+                get = self._updateCatalog(batchSize)
+            self._setIndex(get)
+            s.set(emails=len(get))
+        if withParts:
+            return get
+        return {UID: msg for UID, msg in get.items() if isFirstPart(msg)}
+
+    def _setIndex(self, available: Dict[bytes, email.message.Message]):
+        """build the index from a whole listing with every part"""
+        self.index = buildIndex(available)
+
+    def _indexedEmails(self, projectName: str, version: str = None) -> Dict[bytes, email.message.Message]:
+        """
+        The emails of the project, or of one version of it, newest first.
+        They come from the index, which is built by the first call,
+        the server is searched for the ones the index has not, like the ones uploaded after it was built.
+        """
+        if self.index is None:
+            self.getAllAvailableEmails(withParts=True)
+        if not emailsInIndex(self.index, projectName, version):
+            found = self.scanEmails(self.searchUIDsOnServer(projectName, version))
+            addToIndex(self.index, [(UID, header_msg) for UID, header_msg, size, date in found
+                                    if get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True) == projectName])
+        return emailsInIndex(self.index, projectName, version)
+
+    def searchUIDsOnServer(self, projectName: str, version: str = None) -> Tuple[bytes]:
+        """
+        UID SEARCH HEADER for the emails of the project, newest first.
+        IMAP matches substrings, check the headers of the results.
+        """
+        self._check()
+        criteria = []
+        if version is not None and version.isascii():
+            criteria += ['HEADER', Const.PROJECT_VERSION_HEADER, quoteIMAP(version)]
+        criteria += ['HEADER', Const.PROJECT_NAME_HEADER]
+        if projectName.isascii():
+            typ, data = self.imapObj.uid('SEARCH', None, *criteria, quoteIMAP(projectName))
+        else:  # 非 ASCII 的项目名作为字面量发送
+            self.imapObj.literal = projectName.encode('utf-8')
+            typ, data = self.imapObj.uid('SEARCH', 'CHARSET', 'UTF-8', *criteria)
+        if typ == 'OK' and data and data[0]:
+            return tuple(data[0].split()[::-1])
+        return ()
+
+    def getVersions(self, projectName: str, refresh=False) -> List[str]:
+        """
+        The versions of the project in the mailbox, newest first by Tools.versionKey.
+        refresh: update the index first, otherwise only the projects it has not are searched on the server.
+        """
+        if refresh:
+            self.getAllAvailableEmails(withParts=True)
+        versions = {get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+                    for header_msg in self._indexedEmails(projectName).values() if isFirstPart(header_msg)}
+        return sorted(versions, key=versionKey, reverse=True)
+
+    def getLatestVersion(self, projectName: str, refresh=False) -> Optional[str]:
+        versions = self.getVersions(projectName, refresh)
+        return versions[0] if versions else None
+
+    def loadAvailableEmails(self, batchSize: int = Const.FETCH_BATCH_SIZE, withParts: bool = False
+                            ) -> Iterator[Tuple[int, int, Dict[bytes, email.message.Message]]]:
+        """
+        Like getAllAvailableEmails, but yield (scanned, total, emails) after every FETCH,
+        emails are the ones found since the last yield. The cached ones of the catalog come first.
+        The index is built when the whole mailbox is listed.
+        """
+        self._check()
+        listed = {}
+        if self.catalog is None or self.uidValidity is None:
+            UIDs = self.getAllUid() or ()
+            scanning = self._iterScanEmails(UIDs, batchSize)
+        else:
+            UIDs = self._refreshCatalog()
+            listed.update(self.catalog.getAll())
+            yield 0, len(UIDs), {UID: msg for UID, msg in listed.items() if withParts or isFirstPart(msg)}
+            scanning = self._scanIntoCatalog(UIDs, batchSize)
+        scanned = 0
+        for batch, got in scanning:
+            scanned += len(batch)
+            listed.update((UID, msg) for UID, msg, size, date in got)
+            yield scanned, len(UIDs), {UID: msg for UID, msg, size, date in got if withParts or isFirstPart(msg)}
+        self._setIndex(listed)
+
+    def _updateCatalog(self, batchSize: int) -> Dict[bytes, email.message.Message]:
+        for _ in self._scanIntoCatalog(self._refreshCatalog(), batchSize):
+            pass
+        with span('list.catalog'):
+            return self.catalog.getAll()
+
+    def _refreshCatalog(self) -> Tuple[bytes]:
+        """
+        Drop the catalog if the UIDVALIDITY changed, and forget the emails which were deleted since.
+        return the UIDs which are not scanned yet, newest first.
+        """
+        self.catalog.checkValidity(self.uidValidity)  # UIDVALIDITY 变化时重建
+        UIDs = self.getAllUid() or ()  # 一次 SEARCH ALL 同时得到新邮件和仍然存在的邮件
+        with span('list.catalog'):
+            self.catalog.keepOnly(int(UID) for UID in UIDs)
+        scanned = self.catalog.maxUid
+        return tuple(UID for UID in UIDs if int(UID) > scanned)
+
+    def _scanIntoCatalog(self, UIDs: Tuple[bytes], batchSize: int):
+        """_iterScanEmails, saving every batch into the catalog"""
+        for batch, got in self._iterScanEmails(UIDs, batchSize):
+            with span('list.catalog'):
+                self.catalog.add(catalogEntryOf(*found) for found in got)
+            yield batch, got
+        if UIDs:  # 全部扫描完才记录, 中断后会重新扫描
+            self.catalog.add((), max(int(UID) for UID in UIDs))
+
+    def scanEmails(self, UIDs: Tuple[bytes], batchSize: int = Const.FETCH_BATCH_SIZE):
+        """
+        return [(UID, header Message, size, date)] of the project emails among UIDs, in the order of UIDs.
+        """
+        return [found for batch, got in self._iterScanEmails(UIDs, batchSize) for found in got]
+
+    def _iterScanEmails(self, UIDs: Tuple[bytes], batchSize: int = Const.FETCH_BATCH_SIZE):
+        """yield (UIDs of the batch, scanEmails of the batch) after every FETCH"""
+        batchSize, query = headerQueryOf(batchSize)
+        for start in range(0, len(UIDs), batchSize):
+            batch = UIDs[start:start + batchSize]
+            with span('list.headers', emails=len(batch)) as s:
+                typ, data = self.imapObj.uid('FETCH', b','.join(batch).decode(), query)
+                s.add(sum(len(item[1]) for item in data if isinstance(item, tuple)))
+            with span('list.parse'):
+                got = scannedEmailsOf(batch, data if typ == 'OK' else [])
+            yield batch, got  # 不能在 span 中暂停
 
     def fetch(self, projectName: str, version: str):
         if not projectName:
             raise ValueError('Keyword can not be empty!')
         self._check()
-        target_UID = self.searchFromAvailableEmails(projectName, version)
-        if target_UID:
-            typ, data = self.imapObj.fetch(target_UID, '(BODY[])')
-            if not typ:
-                raise Exception(f'Wrong email, whose data is {data}.')
-            msg = email.message_from_bytes(data[0][1])
-            get = analysisArchive(msg)
-            self.got_files.append(get)
+        parts = self.searchPartsFromAvailableEmails(projectName, version)
+        if parts:
+            base = get_by_msg(parts[0][1], Const.BASE_VERSION_HEADER)
+            if base and not self.hasBase(projectName, base):  # 差量更新需要先取得基础版本
+                self.fetch(projectName, base)
+            self.got_files.append(
+                self.fromCache(*parts[0]) or
+                self.toCache(self.joinParts([self._fetchByUID(self.imapObj, UID, header_msg, reconnect=self._reopen)
+                                               for UID, header_msg in parts]), parts[0][0])
+            )
         else:
             raise FileNotFoundError(f'Can not find the email whose name is {projectName}.')
 
-    def save(self, report=lambda msg: None, overWrite=True):
-        """return the download path."""
-        zip_dir = Const.TEMP_FOLDER_PATH
-        to_path = self.save_path
-        for projectFile in self.got_files:  # type:ProjectArchiveInfo
-            folder_name = f'{projectFile.projectName}{Const.SHOW_SEPARATE}{projectFile.version}'
-            if os.path.exists(os.path.join(to_path, folder_name)):  # 检查是否存在原项目
-                if overWrite:
-                    report(f'"{folder_name}" exists, uninstalling it... \n')
-                    removeFileOrDir(os.path.join(to_path, folder_name))
-                    report(f'Uninstalling "{folder_name}" successfully. \n')
-                else:
-                    report(f'Failed to install "{folder_name}".\n')
-                    raise FileExistsError(f'"{folder_name}" has already exists. Consider to turn overWrite on.')
-            report(f'Installing "{folder_name}"...\n')
-            zip_path = os.path.join(zip_dir, projectFile.filename)
-            makedir(zip_dir)  # 创建临时文件夹
-            z = UnZIPer(zip_path, projectFile.data)
-            z.extractAll(to_path, folder_name)
-            self.temp.append(zip_path)
-            self.temp.append(zip_dir)
-            report(f'Installing "{folder_name} successfully!"\n')
-        self.got_files.clear()
-        return to_path
+    def fetchAll(self, targets: List[Tuple[str, str]], report=lambda msg: None,
+                 available: Dict[bytes, email.message.Message] = None,
+                 fetched=lambda target: None) -> Dict[Tuple[str, str], Exception]:
+        """
+        Fetch several (projectName, version) at the same time through the connection pool,
+        the parts of a split project are fetched at the same time too.
+        The mailbox is only searched once. return the targets that failed and their exceptions.
+        available: the result of getAllAvailableEmails(withParts=True), the index is used if not given.
+            Only the pool is used if it is given, so the mailbox can be scanned meanwhile.
+        fetched: called with (projectName, version) when its archive is ready.
+        """
+        self._check()
+        if self.pool is None:
+            self.pool = IMAPPool(self.poolSize)
+        failed = {}
+        jobs = {}
+        targets = list(targets)
+        for projectName, version in targets:  # 目标可能在循环中增加
+            try:
+                parts = self.searchPartsFromAvailableEmails(projectName, version, available) if projectName else []
+                if not parts:
+                    raise FileNotFoundError(f'Can not find the email whose name is {projectName}.')
+                jobs[projectName, version] = parts
+                base = get_by_msg(parts[0][1], Const.BASE_VERSION_HEADER)
+                if base and not self.hasBase(projectName, base, targets):  # 差量更新需要先取得基础版本
+                    report(f'"{projectName}{Const.SHOW_SEPARATE}{version}" needs version {base}.\n')
+                    targets.append((projectName, base))
+                cached = self.fromCache(*parts[0])
+                if cached:
+                    del jobs[projectName, version]
+                    self.got_files.append(cached)
+                    fetched((projectName, version))
+                    report(f'"{projectName}{Const.SHOW_SEPARATE}{version}" is in the cache.\n')
+            except FileNotFoundError as e:
+                failed[projectName, version] = e
+                report(f'Can not find "{projectName}{Const.SHOW_SEPARATE}{version}".\n')
+        got = {target: [None] * len(parts) for target, parts in jobs.items()}
+        with ThreadPoolExecutor(self.pool.size) as executor:
+            futures = {}
+            for target, parts in jobs.items():
+                for index, (UID, header_msg) in enumerate(parts):
+                    futures[executor.submit(self._fetchInPool, UID, header_msg, report)] = target, index
+            for future in as_completed(futures):
+                target, index = futures[future]
+                if target in failed:
+                    continue
+                try:
+                    got[target][index] = future.result()
+                    if all(got[target]):  # 所有分卷都已下载
+                        self.got_files.append(self.toCache(self.joinParts(got[target]), jobs[target][0][0]))
+                        fetched(target)
+                except Exception as e:
+                    failed[target] = e
+                    report(f'Failed to download "{target[0]}{Const.SHOW_SEPARATE}{target[1]}": {e}\n')
+        return failed
 
-    def clearTempFile(self):
-        for f in self.temp:
-            removeFileOrDir(f)
-        self.temp.clear()
+    def _fetchInPool(self, UID: bytes, header_msg: email.message.Message, report) -> ProjectArchiveInfo:
+        name = partNameOf(header_msg)
+        report(f'Downloading "{name}"...\n')
+        start = time.time()
+        with self.pool.connection() as conn:
+            get = self._fetchByUID(conn, UID, header_msg, report, self.pool.reopen)
+        report(f'Downloaded "{name}" ({os.path.getsize(get.path)} bytes in {time.time() - start:.1f}s).\n')
+        return get
+
+    def _reopen(self, broken: imaplib.IMAP4) -> imaplib.IMAP4:
+        """log in again in place of the broken main connection"""
+        try:
+            broken.shutdown()
+        except OSError:
+            pass
+        self.imapObj = IMAPPool._connect()
+        return self.imapObj
+
+    def _fetchByUID(self, imapObj: imaplib.IMAP4, target_UID: bytes, header_msg: email.message.Message,
+                    report=None, reconnect=None) -> ProjectArchiveInfo:
+        """
+        Download only the archive part of the email, in ranged pieces,
+        decoding them straight into a file under the temp folder.
+        The progress is saved under Const.PARTIAL_PATH after every piece, an interrupted download goes on from there.
+        header_msg: the header Message of the email from getAllAvailableEmails.
+        reconnect: called with the broken connection when the connection drops, returns a new one.
+            The download fails at once if it is not given.
+        """
+        projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True)
+        version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+        UID = target_UID.decode()
+
+        def command(*args):
+            """imapObj.uid, connecting again when the connection drops"""
+            nonlocal imapObj
+            failures = 0
+            while True:
+                try:
+                    return imapObj.uid(*args)
+                except (imaplib.IMAP4.abort, OSError) as e:
+                    failures += 1
+                    if reconnect is None or failures > Const.FETCH_RETRIES:
+                        raise
+                    if report:
+                        report(f'Connection lost ({e}), reconnecting {failures}/{Const.FETCH_RETRIES}...\n')
+                    time.sleep(Const.RECONNECT_DELAY * failures)
+                    try:
+                        imapObj = reconnect(imapObj)
+                    except (imaplib.IMAP4.error, OSError):
+                        continue  # 还连不上, 下一次再试
+                    if uidValidityOf(imapObj) != self.uidValidity:
+                        raise FileNotFoundError('The mailbox has changed, list it again.')
+
+        with span('fetch.structure'):
+            typ, data = command('FETCH', UID, '(BODYSTRUCTURE)')
+        if not typ == 'OK':
+            raise Exception(f'Wrong email, whose data is {data}.')
+        if data[0] is None:  # 邮件已被删除
+            if self.catalog is not None:
+                self.catalog.remove(int(target_UID))
+            removeFromIndex(self.index, target_UID)
+            raise FileNotFoundError(f'The email of {projectName} has been removed.')
+        part = findArchivePart(bodyStructureOf(data))
+        if not part:
+            raise FileNotFoundError(f'The email of {projectName} contains no archive.')
+        section, encoding, size, filename = part
+        name = partNameOf(header_msg)
+        makedir(Const.TEMP_FOLDER_PATH)
+        path = os.path.join(Const.TEMP_FOLDER_PATH, name + '.zip')
+        self.temp.append(path)
+        partial = PartialDownload(Const.PARTIAL_PATH, self.uidValidity, UID, section, size)
+        if partial.resume() and report:
+            report(f'Resuming "{name}" from {partial.offset * 100 // max(1, size)}%.\n')
+        with span('fetch', part=name, size=size) as total, partial:
+            out = Base64StreamDecoder(partial, partial.rest) if encoding == 'BASE64' else partial
+            offset = partial.offset
+            shown = offset * 10 // max(1, size)
+            while offset < size:
+                with span('fetch.body') as s:
+                    typ, data = command('FETCH', UID, f'(BODY.PEEK[{section}]<{offset}.{Const.FETCH_CHUNK_SIZE}>)')
+                    chunk = next((literal for _, literal, _ in iterFetchResponse(data)), b'') if typ == 'OK' else b''
+                    s.add(len(chunk))
+                if not chunk:  # 不完整的压缩包不能移过去, 保留进度以后继续
+                    raise ValueError(f'"{name}" stopped at {offset} of {size} bytes, download it again to go on.')
+                out.write(chunk)
+                total.add(len(chunk))
+                offset += len(chunk)
+                partial.checkpoint(offset, out.pending if encoding == 'BASE64' else b'')
+                if report and offset * 10 // size > shown:  # 每 10% 报告一次
+                    shown = offset * 10 // size
+                    report(f'"{name}" {min(shown * 10, 100)}%\n')
+            if encoding == 'BASE64':
+                out.close()
+        partial.finish(path)
+        partHash = get_by_msg(header_msg, Const.PART_HASH_HEADER)
+        if partHash and not self._verify(path, partHash):
+            raise ValueError(f'"{name}" is broken, its hash does not match.')
+        return ProjectArchiveInfo(filename or name + '.zip', projectName, version, path=path,
+                                  archiveHash=get_by_msg(header_msg, Const.ARCHIVE_HASH_HEADER),
+                                  baseVersion=get_by_msg(header_msg, Const.BASE_VERSION_HEADER))
+
+    def repair(self, projectName: str, version: str, report=lambda msg: None, removeExtra=False,
+               result: VerifyResult = None, available: Dict[bytes, email.message.Message] = None) -> VerifyResult:
+        """
+        Put back the damaged files of an installed project, only they are extracted from its archive,
+        which is taken from the cache or downloaded.
+        result: what verifyProject found, the project is verified first if it is not given.
+        available: see fetchAll, give it when another thread may be using the main connection.
+        return the result of verifying the project again.
+        """
+        folder_name = f'{projectName}{Const.SHOW_SEPARATE}{version}'
+        if not os.path.isdir(os.path.join(self.save_path, folder_name)):
+            raise FileNotFoundError(f'"{folder_name}" is not installed.')
+        if result is None:
+            result = verifyProject(projectName, version, folder=self.save_path)
+        if result.intact and not (removeExtra and result.extra):
+            return result
+        archive = None
+        got = []  # type: List[ProjectArchiveInfo]
+        if result.error is not None or result.damaged:
+            report(f'Getting the archive of "{folder_name}"...\n')
+            before = len(self.got_files)
+            failed = self.fetchAll([(projectName, version)], report, available)
+            got = self.got_files[before:]
+            del self.got_files[before:]  # 不要在 save 时安装
+            if (projectName, version) in failed:
+                raise failed[projectName, version]
+            archive = next(f.path for f in got if f.projectName == projectName and f.version == version)
+        try:
+            if result.error is not None:  # 没有 manifest, 和压缩包中的 CRC 对照
+                result = verifyProject(projectName, version, archive, folder=self.save_path)
+                if result.error is not None:
+                    raise FileNotFoundError(result.error)
+            if result.damaged:
+                report(f'Repairing {len(result.damaged)} files of "{folder_name}"...\n')
+            with span('verify.repair', project=folder_name, files=len(result.damaged)):
+                left = repairProject(result, archive, removeExtra)
+            if left:
+                report(f'{len(left)} files of "{folder_name}" can not be repaired: {", ".join(left)}\n')
+            return verifyProject(projectName, version, archive, folder=self.save_path)
+        finally:
+            for f in got:
+                if f.path in self.temp:  # 没有缓存时用完就删
+                    removeFileOrDir(f.path)
+                    self.temp.remove(f.path)
+            self.releaseCache([f.path for f in got])
 
     def close(self):
+        self.waitRemoving()
         if self._alive:
             self._alive = False
             self.clearTempFile()
+            if self.pool is not None:
+                self.pool.close()
             self.imapObj.close()
             self.imapObj.logout()
 
@@ -294,34 +1493,149 @@ class Downloader:
         self.close()
 
 
+class MappedArchive:
+    """
+    Read-only file object over a memory-mapped archive.
+    mmap itself can not be given to zipfile, which wants seekable().
+    """
+
+    def __init__(self, path: str = None, mapping: mmap.mmap = None):
+        self._file = None
+        if mapping is None:
+            self._file = open(path, 'rb')
+            try:
+                mapping = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):  # 空文件无法映射
+                self._file.close()
+                raise
+        self._map = mapping
+
+    def read(self, size: int = -1) -> bytes:
+        return self._map.read(size if size is not None and size >= 0 else None)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self) -> int:
+        return self._map.tell()
+
+    @staticmethod
+    def seekable():
+        return True
+
+    def close(self):
+        if self._file is not None:  # 调用者传入的 mmap 由调用者关闭
+            self._map.close()
+            self._file.close()
+            self._file = None
+
+
 class UnZIPer:
     def __init__(
             self,
-            zipFile: str,
+            zipFile: Union[str, bytes, bytearray, memoryview, mmap.mmap, io.IOBase],
             content: bytes = None,
+            useMmap: bool = True,
     ):
-        self.zip_path = zipFile
+        """
+        zipFile: the path of the archive, or the archive itself in a buffer, a mmap or a file object.
+        content: the archive in memory, kept there instead of being written to zipFile.
+        useMmap: map the archive at zipFile into memory instead of reading it.
+        """
+        self.zip_path = zipFile if isinstance(zipFile, str) else None
         if content:
-            with open(self.zip_path, 'wb') as w:
-                w.write(content)
-        self.content = self.readArchive()
+            self._source = io.BytesIO(content)
+        elif isinstance(zipFile, (bytes, bytearray, memoryview)):
+            self._source = io.BytesIO(zipFile)
+        elif isinstance(zipFile, mmap.mmap):
+            self._source = MappedArchive(mapping=zipFile)
+        elif self.zip_path is None:
+            self._source = zipFile
+        elif not os.path.exists(self.zip_path):
+            raise FileNotFoundError(f'Can not find "{self.zip_path}".')
+        elif useMmap and os.path.getsize(self.zip_path):
+            self._source = MappedArchive(self.zip_path)
+        else:
+            self._source = None  # 由 zipfile 直接打开
+
+    @property
+    def content(self) -> bytes:
+        """read only when asked, the archive can be much bigger than the memory"""
+        return self.readArchive()
+
+    def _open(self) -> zipfile.ZipFile:
+        return zipfile.ZipFile(self.zip_path if self._source is None else self._source, 'r')
+
+    def readManifest(self) -> Optional[dict]:
+        """the manifest recorded by Uploader, None for archives without one"""
+        with self._open() as z:
+            if Const.MANIFEST_NAME not in z.NameToInfo:
+                return None
+            return json.loads(z.read(Const.MANIFEST_NAME).decode('utf-8'))
+
+    def namelist(self) -> List[str]:
+        with self._open() as z:
+            return z.namelist()
 
     def readArchive(self):
+        if self._source is not None:
+            self._source.seek(0)
+            return self._source.read()
         if not os.path.exists(self.zip_path):
             raise FileNotFoundError(f'Can not find "{self.zip_path}".')
         with open(self.zip_path, 'rb') as r:
             return r.read()
 
     def extractAll(self, to_path: str, dirName: str = None):
-        z = zipfile.ZipFile(self.zip_path, 'r')
+        z = self._open()
         # extract to one folder
         if countTopFolderInZIP(z) > 1 or dirName:
-            zipName = dirName if dirName else os.path.splitext(os.path.split(self.zip_path)[-1])[0]
+            zipName = dirName if dirName else os.path.splitext(os.path.split(self.zip_path or 'archive')[-1])[0]
             to_path = os.path.join(to_path, zipName)
         makedir(to_path)
-        z.extractall(to_path)
+        with span('extract', files=len(z.infolist())) as s:
+            s.add(sum(info.file_size for info in z.infolist()))
+            z.extractall(to_path)
         z.close()
 
+    def extractChanged(self, to_path: str, existing: str = None) -> Tuple[int, int]:
+        """
+        Extract every member into to_path. The files under `existing` which have the same size and CRC
+        as the member are linked (or copied) instead of being extracted again.
+        return (the number of extracted files, the number of reused files)
+        """
+        written = reused = 0
+        makedir(to_path)
+        with self._open() as z, span('extract', files=len(z.infolist())) as s:
+            for info in z.infolist():
+                if info.is_dir():
+                    makedir(safeJoin(to_path, info.filename))
+                    continue
+                old = safeJoin(existing, info.filename) if existing else None
+                if old and sameAsMember(old, info):
+                    path = safeJoin(to_path, info.filename)
+                    makedir(os.path.dirname(path))
+                    linkOrCopy(old, path)
+                    reused += 1
+                else:
+                    z.extract(info, to_path)
+                    s.add(info.file_size)
+                    written += 1
+            s.set(reused=reused)
+        return written, reused
+
+    def close(self):
+        if isinstance(self._source, (MappedArchive, io.BytesIO)):
+            self._source.close()
+        self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 def testUpload():
     Const.PASSWORD = ''
@@ -0,0 +1,106 @@
+# coding=utf-8
+import os
+import json
+import time
+import zlib
+from typing import Optional
+import src.Constant as Const
+from src.Tools import makedir, crcFile
+
+
+class PartialDownload:
+    """
+    An archive which is being downloaded, with its progress saved beside it after every chunk,
+    so the download goes on from there after the connection drops or the program restarts.
+    Keyed by UIDVALIDITY and UID, nothing is resumed once the UIDVALIDITY of the mailbox changed.
+    Write the decoded data into it, then checkpoint.
+    """
+
+    def __init__(self, folder: str, uidValidity: Optional[str], UID: str, section: str, size: int):
+        """uidValidity: None if the server did not tell it, then the progress is never saved"""
+        self.folder = folder
+        self.key = f'{uidValidity}-{UID}'
+        self.dataPath = os.path.join(folder, self.key + '.part')
+        self.statePath = os.path.join(folder, self.key + '.json')
+        self.persistent = uidValidity is not None
+        self.section = section
+        self.size = size
+        self.offset = 0  # 已经取得的编码后的字节数
+        self.written = 0  # 已经写入的解码后的字节数
+        self.rest = b''  # 还没有解码的 base64, 不足 4 个字节
+        self.crc = 0  # 已写入内容的 CRC32, 继续下载前用来校验
+        self._file = None
+
+    def resume(self) -> bool:
+        """load the saved progress if the data on disk still matches it, otherwise start from zero"""
+        if not self.persistent or not os.path.isfile(self.statePath):
+            return False
+        try:
+            with open(self.statePath, encoding='utf-8') as r:
+                state = json.load(r)
+            if state['section'] != self.section or state['size'] != self.size or \
+                    os.path.getsize(self.dataPath) < state['written']:
+                raise ValueError('The saved progress does not match.')
+            if crcFile(self.dataPath, 0, state['written']) != state['crc']:
+                raise ValueError('The downloaded data is broken.')
+        except (OSError, ValueError, KeyError, TypeError):
+            self.discard()
+            return False
+        self.offset, self.written, self.crc = state['offset'], state['written'], state['crc']
+        self.rest = state['rest'].encode('ascii')
+        return True
+
+    def __enter__(self) -> 'PartialDownload':
+        makedir(self.folder)
+        self._file = open(self.dataPath, 'r+b' if self.written else 'wb')
+        self._file.seek(self.written)
+        self._file.truncate()  # 丢掉最后一次保存进度之后写入的内容
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+        self._file = None
+
+    def write(self, data: bytes) -> int:
+        self.crc = zlib.crc32(data, self.crc)
+        self.written += len(data)
+        return self._file.write(data)
+
+    def checkpoint(self, offset: int, rest: bytes = b''):
+        """record that everything before offset is written, rest is the base64 the decoder still keeps"""
+        self.offset, self.rest = offset, rest
+        if not self.persistent:
+            return
+        self._file.flush()
+        temp = self.statePath + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as w:
+            json.dump({'section': self.section, 'size': self.size, 'offset': offset, 'written': self.written,
+                       'crc': self.crc, 'rest': rest.decode('ascii')}, w)
+        os.replace(temp, self.statePath)  # 进度文件要么是旧的要么是新的, 不会写坏
+
+    def finish(self, path: str):
+        """move the finished archive to path and forget the progress"""
+        os.replace(self.dataPath, path)
+        self.discard()
+
+    def discard(self):
+        for path in (self.dataPath, self.statePath):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def sweepPartials(folder: str = Const.PARTIAL_PATH, uidValidity: str = None,
+                  maxAge: float = Const.PARTIAL_MAX_AGE):
+    """remove the downloads of another UIDVALIDITY and the ones not touched for maxAge seconds"""
+    if not os.path.isdir(folder):
+        return
+    now = time.time()
+    for entry in os.scandir(folder):
+        try:
+            if (uidValidity is not None and not entry.name.startswith(f'{uidValidity}-')) or \
+                    now - entry.stat().st_mtime > maxAge:
+                os.remove(entry.path)
+        except OSError:
+            pass
@@ -0,0 +1,321 @@
+# coding=utf-8
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional
+import src.Constant as Const
+from src.emails.EmailManager import Downloader, get_by_msg
+from src.emails.Catalog import MailCatalog
+from src.emails.Cache import ArchiveCache
+from src.Tools import decode, deleteProject, checkProjectExists, installedProjects, versionKey, \
+    verifyProjects, sweepTombstones
+from src.interaction.UserFacer import hasUserMsg, getPasswordFromCache
+from src.Trace import tracer
+from src.Supervisor import ProcessSupervisor
+
+output = sys.stdout  # 结果输出到这里, 其他信息都输出到 stderr
+
+
+def emit(**result):
+    """print one result as a JSON line"""
+    output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    output.flush()
+
+
+def log(msg: str):
+    sys.stderr.write(msg if msg.endswith('\n') else msg + '\n')
+
+
+def parseSpec(spec: str) -> Tuple[str, Optional[str]]:
+    """"project@version" => (project, version), the version is None if it is not given"""
+    projectName, separate, version = spec.partition(Const.SPEC_SEPARATE)
+    return projectName, version if separate and version else None
+
+
+def readSpecFile(path: str) -> List[str]:
+    """a JSON list of specs or of {"project", "version"}, or one spec per line, "#" starts a comment"""
+    with open(path, encoding='utf-8') as r:
+        text = r.read()
+    if text.lstrip().startswith('['):
+        return [item if isinstance(item, str) else
+                item['project'] + (Const.SPEC_SEPARATE + item['version'] if item.get('version') else '')
+                for item in json.loads(text)]
+    return [line.split('#')[0].strip() for line in text.splitlines() if line.split('#')[0].strip()]
+
+
+def applyPassword(code: str = None):
+    """the password is taken from the argument, the environment variable, or the one the GUI saved"""
+    code = code or os.environ.get(Const.PASSWORD_ENV) or (getPasswordFromCache() if hasUserMsg() else None)
+    if not code:
+        raise ValueError(f'No password, give --password or set {Const.PASSWORD_ENV}.')
+    Const.PASSWORD = decode(code)
+
+
+def openDownloader(jobs: int = Const.POOL_SIZE) -> Downloader:
+    downloader = Downloader(catalog=MailCatalog(Const.CATALOG_PATH), poolSize=jobs,
+                            cache=ArchiveCache(Const.CACHE_PATH))
+    downloader.login()
+    return downloader
+
+
+def closeDownloader(downloader: Downloader):
+    downloader.close()
+    downloader.catalog.close()
+
+
+def install(args) -> bool:
+    specs = list(args.specs) + (readSpecFile(args.file) if args.file else [])
+    downloader = openDownloader(args.jobs)
+    success = True
+    try:
+        targets = []
+        for spec in specs:
+            projectName, version = parseSpec(spec)
+            if version is None:  # 没有版本时安装最新版本
+                version = downloader.getLatestVersion(projectName)
+                if version is None:
+                    emit(command='install', project=projectName, version=None, ok=False,
+                         error=f'Can not find the project "{projectName}".')
+                    success = False
+                    continue
+            if not args.overwrite and checkProjectExists(projectName, version):
+                emit(command='install', project=projectName, version=version, ok=True, skipped=True)
+                continue
+            if (projectName, version) not in targets:
+                targets.append((projectName, version))
+        start = time.time()
+        fetched = {}
+        installed = {}
+        failed = downloader.fetchAll(targets, log, fetched=lambda target: fetched.__setitem__(
+            target, time.time() - start))
+        error = None
+        try:
+            downloader.save(log, incremental=not args.full, precompile=args.compile,
+                            installed=lambda projectFile, seconds: installed.__setitem__(
+                                (projectFile.projectName, projectFile.version), seconds))
+        except Exception as e:  # 之后的项目没有安装
+            error = e
+        finally:
+            downloader.clearTempFile()
+        for target in targets + [target for target in installed if target not in targets]:  # 包括差量更新的基础版本
+            ok = target in installed
+            success = success and ok
+            emit(command='install', project=target[0], version=target[1], ok=ok,
+                 dependency=target not in targets,
+                 download_seconds=round(fetched[target], 3) if target in fetched else None,
+                 install_seconds=round(installed[target], 3) if ok else None,
+                 error=None if ok else f'{failed.get(target) or error or "Not installed."}')
+    finally:
+        closeDownloader(downloader)
+    return success
+
+
+def listProjects(args) -> bool:
+    downloader = openDownloader(1)
+    try:
+        versions = {}
+        for UID, header_msg in downloader.getAllAvailableEmails().items():
+            versions.setdefault(get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True), set()).add(
+                get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True))
+    finally:
+        closeDownloader(downloader)
+    for projectName in sorted(versions, key=str.lower):
+        if args.projects and projectName not in args.projects:
+            continue
+        ordered = sorted(versions[projectName], key=versionKey, reverse=True)
+        emit(command='list', project=projectName, latest=ordered[0],
+             versions=ordered if args.all else ordered[:1],
+             installed=installedProjects.versionsOf(projectName))
+    return True
+
+
+def delete(args) -> bool:
+    def deleteOne(projectName: str, version: str):
+        start = time.time()
+        removed = {}
+        deleteProject(projectName, version, ask=False, progress=lambda path, count: removed.__setitem__(path, count))
+        return time.time() - start, sum(removed.values())
+
+    success = True
+    jobs = {}
+    with ThreadPoolExecutor(args.jobs) as executor:  # 每个项目内部也并行删除
+        for spec in args.specs:
+            projectName, version = parseSpec(spec)
+            if version is None or not checkProjectExists(projectName, version):
+                emit(command='delete', project=projectName, version=version, ok=False,
+                     error=f'"{spec}" is not installed, give the version as project{Const.SPEC_SEPARATE}version.')
+                success = False
+                continue
+            jobs[projectName, version] = executor.submit(deleteOne, projectName, version)
+        for (projectName, version), future in jobs.items():
+            try:
+                seconds, files = future.result()
+                emit(command='delete', project=projectName, version=version, ok=True,
+                     seconds=round(seconds, 3), files=files)
+            except Exception as e:
+                success = False
+                emit(command='delete', project=projectName, version=version, ok=False, error=f'{e}')
+    return success
+
+
+def run(args) -> bool:
+    success = True
+    exited = queue.Queue()
+    supervisor = ProcessSupervisor(args.sample or Const.SAMPLE_INTERVAL, exited.put)
+    started = []
+    for spec in args.specs:
+        projectName, version = parseSpec(spec)
+        if version is None:  # 没有版本时运行已安装的最新版本
+            versions = installedProjects.versionsOf(projectName)
+            version = versions[0] if versions else None
+        try:
+            if version is None:
+                raise FileNotFoundError(f'"{projectName}" is not installed.')
+            # 项目的输出不能混进标准输出的 JSON 行
+            running = supervisor.launch(projectName, version, stdout=sys.stderr, stderr=sys.stderr)
+        except Exception as e:
+            success = False
+            emit(command='run', project=projectName, version=version, ok=False, error=f'{e}')
+            continue
+        started.append(running)
+        emit(command='run', project=projectName, version=version, ok=True, pid=running.pid)
+    if not args.wait:
+        supervisor.close()
+        return success
+    left = len(started)
+    while left:
+        try:
+            running = exited.get(timeout=args.sample)
+        except queue.Empty:  # 每隔 --sample 秒输出一次运行中项目的占用
+            for running in supervisor.running():
+                emit(command='sample', ok=True, **running.toDict())
+            continue
+        left -= 1
+        success = success and running.returncode == 0
+        emit(command='exit', ok=running.returncode == 0, **running.toDict())
+    return success
+
+
+def verify(args) -> bool:
+    targets = []
+    for spec in args.specs:
+        projectName, version = parseSpec(spec)
+        versions = [version] if version is not None else installedProjects.versionsOf(projectName)
+        if not versions:
+            versions = [None]
+        targets.extend((projectName, version) for version in versions)
+    if not args.specs:  # 校验所有已安装的项目
+        targets = installedProjects.projects()
+    start = time.time()
+    results = verifyProjects([target for target in targets if target[1] is not None], workers=args.jobs)
+    log(f'Verified {len(results)} projects, {sum(result.bytes for result in results)} bytes '
+        f'in {time.time() - start:.1f}s.')
+    success = all(version is not None for projectName, version in targets)
+    for projectName, version in targets:
+        if version is None:
+            emit(command='verify', project=projectName, version=None, ok=False,
+                 error=f'"{projectName}" is not installed.')
+    damaged = [result for result in results if not result.intact or (args.remove_extra and result.extra)]
+    for result in results:
+        if args.repair and result in damaged:  # 修复后再输出
+            continue
+        success = success and result.intact
+        emit(command='verify', ok=result.intact, **result.toDict())
+    if args.repair and damaged:
+        applyPassword(args.password)
+        downloader = openDownloader(1)
+        try:
+            for result in damaged:
+                try:
+                    after = downloader.repair(result.projectName, result.version, log, args.remove_extra, result)
+                except Exception as e:
+                    success = False
+                    emit(command='verify', ok=False, repaired=False, **dict(result.toDict(), error=f'{e}'))
+                    continue
+                success = success and after.intact
+                emit(command='verify', ok=after.intact, **after.toDict(), repaired=True,
+                     was_missing=result.missing, was_modified=result.modified)
+        finally:
+            closeDownloader(downloader)
+    return success
+
+
+def buildParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='Main.py', description='Install, list, delete, run and verify projects without the window. '
+                                    'Every result is printed to stdout as a JSON line.')
+    parser.add_argument('--password', help=f'the password code, or set {Const.PASSWORD_ENV}')
+    parser.add_argument('--trace', nargs='?', const=Const.TRACE_PATH, metavar='PATH',
+                        help=f'time every phase, append the spans to PATH ({Const.TRACE_PATH}) as JSON lines '
+                             f'and print a summary to stderr')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sub = commands.add_parser('install', help='download and install projects')
+    sub.add_argument('specs', nargs='*', metavar='project[@version]', help='the latest version without @version')
+    sub.add_argument('-f', '--file', help='a file of specs, one per line or a JSON list')
+    sub.add_argument('-j', '--jobs', type=int, default=Const.POOL_SIZE, help='downloads at the same time')
+    sub.add_argument('--no-overwrite', dest='overwrite', action='store_false',
+                     help='skip the projects which are installed')
+    sub.add_argument('--full', action='store_true', help='reinstall every file instead of only the changed ones')
+    sub.add_argument('--no-compile', dest='compile', action='store_false',
+                     help='do not byte-compile the installed projects')
+    sub.set_defaults(function=install, login=True)
+
+    sub = commands.add_parser('list', help='list the projects in the mailbox')
+    sub.add_argument('projects', nargs='*', metavar='project', help='only these projects')
+    sub.add_argument('-a', '--all', action='store_true', help='every version, not only the latest')
+    sub.set_defaults(function=listProjects, login=True)
+
+    sub = commands.add_parser('delete', help='delete installed projects')
+    sub.add_argument('specs', nargs='+', metavar='project@version')
+    sub.add_argument('-j', '--jobs', type=int, default=Const.POOL_SIZE, help='projects deleted at the same time')
+    sub.set_defaults(function=delete, login=False)
+
+    sub = commands.add_parser('run', help='run installed projects')
+    sub.add_argument('specs', nargs='+', metavar='project[@version]', help='the latest installed without @version')
+    sub.add_argument('-w', '--wait', action='store_true', help='wait for them to exit')
+    sub.add_argument('--sample', type=float, metavar='SECONDS',
+                     help='with --wait, print the CPU and memory of the running projects every SECONDS')
+    sub.set_defaults(function=run, login=False)
+
+    sub = commands.add_parser('verify', help='check the installed files against the manifests or the archives')
+    sub.add_argument('specs', nargs='*', metavar='project[@version]',
+                     help='every installed version without @version, every installed project without specs')
+    sub.add_argument('-j', '--jobs', type=int, default=Const.VERIFY_WORKERS, help='files hashed at the same time')
+    sub.add_argument('--repair', action='store_true',
+                     help='put back the missing and modified files from the archives, needs to log in')
+    sub.add_argument('--remove-extra', action='store_true', help='with --repair, also delete the files '
+                                                                 'which do not belong to the projects')
+    sub.set_defaults(function=verify, login=False)
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """return 0 if every project succeeded, 1 if some failed, 2 if nothing could be done"""
+    args = buildParser().parse_args(argv)
+    tracer.enabled = tracer.enabled or bool(args.trace)
+    mark = tracer.mark()
+    with contextlib.redirect_stdout(sys.stderr):  # 保证 stdout 中只有结果
+        sweeping = sweepTombstones(Const.SAVE_PATH)  # 清理上次未删除完的项目, 退出前等待
+        try:
+            if args.login:
+                applyPassword(args.password)
+            return 0 if args.function(args) else 1
+        except Exception as e:
+            emit(command=args.command, ok=False, error=f'{e}')
+            return 2
+        finally:
+            for thread in sweeping:
+                thread.join()
+            if tracer.enabled:
+                log(tracer.summaryText(mark))
+                tracer.export(args.trace or Const.TRACE_PATH, mark)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
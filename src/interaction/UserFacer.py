@@ -1,15 +1,24 @@
 # coding=utf-8
 import os
+import bisect
+import queue
 import threading
 import time
 import tkinter as tk
 import tkinter.messagebox as tkmsg
-from typing import List, Dict
-from src.emails.EmailManager import Downloader, get_by_msg
-from src.Tools import decode, showException, checkProjectRunnable, runProject, deleteProject, checkProjectExists
+import tkinter.ttk as ttk
+import traceback as tb
+from typing import List, Dict, Set, Tuple
+from src.emails.EmailManager import Downloader, get_by_msg, isFirstPart
+from src.emails.Catalog import MailCatalog
+from src.emails.Cache import ArchiveCache
+from src.Tools import decode, showException, checkProjectRunnable, checkProjectExists, \
+    deleteProjects, sweepTombstones, versionKey, verifyProjects, VerifyResult
+from src.Trace import tracer
+from src.Supervisor import ProcessSupervisor
 import src.Constant as Const
 import json
-import subprocess
+import email.message
 
 
 def destroy(widget):
@@ -22,6 +31,19 @@ def destroy(widget):
         pass
 
 
+def describeVerify(result: VerifyResult) -> str:
+    """校验结果的说明"""
+    name = f'{result.projectName}{Const.SHOW_SEPARATE}{result.version}'
+    if result.error is not None:
+        return f'"{name}" 无法校验: {result.error}\n'
+    lines = [f'"{name}" 检查了{result.checked}个文件, ' +
+             ('完好' if result.intact else f'缺少{len(result.missing)}个, 被修改{len(result.modified)}个') +
+             (f', 多出{len(result.extra)}个' if result.extra else '') + '\n']
+    lines.extend(f'    缺少 {path}\n' for path in result.missing)
+    lines.extend(f'    被修改 {path}\n' for path in result.modified)
+    return ''.join(lines)
+
+
 def hasUserMsg():
     return os.path.exists(Const.USER_MSG_PATH)
 
@@ -45,19 +67,37 @@ class UserFacer:
     def __init__(self):
         self.alive = True
         self.emails = {}  # 邮箱上对应的应用列表
-        self.selected = {}
-        self.processes = {}  # type: Dict[str, subprocess.Popen]
+        self.available = {}  # 包括各分卷, 下载时使用
+        self.loading = False  # 是否正在后台加载邮箱中的项目
+        self.status = None  # type: tk.Label
+        self.selected = set()  # type: Set[str]  # 选中的项目, 搜索时隐藏的也保留
+        self.versions = {}  # type: Dict[str, List[str]]  # 项目名 -> 版本, 新版本在前
+        self.shown = set()  # type: Set[str]  # 列表中显示的项目
+        self.folded = {}  # type: Dict[str, List[str]]  # 折叠起来还没加入列表的旧版本
+        self.tops = {}  # type: Dict[str, str]  # 项目名 -> 列表中它最上层的行
+        self.topKeys = []  # type: List[str]  # 最上层各行的排序依据, 加载时按它插入新项目
+        self.tree = None  # type: ttk.Treeview
+        self.search = None  # type: tk.StringVar
+        self.showAll = None  # type: tk.BooleanVar
+        self._fillTask = None
+        self._loader = None  # type: threading.Thread
+        self._stopLoading = threading.Event()
+        self.supervisor = ProcessSupervisor()
+        self.running = set()  # type: Set[Tuple[str, str]]  # 上次检查时运行中的项目
+        self._watchTask = None
         self.downloadTargets: List[str] = []
         self.root = tk.Tk()
         self.root.title('Azazo软件管理')
         self.topFrame = None
-        self.downloader = Downloader()
+        sweepTombstones(Const.SAVE_PATH)  # 清理上次未删除完的项目
+        self.downloader = Downloader(catalog=MailCatalog(Const.CATALOG_PATH), cache=ArchiveCache(Const.CACHE_PATH))
         if not self.checkPassword():
             self.alive = False
 
     def applyPassword(self, pwd: str):
         Const.PASSWORD = decode(pwd)  # 解密得到邮箱密码
         self.initDownloader()
+        self.loadPackages()
         self.packAvailablePackage()
 
     def askForPassword(self):
@@ -80,9 +120,9 @@ class UserFacer:
             if not confirm:
                 pwd.set('')
                 cancel[0] = True
-            alive[0] = False
+            done.set(True)
 
-        alive = [True]
+        done = tk.BooleanVar()
         cancel = [False]
         self.root.title('Azazo软件管理')
         self.root.protocol('WM_DELETE_WINDOW', lambda *a: over(False))
@@ -106,8 +146,7 @@ class UserFacer:
         tk.Checkbutton(frame, text='保存密码', variable=save).pack(side=tk.LEFT)
         tk.Checkbutton(frame, text='显示密码', command=toggleShowing, variable=show).pack(side=tk.LEFT)
 
-        while alive[0]:
-            self.root.update()
+        self.root.wait_variable(done)  # 等待时照常处理事件, 不占用CPU
         return pwd.get(), cancel[0], save.get()
 
     def checkPassword(self):
@@ -146,11 +185,14 @@ class UserFacer:
         self.check()
         if self.downloader.imapObj.state != 'SELECTED':
             self.downloader.login()
-        self.getAvailablePackages()
 
     def refresh(self):
         # 刷新项目
-        self.getAvailablePackages()
+        if self.loading:
+            return
+        self.emails = {}
+        self.available = {}
+        self.loadPackages()
         self.packAvailablePackage()
 
     def changeNewTopFrame(self):
@@ -160,54 +202,79 @@ class UserFacer:
         self.topFrame.pack(expand=True, fill=tk.BOTH)
         return self.topFrame
 
-    def getAvailablePackages(self):
-        self.emails = self.downloader.getAllAvailableEmails()
+    def loadPackages(self):
+        """在后台加载邮箱中的项目, 每加载一批就加入列表"""
+        self.check()
+        self.loading = True
+        progress = queue.Queue()  # 加载线程 -> 窗口, None 表示加载结束
+
+        def work():
+            try:
+                for batch in self.downloader.loadAvailableEmails(withParts=True):
+                    if self._stopLoading.is_set():  # 窗口关闭了, 不再使用目录
+                        break
+                    progress.put(batch)
+            except Exception:
+                progress.put(tb.format_exc())
+            progress.put(None)
+
+        self._loader = threading.Thread(target=work, daemon=True)
+        self._loader.start()
+        self.root.after(Const.PROGRESS_INTERVAL, self.drainLoading, progress)
+
+    def drainLoading(self, progress: queue.Queue):
+        if not self.alive:
+            return
+        while True:
+            try:
+                item = progress.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.loading = False
+                self.selected &= {p + Const.CODE_SEPARATE + v for p, versions in self.versions.items() for v in versions}
+                if not self.emails:
+                    self.packAvailablePackage()
+                else:
+                    self.status['text'] = f'共{len(self.versions)}个项目'
+                return
+            if isinstance(item, str):
+                showException('加载失败', attach=item)
+                continue
+            scanned, total, emails = item
+            self.available.update(emails)
+            first = {UID: msg for UID, msg in emails.items() if isFirstPart(msg)}
+            self.emails.update(first)
+            for projectName in self.addVersions(first):  # 只加入新的行, 不重建列表
+                self.updateProjectRows(projectName)
+            self.status['text'] = f'正在加载 {scanned}/{total}'
+        self.root.after(Const.PROGRESS_INTERVAL, self.drainLoading, progress)
+
+    def addVersions(self, emails: Dict[bytes, email.message.Message]) -> Set[str]:
+        """return the projects which got new versions"""
+        changed = set()
+        for UID, header_msg in emails.items():
+            projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER, decode=True)
+            version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER, decode=True)
+            versions = self.versions.setdefault(projectName, [])
+            if version not in versions:  # 重复上传的只显示一次
+                versions.append(version)
+                changed.add(projectName)
+        for projectName in changed:
+            self.versions[projectName].sort(key=versionKey, reverse=True)
+        return changed
 
     def packAvailablePackage(self):
         self.check()
+        if self._fillTask is not None:  # 旧的列表不用再刷新了
+            self.root.after_cancel(self._fillTask)
+            self._fillTask = None
         self.changeNewTopFrame()
         tk.Label(self.topFrame,
                  text='选择你要下载的项目',
                  width=60,
-                 ).pack(expand=True, fill=tk.X)
-        for UID, header_msg in self.emails.items():
-            projectName = get_by_msg(header_msg, Const.PROJECT_NAME_HEADER)
-            version = get_by_msg(header_msg, Const.PROJECT_VERSION_HEADER)
-            showName = f'{projectName}{Const.SHOW_SEPARATE}{version}'
-            totalName = f'{projectName}{Const.CODE_SEPARATE}{version}'
-            frame = tk.Frame(self.topFrame)
-            select = tk.BooleanVar()
-            selectButton = tk.Checkbutton(frame, text=showName, variable=select)
-            selectButton.pack(expand=True, fill=tk.BOTH, side=tk.LEFT)
-            self.selected[totalName] = select  # 加入项目选择列表
-            frame.pack(expand=True, fill=tk.BOTH)
-            if checkProjectRunnable(projectName, version):  # 摆放可运行按钮
-                runButton = tk.Button(
-                    frame,
-                    text='运行',
-                    background='green',
-                    foreground='white',
-                )
-                runButton['command'] = lambda p=projectName, v=version, b=runButton: self.runProject(p, v, b)
-                runButton.pack(side=tk.LEFT)
-            if checkProjectExists(projectName, version):
-                openButton = tk.Button(
-                    frame,
-                    text='打开目录',
-                    command=lambda p=projectName, v=version: os.system(
-                        f'start explorer '
-                        f'{os.path.realpath(os.path.join(Const.SAVE_PATH, p + Const.SHOW_SEPARATE + v))}')
-                )
-                openButton.pack(side=tk.LEFT)
-                deleteButton = tk.Button(
-                    frame,
-                    text='删除',
-                    command=lambda p=projectName, v=version:
-                    deleteProject(p, v) or self.refresh()
-                )
-                deleteButton.pack(side=tk.LEFT)
-            self.root.update()
-        if not self.emails:
+                 ).pack(fill=tk.X)
+        if not self.emails and not self.loading:
             frame = tk.Frame(self.topFrame)
             tk.Button(
                 frame,
@@ -216,133 +283,437 @@ class UserFacer:
                 command=lambda: self.close()
             ).pack(expand=True, fill=tk.BOTH)
             frame.pack(expand=True, fill=tk.BOTH)
-        else:
-            frame = tk.Frame(self.topFrame)
-            download = tk.Button(
-                frame,
-                text='下载',
-                command=self.newWindowRetrieve
-            )
-            download.bind('<space>', lambda *a: download['command']())
-            download.pack(side=tk.LEFT)
-            refresh = tk.Button(
-                frame,
-                text='刷新',
-                command=self.refresh
-            )
-            deleteButton = tk.Button(
-                frame,
-                text='删除',
-                command=self.deleteSelectedProjects
-            )
-            deleteButton.pack(side=tk.LEFT)
-            refresh.pack(side=tk.LEFT)
-            frame.pack(expand=True)
+            return
+        self.versions = {}
+        self.addVersions(self.emails)
+
+        frame = tk.Frame(self.topFrame)
+        tk.Label(frame, text='搜索').pack(side=tk.LEFT)
+        self.search = tk.StringVar(value=self.search.get() if self.search is not None else '')  # 刷新时保留搜索内容
+        searchEntry = tk.Entry(frame, textvariable=self.search)
+        searchEntry.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        searchEntry.focus()
+        self.search.trace_add('write', lambda *a: self.delayFillTree())
+        self.showAll = tk.BooleanVar(value=self.showAll.get() if self.showAll is not None else False)
+        tk.Checkbutton(frame, text='显示所有版本', variable=self.showAll, command=self.fillTree).pack(side=tk.LEFT)
+        frame.pack(fill=tk.X)
+
+        # Treeview 只绘制可见的行, 旧版本在展开时才加入
+        frame = tk.Frame(self.topFrame)
+        self.tree = ttk.Treeview(frame, columns=('version', 'state', 'usage'), selectmode='extended', height=20)
+        self.tree.heading('#0', text='项目')
+        self.tree.heading('version', text='版本')
+        self.tree.heading('state', text='状态')
+        self.tree.heading('usage', text='CPU/内存')
+        self.tree.column('version', width=120, stretch=False)
+        self.tree.column('state', width=80, stretch=False)
+        self.tree.column('usage', width=100, stretch=False)
+        scroll = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree['yscrollcommand'] = scroll.set
+        self.tree.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        scroll.pack(side=tk.LEFT, fill=tk.Y)
+        self.tree.bind('<<TreeviewSelect>>', self.onSelect)
+        self.tree.bind('<<TreeviewOpen>>', self.onOpen)
+        self.tree.bind('<Double-1>', lambda *a: self.toggleRunSelected())
+        frame.pack(expand=True, fill=tk.BOTH)
+        self.status = tk.Label(self.topFrame, text='正在加载...' if self.loading else f'共{len(self.versions)}个项目')
+        self.status.pack(fill=tk.X)
+        self.fillTree()
+
+        frame = tk.Frame(self.topFrame)
+        download = tk.Button(
+            frame,
+            text='下载',
+            command=self.newWindowRetrieve
+        )
+        download.bind('<space>', lambda *a: download['command']())
+        download.pack(side=tk.LEFT)
+        tk.Button(
+            frame,
+            text='运行/停止',
+            command=self.toggleRunSelected
+        ).pack(side=tk.LEFT)
+        tk.Button(
+            frame,
+            text='打开目录',
+            command=self.openSelected
+        ).pack(side=tk.LEFT)
+        deleteButton = tk.Button(
+            frame,
+            text='删除',
+            command=self.deleteSelectedProjects
+        )
+        deleteButton.pack(side=tk.LEFT)
+        tk.Button(
+            frame,
+            text='校验',
+            command=self.newWindowVerify
+        ).pack(side=tk.LEFT)
+        refresh = tk.Button(
+            frame,
+            text='刷新',
+            command=self.refresh
+        )
+        refresh.pack(side=tk.LEFT)
+        frame.pack()
+
+    def delayFillTree(self):
+        """输入搜索内容时, 停顿一会儿再刷新列表"""
+        if self._fillTask is not None:
+            self.root.after_cancel(self._fillTask)
+        self._fillTask = self.root.after(Const.SEARCH_DELAY, self.fillTree)
+
+    def fillTree(self):
+        """按搜索内容重新填充列表, 每个项目只显示最新版本, 其他版本折叠在它下面"""
+        self._fillTask = None
+        query = self.search.get().strip().lower()
+        showAll = self.showAll.get()
+        self.tree.delete(*self.tree.get_children())
+        self.shown.clear()
+        self.folded.clear()
+        self.tops.clear()
+        self.topKeys.clear()
+        for projectName in sorted(self.versions, key=str.lower):
+            matched = self.matchedVersions(projectName, query)
+            if not matched:
+                continue
+            latest = self.insertRow('', projectName, matched[0])
+            self.tops[projectName] = latest
+            self.topKeys.append(projectName.lower())
+            if showAll and len(matched) > 1:
+                self.folded[latest] = matched[1:]
+                self.tree.insert(latest, tk.END, iid=latest + Const.CODE_SEPARATE, text='...')  # 展开时替换
+        self.tree.selection_set([name for name in self.selected if name in self.shown])
+
+    def matchedVersions(self, projectName: str, query: str) -> List[str]:
+        return [v for v in self.versions[projectName] if query in f'{projectName}{Const.SHOW_SEPARATE}{v}'.lower()]
+
+    def updateProjectRows(self, projectName: str):
+        """加载到项目的新版本时只更新它的行, 其他行的展开, 选中和滚动位置不变"""
+        if self.tree is None or not self.tree.winfo_exists():
+            return
+        matched = self.matchedVersions(projectName, self.search.get().strip().lower())
+        if not matched:
+            return
+        latest = f'{projectName}{Const.CODE_SEPARATE}{matched[0]}'
+        old = self.tops.get(projectName)
+        opened = False
+        if old is None:  # 新项目按名称插入
+            key = projectName.lower()
+            index = bisect.bisect(self.topKeys, key)
+            self.topKeys.insert(index, key)
+            self.insertRow('', projectName, matched[0], index)
+        elif old != latest:  # 有了更新的版本, 换掉最上层的行
+            opened = self.tree.item(old, 'open')
+            index = self.tree.index(old)
+            self.removeRows(old)
+            self.insertRow('', projectName, matched[0], index)
+        self.tops[projectName] = latest
+        older = matched[1:] if self.showAll.get() else []
+        children = self.tree.get_children(latest)
+        if latest in self.folded:  # 还没展开, 展开时才加入
+            self.folded[latest] = older
+        elif children:  # 已经展开, 按顺序补上新的旧版本
+            for index, version in enumerate(older):
+                if f'{projectName}{Const.CODE_SEPARATE}{version}' not in self.shown:
+                    self.insertRow(latest, projectName, version, index)
+        elif older:
+            self.folded[latest] = older
+            self.tree.insert(latest, tk.END, iid=latest + Const.CODE_SEPARATE, text='...')
+            if opened:  # 原来展开着的仍然展开
+                self.tree.item(latest, open=True)
+                self.unfold(latest)
+        self.tree.selection_add([name for name in self.selected
+                                 if name in self.shown and name.startswith(projectName + Const.CODE_SEPARATE)])
+
+    def removeRows(self, top: str):
+        """remove a top row with its children"""
+        for child in self.tree.get_children(top):
+            self.shown.discard(child)
+        self.shown.discard(top)
+        self.folded.pop(top, None)
+        self.tree.delete(top)
+
+    def insertRow(self, parent: str, projectName: str, version: str, index=tk.END) -> str:
+        totalName = f'{projectName}{Const.CODE_SEPARATE}{version}'
+        self.tree.insert(parent, index, iid=totalName, text=projectName,
+                         values=(version, self.stateOf(projectName, version), self.usageOf(projectName, version)))
+        self.shown.add(totalName)
+        return totalName
+
+    def onOpen(self, *args):
+        self.unfold(self.tree.focus())
+
+    def unfold(self, latest: str):
+        """展开项目时才加入它的旧版本"""
+        if latest not in self.folded:
+            return
+        self.tree.delete(latest + Const.CODE_SEPARATE)
+        projectName = latest.split(Const.CODE_SEPARATE)[0]
+        for version in self.folded.pop(latest):
+            self.insertRow(latest, projectName, version)
+        self.tree.selection_add([name for name in self.selected if name in self.shown])
+
+    def onSelect(self, *args):
+        chosen = set(self.tree.selection())
+        self.selected = (self.selected - self.shown) | (chosen & self.shown)
+
+    def selectedShown(self) -> List[List[str]]:
+        """列表中可见的选中项目, [[项目名, 版本], ...]"""
+        return [name.split(Const.CODE_SEPARATE) for name in self.tree.selection() if name in self.shown]
+
+    def stateOf(self, project: str, version: str) -> str:
+        if self.supervisor.get(project, version) is not None:
+            return '运行中'
+        if checkProjectRunnable(project, version):
+            return '可运行'
+        if checkProjectExists(project, version):
+            return '已安装'
+        return ''
+
+    def usageOf(self, project: str, version: str) -> str:
+        running = self.supervisor.get(project, version)
+        return running.usageText() if running is not None else ''
+
+    def updateRow(self, project: str, version: str):
+        totalName = project + Const.CODE_SEPARATE + version
+        if self.alive and self.tree is not None and self.tree.exists(totalName):
+            self.tree.set(totalName, 'state', self.stateOf(project, version))
+            self.tree.set(totalName, 'usage', self.usageOf(project, version))
+
+    def toggleRunSelected(self):
+        for project, version in self.selectedShown():
+            if self.supervisor.get(project, version) is not None:
+                self.stopProject(project, version)
+            elif checkProjectRunnable(project, version):
+                self.runProject(project, version)
+
+    def openSelected(self):
+        for project, version in self.selectedShown():
+            if checkProjectExists(project, version):
+                os.system(f'start explorer '
+                          f'{os.path.realpath(os.path.join(Const.SAVE_PATH, project + Const.SHOW_SEPARATE + version))}')
 
     def deleteSelectedProjects(self):
         if tkmsg.askyesno('确认删除？', f'是否真的要删除选中的本地项目文件？\n删除操作无法撤销！请做好信息备份！'):
-            for name, result in self.selected.items():  # type: str, tk.BooleanVar
-                if result.get():
-                    project, version = name.split(Const.CODE_SEPARATE)
-                    deleteProject(project, version, False)
-            self.refresh()
-
-    def runProject(self, project: str, version: str, controlButton: tk.Button):
-        self.processes[f'{project + Const.CODE_SEPARATE + version}'] = runProject(project, version)
-        controlButton['text'] = '停止'
-        controlButton['command'] = lambda p=project, v=version, b=controlButton: self.stopProject(p, v, b)
-        controlButton['background'] = 'red'
-        controlButton.after(Const.DELAY_CALL,
-                            self.checkProcessAlive,
-                            project, version, controlButton
-                            )
-
-    def stopProject(self, project: str, version: str, controlButton: tk.Button):
-        controlButton['text'] = '运行'
-        controlButton['command'] = lambda p=project, v=version, b=controlButton: self.runProject(p, v, b)
-        controlButton['background'] = 'green'
-        program = self.processes[project + Const.CODE_SEPARATE + version]  # type:subprocess.Popen
-        program.kill()
-
-    def checkProcessAlive(self, project: str, version: str, button: tk.Button):
-        if self.processes[project + Const.CODE_SEPARATE + version].poll() is not None:
-            self.stopProject(project, version, button)
-            del self.processes[project + Const.CODE_SEPARATE + version]
+            targets = [(project, version) for project, version in self.selectedShown()]  # 不删除搜索时隐藏的项目
+            removed = {}
+            threads = deleteProjects(targets, lambda path, count: removed.__setitem__(path, count))  # 同时在后台删除
+            self.fillTree()  # 只有安装状态变了
+            self.watchDeleting(threads, removed)
+
+    def watchDeleting(self, threads, removed: Dict[str, int]):
+        """在标题中显示后台删除的进度"""
+        if not self.alive:
+            return
+        if any(t.is_alive() for t in threads):
+            self.root.title(f'Azazo软件管理 - 正在删除{len(threads)}个项目, 已删除{sum(removed.values())}个文件')
+            self.root.after(Const.DELAY_CALL, self.watchDeleting, threads, removed)
         else:
-            button.after(Const.DELAY_CALL, self.checkProcessAlive, project, version, button)
+            self.root.title('Azazo软件管理')
+
+    def runProject(self, project: str, version: str):
+        self.supervisor.launch(project, version)
+        self.running.add((project, version))
+        self.updateRow(project, version)
+        if self._watchTask is None:
+            self._watchTask = self.root.after(Const.DELAY_CALL, self.checkProcessAlive)
+
+    def stopProject(self, project: str, version: str):
+        self.supervisor.stop(project, version)
+
+    def checkProcessAlive(self):
+        """所有运行中的项目共用一个定时器: 更新退出了的项目和各项目的占用"""
+        self._watchTask = None
+        if not self.alive:
+            return
+        running = {(item.projectName, item.version): item for item in self.supervisor.running()}
+        for project, version in self.running.difference(running):  # 监视线程发现它们退出了
+            self.updateRow(project, version)
+        self.running = set(running)
+        for (project, version), item in running.items():
+            totalName = project + Const.CODE_SEPARATE + version
+            if totalName in self.shown and self.tree.exists(totalName):
+                self.tree.set(totalName, 'usage', item.usageText())
+        if running:
+            self._watchTask = self.root.after(Const.DELAY_CALL, self.checkProcessAlive)
 
     def checkEmptySelect(self):
-        for i, b in self.selected.items():
-            if b.get():
-                return False
-        else:
-            return True
+        return not self.selected
 
     def newWindowRetrieve(self):
-        """第二线程新窗口下载"""
+        """新窗口显示进度, 第二线程下载"""
         self.check()
 
         if self.checkEmptySelect():
             showException('选择错误', '请选择你要下载的项目！')
-            self.refresh()
             return
-        alive = [True]
-        output = []
+        progress = queue.Queue()  # 下载线程 -> 窗口, None 表示下载失败
+        available = dict(self.available)  # 已经加载的邮件, 加载没有完成时也可以下载
 
         def close():
             log = text.get(0.0, tk.END)
             log = time.asctime(time.localtime(time.time())) + '\n' + log + '-----\n'
             with open(Const.LOG_PATH, 'ab') as w:
                 w.write(log.encode())
-            destroy(window)
-            alive[0] = False
+            window.grab_release()
+            window.destroy()
 
-        def rep(msg: str):
-            output.append(msg)
+        def finish(p: str):
+            close()
+            if tkmsg.askokcancel('下载成功', f'是否前往"{p}"查看项目。'):
+                os.system(f'start explorer "{p}"')
+            self.fillTree()
 
-        def checkOutput():
-            if not output:
-                return
-            msg = output.pop(0)
-            if Const.FINISH_DOWNLOAD in msg:
-                close()
-                p = msg.split(Const.CODE_SEPARATE)[-1]
-                if tkmsg.askokcancel('下载成功', f'是否前往"{p}"查看项目。'):
-                    os.system(f'start explorer "{p}"')
-                return
-            text.insert(tk.END, msg)
+        def work():
+            try:
+                self.retrieve(progress.put, available)
+            except Exception:
+                progress.put(tb.format_exc())
+                progress.put(None)
 
-        window = tk.Tk()
+        def drain():
+            """一次显示一批进度"""
+            if not window.winfo_exists():  # 失败后窗口已被关闭
+                return
+            lines = []
+            for _ in range(Const.PROGRESS_BATCH):
+                try:
+                    msg = progress.get_nowait()
+                except queue.Empty:
+                    break
+                if msg is None:  # 下载失败, 允许关闭窗口
+                    window.protocol('WM_DELETE_WINDOW', lambda *args: close() or self.fillTree())
+                    continue
+                if Const.FINISH_DOWNLOAD in msg:
+                    text.insert(tk.END, ''.join(lines))
+                    finish(msg.split(Const.CODE_SEPARATE)[-1])
+                    return
+                lines.append(msg)
+            if lines:
+                text.insert(tk.END, ''.join(lines))
+                text.see(tk.END)
+            window.after(Const.PROGRESS_INTERVAL, drain)
+
+        window = tk.Toplevel(self.root)
         window.title('下载进度')
+        window.transient(self.root)
+        window.protocol('WM_DELETE_WINDOW', lambda *args: None)
+        text = tk.Text(window)
+        text.pack(expand=True, fill=tk.BOTH)
+        window.grab_set()  # 下载时不能操作主窗口
+        threading.Thread(target=work, daemon=True).start()
+        window.after(Const.PROGRESS_INTERVAL, drain)
+
+    def newWindowVerify(self):
+        """新窗口显示校验结果, 有损坏的项目时询问是否修复"""
+        self.check()
+        targets = [(project, version) for project, version in self.selectedShown()
+                   if checkProjectExists(project, version)]
+        if not targets:
+            showException('选择错误', '请选择已安装的项目！')
+            return
+        progress = queue.Queue()  # 工作线程 -> 窗口, 列表表示工作结束
+        available = dict(self.available)  # 修复时只用连接池, 主连接可能正在后台加载
+
+        def verify():
+            try:
+                progress.put(verifyProjects(targets, progress=lambda result: progress.put(describeVerify(result))))
+            except Exception:
+                progress.put(tb.format_exc())
+                progress.put([])
+
+        def repair(results: List[VerifyResult]):
+            for result in results:
+                try:
+                    progress.put(describeVerify(self.downloader.repair(
+                        result.projectName, result.version, progress.put, result=result, available=available)))
+                except Exception as e:
+                    progress.put(f'修复"{result.projectName}{Const.SHOW_SEPARATE}{result.version}"失败: {e}\n')
+            progress.put([])
+
+        def finish(results: List[VerifyResult]):
+            damaged = [result for result in results if not result.intact]
+            if damaged and tkmsg.askokcancel('发现损坏', f'{len(damaged)}个项目的文件缺少或被修改, 是否修复？',
+                                             parent=window):
+                text.insert(tk.END, '修复中...\n')
+                threading.Thread(target=repair, args=(damaged,), daemon=True).start()
+                return False
+            if not results:
+                text.insert(tk.END, '完成\n')
+            window.protocol('WM_DELETE_WINDOW', close)
+            self.fillTree()
+            return True
+
+        def close():
+            window.grab_release()
+            window.destroy()
+
+        def drain():
+            lines = []
+            for _ in range(Const.PROGRESS_BATCH):
+                try:
+                    msg = progress.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(msg, list):
+                    text.insert(tk.END, ''.join(lines))
+                    text.see(tk.END)
+                    lines = []
+                    if finish(msg):
+                        return
+                    continue
+                lines.append(msg)
+            if lines:
+                text.insert(tk.END, ''.join(lines))
+                text.see(tk.END)
+            window.after(Const.PROGRESS_INTERVAL, drain)
+
+        window = tk.Toplevel(self.root)
+        window.title('校验')
+        window.transient(self.root)
         window.protocol('WM_DELETE_WINDOW', lambda *args: None)
         text = tk.Text(window)
         text.pack(expand=True, fill=tk.BOTH)
-        threading.Thread(target=self.retrieve, args=(rep,), daemon=True).start()
-        while alive[0]:
-            window.update()
-            checkOutput()
-        self.refresh()
-
-    def retrieve(self, report: lambda msg: None):
-        """下载选中项目"""
+        window.grab_set()  # 修复时不能操作主窗口
+        text.insert(tk.END, f'校验{len(targets)}个项目中...\n')
+        threading.Thread(target=verify, daemon=True).start()
+        window.after(Const.PROGRESS_INTERVAL, drain)
+
+    def retrieve(self, report: lambda msg: None, available: Dict[bytes, email.message.Message] = None):
+        """下载选中项目, available: 见 Downloader.fetchAll"""
         self.check()
-        for name, button in self.selected.items():  # type: str, tk.BooleanVar
-            if not button.get():
-                continue
-            report(f'下载{name.split(Const.CODE_SEPARATE)}中...\n')
+        targets = []
+        for name in list(self.selected):
             projectName, version = name.split(Const.CODE_SEPARATE)
-            self.downloader.fetch(projectName, version)
-        else:
-            report(f'下载完毕, 正在安装...\n')
+            targets.append((projectName, version))
+        mark = tracer.mark()
+        try:
+            report(f'下载{len(targets)}个项目中...\n')
+            failed = self.downloader.fetchAll(targets, report, available)  # 多个项目并行下载
+            for (projectName, version), e in failed.items():
+                report(f'下载"{projectName}{Const.SHOW_SEPARATE}{version}"失败: {e}\n')
+            report(f'下载完毕, 正在安装...\n')  # 下载成功的项目照常安装
             p = os.path.realpath(self.downloader.save(report=report))
             self.downloader.clearTempFile()
-            report(Const.FINISH_DOWNLOAD + Const.CODE_SEPARATE + p)  # 报告：下载完成加保存路径
+            if failed:  # 不报告下载完成, 窗口显示错误后可以关闭
+                raise FileNotFoundError(f'{len(failed)}个项目下载失败.')
+        finally:
+            if tracer.enabled:  # 显示各阶段耗时, 详细记录保存到 TRACE_PATH
+                report('各阶段耗时:\n' + tracer.summaryText(mark))
+                tracer.export(Const.TRACE_PATH, mark)
+        report(Const.FINISH_DOWNLOAD + Const.CODE_SEPARATE + p)  # 报告：下载完成加保存路径
 
     def close(self):
         if self.alive:
             self.alive = False
+            self.supervisor.close()
             destroy(self.root)
+            self._stopLoading.set()
+            if self._loader is not None:  # 加载线程还在用连接和目录
+                self._loader.join()
             self.downloader.close()
+            self.downloader.catalog.close()
 
     def __del__(self):
         self.close()